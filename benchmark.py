@@ -0,0 +1,561 @@
+import os
+import sys
+import time
+import threading
+import json
+import signal
+import base64
+import urllib2
+import socket
+import subprocess
+from redis import Redis
+from redis.client import Pipeline
+import server
+
+"""
+    benchmark.py
+    Micro-benchmarks of the Portfolio Management System against Redis.
+    Example usage: python benchmark.py deserialize
+    The benchmarks use the Redis database BENCHMARK_REDIS_DB (15 by
+    default) of the Redis service found by server.determine_credentials,
+    and flush it before running.
+"""
+
+BENCHMARK_REDIS_DB = int(os.getenv('BENCHMARK_REDIS_DB', '15'))
+BENCHMARK_ASSET_ID = 100000 # first asset id created by the benchmarks
+
+class CountingPipeline(Pipeline):
+    """Redis pipeline counting one round trip per execute call.
+
+    """
+    def execute(self, *args, **kwargs):
+        CountingRedis.round_trips += 1
+        return Pipeline.execute(self, *args, **kwargs)
+
+class CountingRedis(Redis):
+    """Redis client counting the round trips made to the Redis service.
+
+        Attributes:
+            round_trips (int): Number of round trips since the last reset.
+    """
+    round_trips = 0
+
+    def execute_command(self, *args, **options):
+        CountingRedis.round_trips += 1
+        return Redis.execute_command(self, *args, **options)
+
+    def pipeline(self, transaction=True, shard_hint=None):
+        return CountingPipeline(self.connection_pool, self.response_callbacks, transaction, shard_hint)
+
+def connect():
+    """Connects the server module to the benchmark Redis database.
+
+    """
+    creds = server.determine_credentials()
+    server.redis_server = CountingRedis(host=creds.host, port=creds.port, password=creds.password, db=BENCHMARK_REDIS_DB)
+    server.redis_server.flushdb()
+
+def measure(function, repeat):
+    """Runs a function several times.
+
+        Args:
+            function (function): Function without arguments to run.
+            repeat (int): Number of runs.
+
+        Returns:
+            (round_trips, milliseconds) (float, float): Average number of
+                                                        round trips and
+                                                        wall time per run.
+    """
+    CountingRedis.round_trips = 0
+    start = time.time()
+    for _ in range(repeat):
+        function()
+    elapsed = time.time() - start
+    return float(CountingRedis.round_trips) / repeat, 1000 * elapsed / repeat
+
+def create_assets(count):
+    """Creates count assets in Redis, with ids from BENCHMARK_ASSET_ID.
+
+        Args:
+            count (int): Number of assets to create.
+
+        Returns:
+            asset_ids (list[int]): Ids of the assets created.
+    """
+    asset_ids = range(BENCHMARK_ASSET_ID, BENCHMARK_ASSET_ID + count)
+    pipe = server.redis_server.pipeline(transaction=False)
+    for asset_id in asset_ids:
+        pipe.hmset("asset_id_"+str(asset_id), {"id": asset_id, "name": "asset "+str(asset_id), "price": 1.5, "class": "commodity"})
+    pipe.execute()
+    return asset_ids
+
+def legacy_deserialize(serialized_data):
+    """Deserializes a portfolio resolving each asset with three HGETs.
+
+        This is how Portfolio.deserialize resolved the assets metadata
+        before the asset catalog, and is used as the reference.
+
+        Args:
+            serialized_data (str): Serialized Portfolio.
+
+        Returns:
+            nav (float): Net asset value of the portfolio.
+    """
+    nav = 0
+    for ID, q in server.Portfolio.decode(serialized_data)[1]:
+        server.redis_server.hget("asset_id_"+str(ID), "class")
+        server.redis_server.hget("asset_id_"+str(ID), "name")
+        nav += q * float(server.redis_server.hget("asset_id_"+str(ID), "price"))
+    return nav
+
+def benchmark_deserialize():
+    """Round trips and wall time of Portfolio.deserialize vs holdings count.
+
+        Compares the legacy per-asset HGETs with the batched resolution of
+        Portfolio.deserialize, with an empty (cold) and a loaded (warm)
+        asset catalog.
+    """
+    print("holdings | legacy trips  ms    | cold trips  ms    | warm trips  ms")
+    for holdings in [1, 10, 50, 200, 1000]:
+        connect()
+        portfolio = server.Portfolio("bench")
+        asset_ids = create_assets(holdings)
+        server.asset_catalog.load()
+        for asset_id in asset_ids:
+            portfolio.buy_sell(asset_id, 2)
+        data = portfolio.serialize()
+        repeat = max(5, 2000 // holdings)
+        legacy = measure(lambda: legacy_deserialize(data), repeat)
+        def cold():
+            server.asset_catalog.assets.clear()
+            server.Portfolio.deserialize(data)
+        cold = measure(cold, repeat)
+        warm = measure(lambda: server.Portfolio.deserialize(data), repeat)
+        print("%8d | %11.0f %7.2f | %10.0f %7.2f | %10.0f %7.2f" % ((holdings,) + legacy + cold + warm))
+
+def legacy_serialize(portfolio):
+    """Serializes a portfolio in the legacy hexadecimal format.
+
+        Args:
+            portfolio (Portfolio): Portfolio to serialize.
+
+        Returns:
+            serialized_data (str): Two hexadecimal parts joined by ';'.
+    """
+    assets = "#".join([a.serialize(a_id) for a_id, a in portfolio.assets.iteritems()])
+    return portfolio.user.encode("hex") + ";" + assets.encode("hex")
+
+def benchmark_encoding():
+    """Size and speed of the legacy and compact portfolio encodings.
+
+        Also migrates 2000 legacy portfolios of 20 holdings and reports the
+        Redis used memory before and after.
+    """
+    print("holdings | legacy bytes  ser ms  deser ms | compact bytes  ser ms  deser ms")
+    for holdings in [1, 10, 50, 200, 1000]:
+        connect()
+        portfolio = server.Portfolio("bench")
+        for asset_id in create_assets(holdings):
+            portfolio.buy_sell(asset_id, 1.0 / 3)
+        server.asset_catalog.load()
+        repeat = max(5, 2000 // holdings)
+        legacy_data = legacy_serialize(portfolio)
+        compact_data = portfolio.serialize()
+        legacy = measure(lambda: legacy_serialize(portfolio), repeat)[1], measure(lambda: server.Portfolio.deserialize(legacy_data), repeat)[1]
+        compact = measure(lambda: portfolio.serialize(), repeat)[1], measure(lambda: server.Portfolio.deserialize(compact_data), repeat)[1]
+        print("%8d | %12d %7.3f %9.3f | %13d %7.3f %9.3f" % ((holdings, len(legacy_data)) + legacy + (len(compact_data),) + compact))
+    connect()
+    asset_ids = create_assets(20)
+    server.asset_catalog.load()
+    pipe = server.redis_server.pipeline(transaction=False)
+    for i in range(2000):
+        portfolio = server.Portfolio("user"+str(i))
+        for asset_id in asset_ids:
+            portfolio.buy_sell(asset_id, 1.0 / 3)
+        pipe.hmset("user_user"+str(i), {"name": "user"+str(i), "data": legacy_serialize(portfolio)})
+    pipe.execute()
+    start = time.time()
+    report = server.migrate_portfolios_encoding()
+    print("migration of %d portfolios in %.2fs: used memory %d -> %d bytes" % (report["migrated"], time.time() - start, report["usedMemoryBefore"], report["usedMemoryAfter"]))
+
+def legacy_trade(user, asset_id, quantity):
+    """Trades an asset as update_asset did before the Lua scripts.
+
+        The portfolio is read, deserialized, modified and written back
+        without any isolation from concurrent trades.
+
+        Args:
+            user (str): Name of the user.
+            asset_id (int): Unique asset id.
+            quantity (float): Quantity to buy (positive) or sell (negative).
+    """
+    portfolio = server.Portfolio.deserialize(server.redis_server.hget("user_"+user, "data"))
+    portfolio.buy_sell(asset_id, quantity)
+    server.redis_server.hset("user_"+user, "data", portfolio.serialize())
+
+def run_concurrently(function, threads, trades):
+    """Runs a function from several threads at the same time.
+
+        Args:
+            function (function): Function without arguments to run.
+            threads (int): Number of threads.
+            trades (int): Number of runs per thread.
+
+        Returns:
+            seconds (float): Wall time until all the threads finished.
+    """
+    def work():
+        for _ in range(trades):
+            function()
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.time() - start
+
+def benchmark_trades():
+    """Lost updates and throughput of concurrent trades on one portfolio.
+
+        Several threads buy one unit of the same asset in the same
+        portfolio, with the legacy read-modify-write and with the buy_sell
+        Lua script.
+    """
+    print("threads | legacy lost  trades/s | script lost  trades/s")
+    trades = 500
+    for threads in [1, 2, 4, 8, 16]:
+        connect()
+        asset_id = create_assets(1)[0]
+        server.asset_catalog.load()
+        server.load_lua_scripts()
+        server.redis_server.hmset("user_bench", {"name": "bench", "data": server.Portfolio.encode("bench", [(asset_id, 1.0)])})
+        seconds = run_concurrently(lambda: legacy_trade("bench", asset_id, 1), threads, trades)
+        held = dict(server.Portfolio.decode(server.redis_server.hget("user_bench", "data"))[1])[asset_id] - 1
+        legacy = (threads * trades - held, threads * trades / seconds)
+        server.redis_server.delete("user_bench")
+        server.redis_server.hmset("user_bench", {"name": "bench"})
+        server.redis_server.hset("holdings_bench", asset_id, 1.0)
+        seconds = run_concurrently(lambda: server.run_trade_script("buy_sell", "bench", asset_id, 1), threads, trades)
+        held = float(server.redis_server.hget("holdings_bench", asset_id)) - 1
+        script = (threads * trades - held, threads * trades / seconds)
+        print("%7d | %11d %9.0f | %11d %9.0f" % ((threads,) + legacy + script))
+
+def benchmark_prices():
+    """Round trips and wall time of set_asset_prices vs number of updates.
+
+        10000 portfolios hold 20 of 5000 assets each; every update changes
+        the price of a different asset.
+    """
+    connect()
+    asset_ids = create_assets(5000)
+    server.asset_catalog.load()
+    pipe = server.redis_server.pipeline(transaction=False)
+    for i in range(10000):
+        pipe.hmset("user_user"+str(i), {"name": "user"+str(i), "nav": 30.0})
+        pipe.hmset("holdings_user"+str(i), dict((asset_ids[(i * 20 + j) % len(asset_ids)], 1.0) for j in range(20)))
+    pipe.execute()
+    start = time.time()
+    report = server.rebuild_holders()
+    print("index of %d holdings rebuilt in %.2fs" % (report["added"], time.time() - start))
+    print("updates | portfolios   trips       ms")
+    price = 1.5
+    for updates in [1, 10, 100, 1000, 5000]:
+        price += 1
+        prices = dict((asset_id, price) for asset_id in asset_ids[:updates])
+        CountingRedis.round_trips = 0
+        start = time.time()
+        portfolios, _ = server.set_asset_prices(prices)
+        print("%7d | %10d %7d %8.0f" % (updates, portfolios, CountingRedis.round_trips, 1000 * (time.time() - start)))
+    print(server.verify_navs())
+
+def benchmark_rebalance():
+    """Round trips and wall time of a 20 legs rebalance.
+
+        Compares one PUT /portfolios/<user>/assets/<id> per leg with a
+        single POST /portfolios/<user>/trades, through the Flask test
+        client with authentication on.
+    """
+    connect()
+    asset_ids = create_assets(20)
+    server.asset_catalog.load()
+    server.redis_server.hmset("password_bench", {"hash_password": server.generate_password_hash("bench")})
+    server.redis_server.hmset("user_bench", {"name": "bench"})
+    server.redis_server.hmset("holdings_bench", dict((asset_id, 100.0) for asset_id in asset_ids))
+    server.rebuild_holders()
+    client = server.app.test_client()
+    headers = {"Authorization": "Basic " + "bench:bench".encode("base64").strip()}
+    legs = [{"asset_id": asset_id, "quantity": 1 if i % 2 else -1} for i, asset_id in enumerate(asset_ids)]
+    def puts():
+        for leg in legs:
+            client.put(server.url_version+"/portfolios/bench/assets/"+str(leg["asset_id"]), data=json.dumps({"quantity": leg["quantity"]}), headers=headers)
+    def post():
+        client.post(server.url_version+"/portfolios/bench/trades", data=json.dumps({"trades": legs}), headers=headers)
+    puts() # warms up the credentials cache
+    print("20 PUTs: %.0f round trips %.2f ms" % measure(puts, 50))
+    print("1 POST:  %.0f round trips %.2f ms" % measure(post, 50))
+    print(server.verify_navs())
+
+def benchmark_bulk():
+    """Trades per second of PUT per trade vs the bulk trades endpoint.
+
+        20000 trades over 2000 users holding 10 assets each, through the
+        Flask test client with authentication on.
+    """
+    connect()
+    asset_ids = create_assets(10)
+    server.asset_catalog.load()
+    server.redis_server.hmset("admin_password_admin", {"hash_password": server.generate_password_hash("admin")})
+    pipe = server.redis_server.pipeline(transaction=False)
+    for i in range(2000):
+        pipe.hmset("user_user"+str(i), {"name": "user"+str(i)})
+        pipe.hmset("holdings_user"+str(i), dict((asset_id, 100.0) for asset_id in asset_ids))
+    pipe.execute()
+    server.rebuild_holders()
+    client = server.app.test_client()
+    headers = {"Authorization": "Basic " + "admin:admin".encode("base64").strip()}
+    trades = [{"user": "user"+str(i % 2000), "asset_id": asset_ids[i % 10], "quantity": 1 if i % 3 else -1} for i in range(20000)]
+    start = time.time()
+    for trade in trades:
+        client.put(server.url_version+"/portfolios/"+trade["user"]+"/assets/"+str(trade["asset_id"]), data=json.dumps({"quantity": trade["quantity"]}), headers=headers)
+    print("PUT per trade: %.0f trades/s" % (len(trades) / (time.time() - start)))
+    for content_type, data in [("application/json", json.dumps({"trades": trades})), ("application/x-ndjson", "\n".join(json.dumps(trade) for trade in trades))]:
+        CountingRedis.round_trips = 0
+        start = time.time()
+        response = client.post(server.url_version+"/trades", data=data, content_type=content_type, headers=headers)
+        elapsed = time.time() - start
+        print("bulk %s: %.0f trades/s, %d round trips, %d applied" % (content_type, len(trades) / elapsed, CountingRedis.round_trips, json.loads(response.data)["applied"]))
+    print(server.verify_navs())
+
+def benchmark_valuation():
+    """Valuation of the whole book with the valuation engine.
+
+        Values 1M holdings (100000 users holding 10 of 5000 assets) built
+        in memory, with NumPy and in pure Python, then loads 100000
+        holdings from Redis.
+    """
+    connect()
+    asset_ids = create_assets(5000)
+    users = ["user"+str(i) for i in range(100000)]
+    holdings = [(user, asset_ids[(i * 7 + j * 131) % len(asset_ids)], 1.0 + j) for i, user in enumerate(users) for j in range(10)]
+    numpy = server.numpy
+    for label, module in [("numpy", numpy), ("pure Python", None)]:
+        server.numpy = module
+        engine = server.ValuationEngine()
+        start = time.time()
+        engine.build(users, holdings)
+        engine.loaded_at = time.time()
+        build = time.time() - start
+        engine.value() # warms up the connection
+        trips, milliseconds = measure(engine.value, 5)
+        print("%s: %d holdings built in %.2fs, valued in %.1f ms (%d round trips), AUM %.2f" % (label, len(holdings), build, milliseconds, trips, sum(engine.value()[1])))
+    server.numpy = numpy
+    pipe = server.redis_server.pipeline(transaction=False)
+    for user in users[:10000]:
+        pipe.hmset("user_"+user, {"name": user})
+        pipe.sadd("list_users", user)
+    for user, asset_id, quantity in holdings[:100000]:
+        pipe.hset("holdings_"+user, asset_id, quantity)
+    pipe.execute()
+    engine = server.ValuationEngine()
+    engine.load()
+    print("100000 holdings of 10000 users loaded from Redis in %.2fs" % engine.load_seconds)
+
+def start_server(command, port):
+    """Starts server.py in a new process group and waits until it answers.
+
+        Args:
+            command (list[str]): Command line arguments of server.py.
+            port (int): Port the server listens on.
+
+        Returns:
+            process (Popen): The server process.
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    with open(os.devnull, "w") as devnull:
+        process = subprocess.Popen([sys.executable, os.path.join(directory, "server.py")] + command, cwd=directory,
+                                   env=dict(os.environ, PORT=str(port)), stdout=devnull, stderr=devnull, preexec_fn=os.setsid)
+    for _ in range(300):
+        try:
+            urllib2.urlopen("http://127.0.0.1:%d/api/v1" % port).read()
+            return process
+        except IOError:
+            time.sleep(0.1)
+    stop_server(process)
+    raise RuntimeError("server.py %s did not start" % " ".join(command))
+
+def stop_server(process):
+    """Stops a server started with start_server and all its processes.
+
+        Args:
+            process (Popen): The server process.
+    """
+    os.killpg(process.pid, signal.SIGTERM)
+    process.wait()
+
+def http_request(port, method, path, credentials, body=None, timeout=30):
+    """Sends a request with basic authentication to a local server.
+
+        Args:
+            port (int): Port of the server.
+            method (str): HTTP method.
+            path (str): Path of the resource.
+            credentials (str): "user:password".
+            body (None, dict): JSON body of the request.
+            timeout (float): Seconds to wait for the response.
+
+        Returns:
+            data (str): Body of the response.
+    """
+    request = urllib2.Request("http://127.0.0.1:%d%s" % (port, path), json.dumps(body) if body is not None else None)
+    request.get_method = lambda: method
+    request.add_header("Authorization", "Basic " + base64.b64encode(credentials))
+    request.add_header("Content-Type", "application/json")
+    return urllib2.urlopen(request, timeout=timeout).read()
+
+def benchmark_serving():
+    """Throughput of the development server and of the serve command.
+
+        Client threads read the NAV of a portfolio (authentication, one
+        Redis round trip) with one connection per request, against the
+        single process Werkzeug server with the debugger (run command)
+        and the pre-forking gunicorn server (serve command). These use the
+        default Redis database, where a portfolio is created for the
+        benchmark and deleted afterwards.
+    """
+    port = int(os.getenv('BENCHMARK_PORT', '5099'))
+    admin = "admin:admin_password"
+    user, password = "benchmark_serving", "benchmark_password"
+    configurations = [("run (dev server)", ["run"])]
+    for workers, threads in [(1, 1), (server.SERVER_WORKERS, 1), (2, 4)]:
+        configurations.append(("serve %d workers x %d threads" % (workers, threads), ["serve", "--workers", str(workers), "--threads", str(threads)]))
+    print("server                          | clients | requests/s")
+    for label, command in configurations:
+        process = start_server(command, port)
+        try:
+            http_request(port, "POST", "/api/v1/portfolios", admin, {"user": user, "password": password})
+            http_request(port, "POST", "/api/v1/portfolios/%s/assets" % user, user+":"+password, {"asset_id": 0, "quantity": 2})
+            read_nav = lambda: http_request(port, "GET", "/api/v1/portfolios/%s/nav" % user, user+":"+password)
+            for clients in [1, 8, 32]:
+                requests = 2000 // clients
+                seconds = run_concurrently(read_nav, clients, requests)
+                print("%-31s | %7d | %10.0f" % (label, clients, clients * requests / seconds))
+        finally:
+            http_request(port, "DELETE", "/api/v1/portfolios/%s" % user, admin)
+            stop_server(process)
+
+def benchmark_connections():
+    """Concurrent connections served by threaded and gevent workers.
+
+        Slow clients open connections and send only their request line,
+        keeping them open as clients on a slow network would, then NAV
+        reads are sent and must be answered within 2 seconds. A sync or
+        threaded worker is stuck with a slow client until it finishes
+        its request (or SERVER_TIMEOUT), one per thread, while a gevent
+        worker (serve-async command) serves the other clients meanwhile,
+        up to SERVER_CONNECTIONS per worker.
+    """
+    port = int(os.getenv('BENCHMARK_PORT', '5099'))
+    admin = "admin:admin_password"
+    user, password = "benchmark_connections", "benchmark_password"
+    workers = str(server.SERVER_WORKERS)
+    configurations = [("serve %s workers x 1 thread" % workers, ["serve", "--workers", workers, "--threads", "1"]),
+                      ("serve %s workers x 8 threads" % workers, ["serve", "--workers", workers, "--threads", "8"]),
+                      ("serve-async 1 worker", ["serve-async", "--workers", "1"]),
+                      ("serve-async %s workers" % workers, ["serve-async", "--workers", workers])]
+    read_nav = lambda: http_request(port, "GET", "/api/v1/portfolios/%s/nav" % user, user+":"+password, timeout=2)
+    print("server                          | slow clients | reads served | ms per read")
+    for label, command in configurations:
+        process = start_server(command, port)
+        try:
+            http_request(port, "POST", "/api/v1/portfolios", admin, {"user": user, "password": password})
+            http_request(port, "POST", "/api/v1/portfolios/%s/assets" % user, user+":"+password, {"asset_id": 0, "quantity": 2})
+            read_nav()
+            for slow_clients in [2, 20, 200, 800]:
+                connections = [socket.create_connection(("127.0.0.1", port)) for _ in range(slow_clients)]
+                for connection in connections:
+                    connection.sendall("GET /api/v1 HTTP/1.1\r\n")
+                time.sleep(0.5)
+                served = 0
+                start = time.time()
+                for _ in range(20):
+                    try:
+                        read_nav()
+                        served += 1
+                    except IOError:
+                        pass
+                milliseconds = (time.time() - start) * 1000 / 20
+                for connection in connections:
+                    connection.close()
+                print("%-31s | %12d | %9d/20 | %11.1f" % (label, slow_clients, served, milliseconds))
+                if not served:
+                    break
+        finally:
+            time.sleep(0.5)
+            http_request(port, "DELETE", "/api/v1/portfolios/%s" % user, admin)
+            stop_server(process)
+
+def benchmark_metrics():
+    """Overhead of the metrics on the hot paths.
+
+        Lists the 20 assets of a portfolio with the Flask test client
+        (authentication, conditional request, holdings and NAV reads)
+        with the metrics enabled and disabled in alternating rounds, each
+        request observing its route, check_auth and 3 Redis round trips.
+        Also times one observation and one flush to Redis.
+    """
+    creds = server.determine_credentials()
+    server.redis_server = Redis(connection_pool=server.RedisPool(host=creds.host, port=creds.port, password=creds.password, db=BENCHMARK_REDIS_DB))
+    server.redis_server.flushdb()
+    server.load_lua_scripts()
+    server.fill_database_admin()
+    client = server.app.test_client()
+    authorization = lambda credentials: {'Authorization': 'Basic ' + base64.b64encode(credentials)}
+    user, password = "benchmark_metrics", "benchmark_password"
+    client.post("/api/v1/portfolios", data=json.dumps({"user": user, "password": password}), headers=authorization("admin:admin_password"))
+    for asset_id in create_assets(20):
+        client.post("/api/v1/portfolios/%s/assets" % user, data=json.dumps({"asset_id": asset_id, "quantity": 2}), headers=authorization(user+":"+password))
+    headers = authorization(user+":"+password)
+    list_assets = lambda: client.get("/api/v1/portfolios/%s/assets" % user, headers=headers)
+    results = {True: [], False: []}
+    for round in range(10):
+        for enabled in [True, False]:
+            server.metrics.enabled = enabled
+            start = time.time()
+            for _ in range(500):
+                list_assets()
+            results[enabled].append(1000 * (time.time() - start) / 500)
+    for enabled in [False, True]:
+        print("metrics %-8s: %.3f ms per request (best round %.3f ms)" % ("enabled" if enabled else "disabled", sum(results[enabled]) / len(results[enabled]), min(results[enabled])))
+    server.metrics.enabled = True
+    labels = (("command", "HGET"),)
+    start = time.time()
+    for _ in range(100000):
+        server.metrics.observe("portfoliomgmt_redis_command_duration_seconds", labels, 0.0003)
+    print("one observation: %.2f us" % (10 * (time.time() - start)))
+    start = time.time()
+    server.metrics.flush()
+    print("flush of %d series: %.1f ms" % (server.redis_server.hlen(server.METRICS_KEY), 1000 * (time.time() - start)))
+
+BENCHMARKS = {
+    "deserialize" : benchmark_deserialize,
+    "encoding" : benchmark_encoding,
+    "prices" : benchmark_prices,
+    "rebalance" : benchmark_rebalance,
+    "bulk" : benchmark_bulk,
+    "valuation" : benchmark_valuation,
+    "trades" : benchmark_trades,
+    "serving" : benchmark_serving,
+    "connections" : benchmark_connections,
+    "metrics" : benchmark_metrics
+    }
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    if len(sys.argv) != 2 or sys.argv[1] not in BENCHMARKS:
+        print("Usage: python benchmark.py [" + "|".join(sorted(BENCHMARKS)) + "]")
+        exit(1)
+    BENCHMARKS[sys.argv[1]]()
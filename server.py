@@ -1,8 +1,38 @@
 import os
-from redis import Redis, ConnectionError
-from flask import Flask, jsonify, request, json, Response
+import csv
+import sys
+import time
+STARTED_AT = time.time() # before the other imports, for the cold start time
+import math
+import struct
+import bisect
+import logging
+import argparse
+import hmac
+import hashlib
+import threading
+import multiprocessing
+from collections import OrderedDict
+from base64 import urlsafe_b64encode, urlsafe_b64decode
+from Queue import Empty
+from redis import Redis, ConnectionError, BlockingConnectionPool
+from redis.exceptions import NoScriptError, TimeoutError
+from flask import Flask, jsonify, request, json, Response, g, _app_ctx_stack
 from werkzeug.security import generate_password_hash, check_password_hash
+from werkzeug.urls import url_encode
 from functools import wraps
+try:
+    import numpy
+except ImportError: # optional, the valuation engine falls back to pure Python
+    numpy = None
+try:
+    import gunicorn.app.base
+except ImportError: # optional, only needed by the serve commands
+    gunicorn = None
+try:
+    import gevent
+except ImportError: # optional, only needed by the serve-async command
+    gevent = None
 
 """
     server.py
@@ -19,10 +49,13 @@ from functools import wraps
 HTTP_200_OK = 200
 HTTP_201_CREATED = 201
 HTTP_204_NO_CONTENT = 204
+HTTP_304_NOT_MODIFIED = 304
 HTTP_400_BAD_REQUEST = 400
 HTTP_401_UNAUTHORIZED = 401
 HTTP_404_NOT_FOUND = 404
 HTTP_409_CONFLICT = 409
+HTTP_500_INTERNAL_SERVER_ERROR = 500
+HTTP_503_SERVICE_UNAVAILABLE = 503
 
 # Create Flask application
 app = Flask(__name__)
@@ -30,14 +63,465 @@ url_version = "/api/v1"
 app_name = "Portfolio Management RESTful Service"
 app_version = 1.0
 redis_server = None
+swagger_specification = None # JS Swagger specification, once rendered
 SECURED = True
+AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', '1024'))
+AUTH_CACHE_TTL = float(os.getenv('AUTH_CACHE_TTL', '300'))
+PORTFOLIOS_CACHE_SIZE = int(os.getenv('PORTFOLIOS_CACHE_SIZE', '64')) # listings and pages cached
+PORTFOLIOS_CACHE_TTL = float(os.getenv('PORTFOLIOS_CACHE_TTL', '60'))
+ASSET_CATALOG_REFRESH = float(os.getenv('ASSET_CATALOG_REFRESH', '5'))
+ASSET_CATALOG_VERSION = "asset_catalog_version"
+ASSET_CATALOG_CHANNEL = "asset_catalog"
+PORTFOLIO_VERSION = "portfolio_version" # counter of the portfolio changes, for the ETags
+SEED_VERSION = 2 # to increment when the common assets change
+SEED_VERSION_KEY = "seed_version"
+ASSET_FIELDS = ["id", "name", "class", "price"]
+PORTFOLIOS_PAGE_LIMIT = int(os.getenv('PORTFOLIOS_PAGE_LIMIT', '100'))
+PORTFOLIOS_PAGE_LIMIT_MAX = int(os.getenv('PORTFOLIOS_PAGE_LIMIT_MAX', '1000'))
+EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', '500'))
+MIGRATION_BATCH_SIZE = int(os.getenv('MIGRATION_BATCH_SIZE', '500'))
+PRICES_BATCH_MAX = int(os.getenv('PRICES_BATCH_MAX', '10000'))
+ASSETS_SEARCH_SCAN_MAX = int(os.getenv('ASSETS_SEARCH_SCAN_MAX', '10000')) # names read per page with class and q
+ASSETS_IMPORT_BATCH_SIZE = int(os.getenv('ASSETS_IMPORT_BATCH_SIZE', '2000'))
+ASSETS_IMPORT_SCRIPT_SIZE = 100 # assets written per script call
+ASSETS_IMPORT_ERRORS_MAX = 100 # invalid rows reported in detail
+TRADES_MAX_LEGS = int(os.getenv('TRADES_MAX_LEGS', '1000'))
+BULK_TRADES_BATCH_SIZE = int(os.getenv('BULK_TRADES_BATCH_SIZE', '5000'))
+TRADES_RETRIES = int(os.getenv('TRADES_RETRIES', '5'))
+VALUATION_MAX_AGE = float(os.getenv('VALUATION_MAX_AGE', '60'))
+NAV_DRIFT_TOLERANCE = float(os.getenv('NAV_DRIFT_TOLERANCE', '1e-9')) # relative
+SERVER_WORKERS = int(os.getenv('SERVER_WORKERS', str(2 * multiprocessing.cpu_count() + 1)))
+SERVER_THREADS = int(os.getenv('SERVER_THREADS', '1'))
+SERVER_CONNECTIONS = int(os.getenv('SERVER_CONNECTIONS', '1000')) # per worker, with serve-async
+SERVER_TIMEOUT = int(os.getenv('SERVER_TIMEOUT', '30')) # seconds before a stuck worker is restarted
+SERVER_GRACEFUL_TIMEOUT = int(os.getenv('SERVER_GRACEFUL_TIMEOUT', '30')) # seconds to finish requests on reload
+REDIS_POOL_SIZE = int(os.getenv('REDIS_POOL_SIZE', '50')) # connections per process
+REDIS_POOL_BLOCKING = os.getenv('REDIS_POOL_BLOCKING', 'true').lower() in ('1', 'true', 'yes')
+REDIS_POOL_TIMEOUT = float(os.getenv('REDIS_POOL_TIMEOUT', '1')) # seconds to wait for a free connection
+REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', '5'))
+REDIS_CONNECT_TIMEOUT = float(os.getenv('REDIS_CONNECT_TIMEOUT', '2'))
+REDIS_SOCKET_KEEPALIVE = os.getenv('REDIS_SOCKET_KEEPALIVE', 'true').lower() in ('1', 'true', 'yes')
+REDIS_HEALTH_CHECK_INTERVAL = float(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', '30')) # 0 to disable
+REDIS_TRACE_ENABLED = os.getenv('REDIS_TRACE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+REDIS_ROUND_TRIPS_BUDGET = int(os.getenv('REDIS_ROUND_TRIPS_BUDGET', '10')) # per request, 0 to disable the warning
+REDIS_READ_COMMANDS = frozenset(["get", "mget", "exists", "hget", "hmget", "hgetall", "hexists", "hkeys", "hlen", "smembers",
+                                 "sismember", "scard", "sscan", "zscore", "zcard", "zrangebylex", "lrange"])
+METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5')) # seconds between two flushes to Redis
+METRICS_BUCKETS = [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10] # seconds
+METRICS_KEY = "metrics"
+METRICS_HELP = {
+    "portfoliomgmt_http_requests_total" : ("counter", "Requests by route, method and status code."),
+    "portfoliomgmt_http_request_duration_seconds" : ("histogram", "Duration of the requests by route and method."),
+    "portfoliomgmt_function_duration_seconds" : ("histogram", "Duration of the calls of instrumented functions."),
+    "portfoliomgmt_redis_command_duration_seconds" : ("histogram", "Duration of the Redis commands, PIPELINE for a whole pipeline.")
+    }
+EXPOSURE_EPSILON = 1e-9 # smaller exposures are float residues of closed positions
+PORTFOLIO_FORMAT_COMPACT = 1 # format tag, first byte of compact serialized data
+PORTFOLIO_HEADER = struct.Struct("<BH") # format tag, length of the user name
+PORTFOLIO_HOLDING = struct.Struct("<Id") # asset id, quantity
+
+class AuthCache(object):
+    """Bounded in-process cache of successful credential verifications.
+
+        Verifying a password with check_password_hash is deliberately slow,
+        so successful verifications are remembered for a short time. Entries
+        are keyed on the username and a HMAC of the presented password with
+        a random per-process key, so plaintext passwords are never stored.
+        Each entry also records the stored hash it was verified against and
+        is only valid as long as Redis still holds that same hash.
 
+        Attributes:
+            size (int): Maximum number of entries kept (least recently used
+                        entries are evicted first).
+            ttl (float): Number of seconds an entry stays valid.
+            hits (int): Number of verifications answered by the cache.
+            misses (int): Number of verifications not answered by the cache.
+    """
+    def __init__(self, size=AUTH_CACHE_SIZE, ttl=AUTH_CACHE_TTL):
+        """Constructor of the AuthCache class.
+
+            Args:
+                size (int): Maximum number of entries kept.
+                ttl (float): Number of seconds an entry stays valid.
+        """
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.secret = os.urandom(32)
+
+    def key(self, username, password, admin=False):
+        """Returns the cache key of a username and password couple.
+
+            Args:
+                username (str): Name of the user or administrator.
+                password (str): Plaintext password presented.
+                admin (bool): True if the username is an administrator.
+
+            Returns:
+                key (tuple): admin flag, username and keyed password digest.
+        """
+        if isinstance(password, unicode):
+            password = password.encode("utf-8")
+        digest = hmac.new(self.secret, password, hashlib.sha256).hexdigest()
+        return (admin, username, digest)
+
+    def lookup(self, username, password, hash_password_stored, admin=False):
+        """Checks if the credentials were recently verified successfully.
+
+            Args:
+                username (str): Name of the user or administrator.
+                password (str): Plaintext password presented.
+                hash_password_stored (str): Hash currently stored in Redis.
+                admin (bool): True if the username is an administrator.
+
+            Returns:
+                True or False: True if the cache vouches for the credentials.
+        """
+        key = self.key(username, password, admin)
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] == hash_password_stored and entry[1] > time.time():
+                self.entries[key] = entry # most recently used goes last
+                self.hits += 1
+                return True
+            self.misses += 1
+            return False
+
+    def store(self, username, password, hash_password_stored, admin=False):
+        """Remembers a successful verification of the credentials.
+
+            Args:
+                username (str): Name of the user or administrator.
+                password (str): Plaintext password presented.
+                hash_password_stored (str): Hash the password was verified
+                                            against.
+                admin (bool): True if the username is an administrator.
+        """
+        if self.size <= 0:
+            return
+        key = self.key(username, password, admin)
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (hash_password_stored, time.time() + self.ttl)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, username, admin=False):
+        """Forgets every verification of a user.
+
+            Args:
+                username (str): Name of the user or administrator.
+                admin (bool): True if the username is an administrator.
+        """
+        with self.lock:
+            for key in [k for k in self.entries if k[0] == admin and k[1] == username]:
+                del self.entries[key]
+
+    def stats(self):
+        """Returns the counters of the cache.
+
+            Returns:
+                stats (dict): Size, capacity, hits, misses and hit ratio.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size" : len(self.entries),
+                "capacity" : self.size,
+                "ttl" : self.ttl,
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "hitRatio" : float(self.hits) / lookups if lookups else 0.0
+                }
+
+auth_cache = AuthCache()
+
+class ResponseCache(object):
+    """Bounded in-process cache of response bodies, valid for one generation.
+
+        Each body is stored with the generation of the data it was
+        computed from, a value read from Redis which changes whenever the
+        data changes, and is only served while Redis still holds that same
+        generation, so that all the processes see the writes of the others
+        right away. Entries also expire after ttl seconds and the least
+        recently used ones are evicted beyond size entries.
+    """
+    def __init__(self, size=PORTFOLIOS_CACHE_SIZE, ttl=PORTFOLIOS_CACHE_TTL):
+        """Constructor of the ResponseCache class.
+
+            Args:
+                size (int): Maximum number of entries kept.
+                ttl (float): Number of seconds an entry stays valid.
+        """
+        self.size = size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, generation):
+        """Returns the body cached for a key and a generation.
+
+            Args:
+                key (tuple): Request parameters the body depends on.
+                generation (tuple): Current generation of the data.
+
+            Returns:
+                body (str, None): Body cached, or None if there is none.
+        """
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] == generation and entry[1] > time.time():
+                self.entries[key] = entry # most recently used goes last
+                self.hits += 1
+                return entry[2]
+            self.misses += 1
+            return None
+
+    def put(self, key, generation, body):
+        """Caches the body computed for a key and a generation.
+
+            The generation must have been read before the data the body
+            was computed from, so that a concurrent write changes it.
+
+            Args:
+                key (tuple): Request parameters the body depends on.
+                generation (tuple): Generation read before computing it.
+                body (str): Body of the response.
+        """
+        if self.size <= 0:
+            return
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = (generation, time.time() + self.ttl, body)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def stats(self):
+        """Returns the counters of the cache.
+
+            Returns:
+                stats (dict): Size, capacity, hits, misses and hit ratio.
+        """
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                "size" : len(self.entries),
+                "capacity" : self.size,
+                "ttl" : self.ttl,
+                "hits" : self.hits,
+                "misses" : self.misses,
+                "hitRatio" : float(self.hits) / lookups if lookups else 0.0
+                }
+
+portfolios_cache = ResponseCache()
+
+class Metrics(object):
+    """Prometheus metrics of the service, summed over all its processes.
+
+        Each process counts the requests and observes the durations in
+        memory, and adds what it counted since the last flush to the
+        METRICS_KEY hash of Redis every flush_interval seconds, from a
+        background thread, with one pipelined round trip. The fields of
+        the hash are the series of the Prometheus text format, so the
+        workers of every host add up and any process can render all of
+        them. The Redis commands of the flush itself are not observed.
+
+        Attributes:
+            enabled (bool): Whether to count and observe.
+            buckets (list[float]): Upper bounds of the histogram buckets,
+                                   in seconds.
+            flush_interval (float): Seconds between two flushes.
+            counters (dict): Increment by (metric, labels) since the last
+                             flush.
+            histograms (dict): Count by bucket, count above the last
+                               bucket and sum by (metric, labels) since
+                               the last flush.
+    """
+    def __init__(self, enabled=METRICS_ENABLED, buckets=METRICS_BUCKETS, flush_interval=METRICS_FLUSH_INTERVAL):
+        """Constructor of the Metrics class.
+
+            Args:
+                enabled (bool): Whether to count and observe.
+                buckets (list[float]): Upper bounds of the buckets.
+                flush_interval (float): Seconds between two flushes.
+        """
+        self.enabled = enabled
+        self.buckets = sorted(buckets)
+        self.flush_interval = flush_interval
+        self.counters = dict()
+        self.histograms = dict()
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.flusher = None
+
+    def inc(self, metric, labels, value=1):
+        """Increments a counter.
+
+            Args:
+                metric (str): Name of the counter.
+                labels (tuple): (name, value) pairs of the labels.
+                value (int): Increment.
+        """
+        if not self.enabled:
+            return
+        key = (metric, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, metric, labels, seconds):
+        """Adds a duration to a histogram.
+
+            Args:
+                metric (str): Name of the histogram.
+                labels (tuple): (name, value) pairs of the labels.
+                seconds (float): Duration observed.
+        """
+        if not self.enabled or getattr(self.local, "muted", False):
+            return
+        key = (metric, labels)
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            histogram[bisect.bisect_left(self.buckets, seconds)] += 1
+            histogram[-1] += seconds
+
+    @staticmethod
+    def series(metric, labels):
+        """Formats a series of the Prometheus text format.
+
+            Args:
+                metric (str): Name of the metric.
+                labels (tuple): (name, value) pairs of the labels.
+
+            Returns:
+                series (str): The metric name and its labels.
+        """
+        if not labels:
+            return metric
+        escape = lambda value: str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        return metric + "{" + ",".join('{0}="{1}"'.format(name, escape(value)) for name, value in labels) + "}"
+
+    def flush(self):
+        """Adds the counts since the last flush to the METRICS_KEY hash.
+
+            They are kept in memory for the next flush if Redis is not
+            available.
+        """
+        with self.lock:
+            counters, self.counters = self.counters, dict()
+            histograms, self.histograms = self.histograms, dict()
+        if not counters and not histograms:
+            return
+        pipe = redis_server.pipeline(transaction=False)
+        for (metric, labels), value in counters.iteritems():
+            pipe.hincrby(METRICS_KEY, Metrics.series(metric, labels), value)
+        for (metric, labels), histogram in histograms.iteritems():
+            count = 0
+            for bound, bucket_count in zip(self.buckets + ["+Inf"], histogram):
+                count += bucket_count
+                if count:
+                    pipe.hincrby(METRICS_KEY, Metrics.series(metric+"_bucket", labels + (("le", bound),)), count)
+            pipe.hincrby(METRICS_KEY, Metrics.series(metric+"_count", labels), count)
+            pipe.hincrbyfloat(METRICS_KEY, Metrics.series(metric+"_sum", labels), histogram[-1])
+        self.local.muted = True
+        try:
+            pipe.execute()
+        except (ConnectionError, TimeoutError):
+            with self.lock:
+                for key, value in counters.iteritems():
+                    self.counters[key] = self.counters.get(key, 0) + value
+                for key, histogram in histograms.iteritems():
+                    current = self.histograms.setdefault(key, [0] * len(histogram[:-1]) + [0.0])
+                    self.histograms[key] = [a + b for a, b in zip(current, histogram)]
+        finally:
+            self.local.muted = False
+
+    def start(self):
+        """Starts flushing in a background thread.
+
+            The counts inherited from a parent process, which flushes
+            them itself, are dropped.
+        """
+        with self.lock:
+            self.counters = dict()
+            self.histograms = dict()
+        if not self.enabled or (self.flusher is not None and self.flusher.is_alive()):
+            return
+        def run():
+            while True:
+                time.sleep(self.flush_interval)
+                self.flush()
+        self.flusher = threading.Thread(target=run, name="metrics")
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def render(self):
+        """Returns the metrics of all the processes in the Prometheus format.
+
+            The counts of this process are flushed first.
+
+            Returns:
+                text (str): Metrics in the Prometheus text format 0.0.4.
+        """
+        self.flush()
+        families = dict()
+        for series, value in redis_server.hgetall(METRICS_KEY).iteritems():
+            name, sep, labels = series.partition("{")
+            for suffix in ["_bucket", "_count", "_sum"]:
+                if name.endswith(suffix) and name[:-len(suffix)] in METRICS_HELP:
+                    name = name[:-len(suffix)]
+            base, sep, bound = labels.partition('le="')
+            order = float(bound.rstrip('"}')) if bound else 0.0
+            families.setdefault(name, []).append(((series.partition("{")[0], base, order), series, value))
+        lines = []
+        for name in sorted(families):
+            kind, description = METRICS_HELP.get(name, ("untyped", ""))
+            lines.append("# HELP {0} {1}".format(name, description))
+            lines.append("# TYPE {0} {1}".format(name, kind))
+            for order, series, value in sorted(families[name]):
+                lines.append("{0} {1}".format(series, value))
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+
+def timed(function):
+    """Decorator observing the duration of each call of a function.
+
+        The durations go to the portfoliomgmt_function_duration_seconds
+        histogram, labelled with the name of the function.
+
+        Args:
+            function (str): Name of the function for the label.
+    """
+    labels = (("function", function),)
+    def decorator(f):
+        @wraps(f)
+        def decorated(*args, **kwargs):
+            start = time.time()
+            try:
+                return f(*args, **kwargs)
+            finally:
+                metrics.observe("portfoliomgmt_function_duration_seconds", labels, time.time() - start)
+        return decorated
+    return decorator
+
+@timed("check_auth")
 def check_auth(username, password, admin=False):
     """Checks the credentials provided against the ones stored in Redis.
 
         It searches for the username key in the Redis database, and then
         compares the hash of the password with the hash of the password 
         stored in the Redis database. If it matches, it returns True.
+        Successful verifications are kept in the auth_cache so that the
+        expensive hash comparison is skipped while the stored hash is
+        unchanged.
 
         Args:
             username (string): Name of the username of administrator.
@@ -53,7 +537,12 @@ def check_auth(username, password, admin=False):
         hash_password_stored = redis_server.hget("password_"+username, "hash_password")
     if not hash_password_stored:
         return False
-    return check_password_hash(hash_password_stored, password)
+    if auth_cache.lookup(username, password, hash_password_stored, admin):
+        return True
+    if not check_password_hash(hash_password_stored, password):
+        return False
+    auth_cache.store(username, password, hash_password_stored, admin)
+    return True
 
 def requires_auth(f):
     """Prompts the user for the his/her username and password credentials.
@@ -112,6 +601,80 @@ def requires_auth_admin(f):
         return f(*args, **kwargs)
     return decorated
 
+def requires_auth_any(f):
+    """Prompts for the username and password of any user or admin.
+
+        It is used by the resources which are not owned by a user, such
+        as the asset catalog. The credentials are checked against the
+        user passwords first and against the admin passwords after.
+
+        Args:
+            f (function): Function that requires an authenticated user.
+
+        Returns:
+            f(*args, **kwargs): The function with its original arguments,
+                                if authorized.
+            Response: Error response with status code 401 if not authorized.
+    """
+    @wraps(f)
+    def decorated(*args, **kwargs):
+        auth = request.authorization
+        if SECURED:
+            if not auth or not (check_auth(auth.username, auth.password) or
+                                check_auth(auth.username, auth.password, admin=True)):
+                return Response(
+                                'Could not verify your access level for that URL.\n'
+                                'You have to login with proper credentials',
+                                HTTP_401_UNAUTHORIZED,
+                                {'WWW-Authenticate': 'Basic realm="Login Required"'})
+        return f(*args, **kwargs)
+    return decorated
+
+def conditional(f):
+    """Answers the conditional GETs of a portfolio resource.
+
+        The ETag of the resources of a portfolio is the version field of
+        its user_* hash, which the scripts set to a new value of the
+        portfolio_version counter whenever a holding or the price of a
+        held asset changes. The holdings of a portfolio still in the
+        legacy data blob are not versioned, so its ETag is a hash of the
+        blob and of the asset catalog version, which changes with the
+        prices. If the If-None-Match header of the request holds the ETag,
+        the function is not called and 304 Not Modified is answered after
+        one round trip. The ETag is read before the function reads the
+        portfolio, so a concurrent change can only make the ETag older
+        than the response, never newer.
+
+        Args:
+            f (function): Function returning a portfolio resource.
+
+        Returns:
+            f(*args, **kwargs): The response of the function, with its
+                                ETag if successful.
+            Response: Empty response with status code 304 if not modified.
+    """
+    @wraps(f)
+    def decorated(user, *args, **kwargs):
+        pipe = redis_server.pipeline(transaction=False)
+        pipe.hmget("user_"+user, ["name", "version", "data"])
+        pipe.get(ASSET_CATALOG_VERSION)
+        (username, version, data), catalog_version = pipe.execute()
+        if not username: # the function answers 404
+            return f(user, *args, **kwargs)
+        if data:
+            version = "legacy-" + hashlib.sha1(data + ";" + str(catalog_version or 0)).hexdigest()
+        else:
+            version = str(version or 0)
+        if request.if_none_match.contains(version):
+            response = Response(status=HTTP_304_NOT_MODIFIED)
+            response.set_etag(version)
+            return response
+        response = f(user, *args, **kwargs)
+        if response.status_code == HTTP_200_OK:
+            response.set_etag(version)
+        return response
+    return decorated
+
 class NegativeAssetException(Exception):
     """Asset has a negative quantity exception
 
@@ -124,12 +687,560 @@ class AssetNotFoundException(Exception):
     """
     pass
 
+class InvalidQuantityException(Exception):
+    """Quantity or value of an asset not a finite number exception
+
+    """
+    pass
+
 class RedisConnectionException(Exception):
     """Redis service connection exception.
 
     """
     pass
 
+class RedisPoolExhaustedException(ConnectionError):
+    """No Redis connection available within the pool timeout exception.
+
+    """
+    pass
+
+class RedisPool(BlockingConnectionPool):
+    """Pool of Redis connections with health checks and statistics.
+
+        At most max_connections connections are opened. When they are all
+        in use, a request for a connection waits at most timeout seconds
+        if blocking, and fails right away otherwise, raising a
+        RedisPoolExhaustedException. A connection idle for more than
+        health_check_interval seconds is checked with a PING before being
+        handed out, and reconnected if Redis does not answer. The duration
+        of each command is observed in the metrics.
+
+        Attributes:
+            blocking (bool): Whether to wait for a free connection.
+            health_check_interval (float): Idle seconds before a health
+                                           check, 0 to disable them.
+            waits (int): Number of requests which waited for a connection.
+            timeouts (int): Number of requests which got no connection.
+            health_checks (int): Number of health checks done.
+            reconnects (int): Number of health checks which failed.
+    """
+    def __init__(self, max_connections=REDIS_POOL_SIZE, timeout=REDIS_POOL_TIMEOUT, blocking=REDIS_POOL_BLOCKING,
+                 health_check_interval=REDIS_HEALTH_CHECK_INTERVAL, socket_timeout=REDIS_SOCKET_TIMEOUT,
+                 socket_connect_timeout=REDIS_CONNECT_TIMEOUT, socket_keepalive=REDIS_SOCKET_KEEPALIVE, **connection_kwargs):
+        """Constructor of the RedisPool class.
+
+            Args:
+                max_connections (int): Maximum number of connections.
+                timeout (float): Seconds to wait for a free connection.
+                blocking (bool): Whether to wait for a free connection.
+                health_check_interval (float): Idle seconds before a health
+                                               check, 0 to disable them.
+                socket_timeout (float): Seconds to wait for Redis answers.
+                socket_connect_timeout (float): Seconds to wait to connect.
+                socket_keepalive (bool): Whether to enable TCP keepalive.
+                connection_kwargs: host, port, password... of Redis.
+        """
+        self.blocking = blocking
+        self.health_check_interval = health_check_interval
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.timeouts = 0
+        self.health_checks = 0
+        self.reconnects = 0
+        self.lock = threading.Lock()
+        BlockingConnectionPool.__init__(self, max_connections, timeout, socket_timeout=socket_timeout,
+                                        socket_connect_timeout=socket_connect_timeout,
+                                        socket_keepalive=socket_keepalive, **connection_kwargs)
+
+    def get_connection(self, command_name, *keys, **options):
+        """Returns a connection of the pool, opening it if needed.
+
+            Raises:
+                RedisPoolExhaustedException: If all the connections are
+                                             still in use after the timeout
+                                             (right away if not blocking).
+        """
+        self._checkpid()
+        try:
+            connection = self.pool.get_nowait()
+        except Empty:
+            connection = self.wait_connection()
+        if connection is None:
+            connection = self.make_connection()
+        elif self.health_check_interval > 0 and time.time() - connection.released_at > self.health_check_interval:
+            self.check_health(connection)
+        connection.command_name = command_name
+        connection.acquired_at = time.time()
+        return connection
+
+    def wait_connection(self):
+        """Waits for a connection to be released, if blocking.
+
+            Returns:
+                connection (Connection, None): Connection released, or None
+                                               if a new one can be opened.
+
+            Raises:
+                RedisPoolExhaustedException: If no connection is released
+                                             before the timeout.
+        """
+        start = time.time()
+        try:
+            if not self.blocking:
+                raise Empty()
+            return self.pool.get(block=True, timeout=self.timeout)
+        except Empty:
+            with self.lock:
+                self.timeouts += 1
+            raise RedisPoolExhaustedException("No Redis connection available (pool of {0})".format(self.max_connections))
+        finally:
+            with self.lock:
+                self.waits += int(self.blocking)
+                self.wait_seconds += time.time() - start
+
+    def check_health(self, connection):
+        """Sends a PING on an idle connection and disconnects it on failure.
+
+            The connection is opened again by its next command.
+
+            Args:
+                connection (Connection): Connection taken from the pool.
+        """
+        with self.lock:
+            self.health_checks += 1
+        try:
+            connection.send_command("PING")
+            if connection.read_response() != "PONG":
+                raise ConnectionError("Unexpected answer to PING")
+        except (ConnectionError, TimeoutError):
+            connection.disconnect()
+            with self.lock:
+                self.reconnects += 1
+
+    def release(self, connection):
+        """Puts a connection back in the pool.
+
+            The time since the connection was handed out, for one command
+            or a whole pipeline, is observed in the metrics.
+
+            Args:
+                connection (Connection): Connection taken from the pool.
+        """
+        connection.released_at = time.time()
+        command_name = getattr(connection, "command_name", "pubsub")
+        if command_name != "pubsub": # held by a subscriber until it stops
+            metrics.observe("portfoliomgmt_redis_command_duration_seconds", (("command", "PIPELINE" if command_name == "MULTI" else command_name),),
+                            connection.released_at - connection.acquired_at)
+        BlockingConnectionPool.release(self, connection)
+
+    def stats(self):
+        """Returns the counters of the pool.
+
+            Returns:
+                stats (dict): Size, connections opened, in use and idle,
+                              waits, timeouts and health checks.
+        """
+        idle = len([connection for connection in list(self.pool.queue) if connection is not None])
+        with self.lock:
+            return {
+                "size" : self.max_connections,
+                "blocking" : self.blocking,
+                "opened" : len(self._connections),
+                "inUse" : len(self._connections) - idle,
+                "idle" : idle,
+                "waits" : self.waits,
+                "waitSeconds" : self.wait_seconds,
+                "timeouts" : self.timeouts,
+                "healthChecks" : self.health_checks,
+                "reconnects" : self.reconnects
+                }
+
+class RedisTrace(object):
+    """Redis commands sent by one request.
+
+        Attributes:
+            round_trips (int): Round trips to Redis.
+            commands (int): Commands sent, several per pipeline.
+            seconds (float): Time spent waiting for Redis.
+            trips (dict): Round trips by command name, PIPELINE for the
+                          pipelines.
+            reads (dict): Times each read command was sent, by name and
+                          arguments.
+    """
+    def __init__(self):
+        """Constructor of the RedisTrace class.
+
+        """
+        self.round_trips = 0
+        self.commands = 0
+        self.seconds = 0.0
+        self.trips = dict()
+        self.reads = dict()
+
+    def record(self, commands, seconds):
+        """Records one round trip.
+
+            Args:
+                commands (list[tuple]): Name and arguments of the commands
+                                        sent.
+                seconds (float): Duration of the round trip.
+        """
+        self.round_trips += 1
+        self.commands += len(commands)
+        self.seconds += seconds
+        name = commands[0][0].upper() if len(commands) == 1 else "PIPELINE"
+        self.trips[name] = self.trips.get(name, 0) + 1
+        for name, args in commands:
+            if name in REDIS_READ_COMMANDS:
+                read = (name, args)
+                try:
+                    self.reads[read] = self.reads.get(read, 0) + 1
+                except TypeError: # list arguments, of MGET or HMGET
+                    read = (name, repr(args))
+                    self.reads[read] = self.reads.get(read, 0) + 1
+
+    def repeated_reads(self):
+        """Returns the read commands sent more than once.
+
+            Returns:
+                reads (list[tuple]): Count, name and arguments of each
+                                     read, the most repeated first.
+        """
+        return sorted([(count, name.upper(), args) for (name, args), count in self.reads.items() if count > 1], reverse=True)
+
+def current_redis_trace():
+    """Returns the RedisTrace of the current request.
+
+        Returns:
+            trace (RedisTrace, None): None outside of a request or when
+                                      redis_server is not traced.
+    """
+    context = _app_ctx_stack.top # what g proxies, without the lookups of the proxy on each command
+    return getattr(context.g, "redis_trace", None) if context is not None else None
+
+class TracedRedis(object):
+    """Wrapper of a Redis client recording the commands of each request.
+
+        Each command is one round trip, and each pipeline executed is one
+        round trip for all its commands. They are recorded in the
+        RedisTrace of the current request, so the commands of the
+        background threads (metrics flush, asset catalog subscriber) are
+        not traced. A method sending several commands by itself, like
+        scan_iter, counts as one. The other attributes are the ones of
+        the client.
+
+        Attributes:
+            client (Redis): Client wrapped.
+    """
+    def __init__(self, client):
+        """Constructor of the TracedRedis class.
+
+            Args:
+                client (Redis): Client to wrap.
+        """
+        self.client = client
+
+    def __getattr__(self, name):
+        attribute = getattr(self.client, name)
+        if name == "pubsub" or not callable(attribute): # no round trip before subscribing
+            return attribute
+        def command(*args, **kwargs):
+            trace = current_redis_trace()
+            if trace is None:
+                return attribute(*args, **kwargs)
+            start = time.time()
+            try:
+                return attribute(*args, **kwargs)
+            finally:
+                trace.record([(name, args)], time.time() - start)
+        setattr(self, name, command) # __getattr__ is only called once by command
+        return command
+
+    def pipeline(self, transaction=True):
+        """Returns a traced pipeline of the client.
+
+            Args:
+                transaction (bool): Whether to wrap the commands in
+                                    MULTI/EXEC.
+
+            Returns:
+                pipeline (TracedPipeline): The pipeline.
+        """
+        return TracedPipeline(self.client.pipeline(transaction))
+
+class TracedPipeline(object):
+    """Wrapper of a Redis pipeline recording its commands when executed.
+
+        Attributes:
+            pipeline (Pipeline): Pipeline wrapped.
+            commands (list[tuple]): Name and arguments of the commands
+                                    queued.
+    """
+    def __init__(self, pipeline):
+        """Constructor of the TracedPipeline class.
+
+            Args:
+                pipeline (Pipeline): Pipeline to wrap.
+        """
+        self.pipeline = pipeline
+        self.commands = []
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __getattr__(self, name):
+        method = getattr(self.pipeline, name)
+        def queue(*args, **kwargs):
+            self.commands.append((name, args))
+            result = method(*args, **kwargs)
+            return self if result is self.pipeline else result
+        setattr(self, name, queue)
+        return queue
+
+    def execute(self, *args, **kwargs):
+        """Sends the commands queued in one round trip.
+
+            Returns:
+                results (list): Result of each command.
+        """
+        commands, self.commands = self.commands, []
+        trace = current_redis_trace()
+        start = time.time()
+        try:
+            return self.pipeline.execute(*args, **kwargs)
+        finally:
+            if trace is not None and commands: # nothing is sent for an empty pipeline
+                trace.record(commands, time.time() - start)
+
+class AssetCatalog(object):
+    """In-process copy of the asset_id_* hashes stored in Redis.
+
+        The whole catalog is loaded with a single pipelined pass and then
+        served from memory. Writers of asset_id_* hashes call
+        notify_asset_change, which bumps the catalog version key and
+        publishes the changed ids on the catalog channel: subscribed
+        catalogs drop these entries right away, and every catalog compares
+        the version key at most every refresh_interval seconds and reloads
+        itself if it changed.
+
+        Attributes:
+            assets (dict[int:dict]): Metadata (name, class, price) by asset id.
+            version (str): Value of the version key when last loaded.
+            refresh_interval (float): Seconds between two version checks.
+            hits (int): Number of lookups served from memory.
+            misses (int): Number of assets fetched from Redis.
+            reloads (int): Number of full loads of the catalog.
+            invalidations (int): Number of loads and invalidations, so
+                                 that the assets fetched meanwhile are
+                                 not kept.
+    """
+    def __init__(self, refresh_interval=ASSET_CATALOG_REFRESH):
+        """Constructor of the AssetCatalog class.
+
+            Args:
+                refresh_interval (float): Seconds between two version checks.
+        """
+        self.assets = dict()
+        self.version = None
+        self.loaded = False
+        self.checked_at = 0
+        self.refresh_interval = refresh_interval
+        self.hits = 0
+        self.misses = 0
+        self.reloads = 0
+        self.invalidations = 0
+        self.lock = threading.Lock()
+        self.listener = None
+
+    @staticmethod
+    def metadata(asset_hash):
+        """Converts an asset_id_* hash read from Redis into catalog metadata.
+
+            Args:
+                asset_hash (dict): Fields of the asset_id_* hash.
+
+            Returns:
+                metadata (dict): id, name, class and price of the asset or
+                                 None if the hash is empty.
+        """
+        if not asset_hash or asset_hash.get("id") is None:
+            return None
+        return {
+            "id" : int(asset_hash["id"]),
+            "name" : asset_hash["name"],
+            "class" : asset_hash["class"],
+            "price" : float(asset_hash["price"])
+            }
+
+    def load(self):
+        """Loads every asset_id_* hash from Redis in one pipelined pass.
+
+        """
+        with self.lock:
+            keys = list(redis_server.scan_iter(match="asset_id_*", count=1000))
+            pipe = redis_server.pipeline(transaction=False)
+            pipe.get(ASSET_CATALOG_VERSION)
+            for key in keys:
+                pipe.hgetall(key)
+            results = pipe.execute()
+            assets = dict()
+            for asset_hash in results[1:]:
+                metadata = AssetCatalog.metadata(asset_hash)
+                if metadata:
+                    assets[metadata["id"]] = metadata
+            self.assets = assets
+            self.invalidations += 1
+            self.version = results[0]
+            self.loaded = True
+            self.checked_at = time.time()
+            self.reloads += 1
+
+    def check_version(self):
+        """Reloads the catalog if the version key changed in Redis.
+
+            The version key is read at most every refresh_interval seconds.
+        """
+        if not self.loaded:
+            self.load()
+            return
+        now = time.time()
+        if now - self.checked_at < self.refresh_interval:
+            return
+        self.checked_at = now
+        if redis_server.get(ASSET_CATALOG_VERSION) != self.version:
+            self.load()
+
+    def get(self, asset_id):
+        """Returns the metadata of an asset.
+
+            Assets missing from memory are fetched from Redis, in case they
+            were created after the catalog was loaded. They are kept in
+            memory under the lock, unless the catalog was loaded or
+            invalidated while they were fetched.
+
+            Args:
+                asset_id (int): Unique asset id.
+
+            Returns:
+                metadata (dict): id, name, class and price of the asset or
+                                 None if the asset does not exist.
+        """
+        self.check_version()
+        metadata = self.assets.get(asset_id)
+        if metadata is not None:
+            self.hits += 1
+            return metadata
+        self.misses += 1
+        invalidations = self.invalidations
+        metadata = AssetCatalog.metadata(redis_server.hgetall("asset_id_"+str(asset_id)))
+        if metadata is not None:
+            with self.lock:
+                if self.invalidations == invalidations:
+                    self.assets[asset_id] = metadata
+        return metadata
+
+    def prefetch(self, asset_ids):
+        """Fetches the assets missing from memory in one pipelined round trip.
+
+            Args:
+                asset_ids (list[int]): Unique asset ids about to be looked up.
+        """
+        self.check_version()
+        missing = [asset_id for asset_id in set(asset_ids) if asset_id not in self.assets]
+        if not missing:
+            return
+        self.misses += len(missing)
+        invalidations = self.invalidations
+        pipe = redis_server.pipeline(transaction=False)
+        for asset_id in missing:
+            pipe.hmget("asset_id_"+str(asset_id), ASSET_FIELDS)
+        results = pipe.execute()
+        with self.lock:
+            if self.invalidations != invalidations:
+                return
+            for values in results:
+                metadata = AssetCatalog.metadata(dict(zip(ASSET_FIELDS, values)))
+                if metadata is not None:
+                    self.assets[metadata["id"]] = metadata
+
+    def invalidate(self, asset_ids=None):
+        """Drops assets from memory so that they are fetched again.
+
+            Args:
+                asset_ids (list[int], None): Asset ids to drop, or None to
+                                             drop the whole catalog.
+        """
+        with self.lock:
+            self.invalidations += 1
+            if asset_ids is None:
+                self.loaded = False
+                return
+            for asset_id in asset_ids:
+                self.assets.pop(asset_id, None)
+
+    def on_message(self, message):
+        """Handles a change message published on the catalog channel.
+
+            Args:
+                message (dict): Pub/sub message whose data is a comma
+                                separated list of asset ids or "*".
+        """
+        data = message["data"]
+        if data == "*":
+            self.invalidate()
+        else:
+            self.invalidate([int(asset_id) for asset_id in data.split(",") if asset_id])
+
+    def subscribe(self):
+        """Listens to the catalog channel in a background thread.
+
+        """
+        if self.listener is not None:
+            return
+        pubsub = redis_server.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{ASSET_CATALOG_CHANNEL: self.on_message})
+        self.listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+
+    def unsubscribe(self):
+        """Stops the background thread listening to the catalog channel.
+
+        """
+        if self.listener is None:
+            return
+        self.listener.stop()
+        self.listener.join()
+        self.listener = None
+
+    def stats(self):
+        """Returns the counters of the catalog.
+
+            Returns:
+                stats (dict): Size, hits, misses and number of reloads.
+        """
+        return {
+            "size" : len(self.assets),
+            "hits" : self.hits,
+            "misses" : self.misses,
+            "reloads" : self.reloads
+            }
+
+asset_catalog = AssetCatalog()
+
+def notify_asset_change(asset_ids=None):
+    """Signals to every AssetCatalog that asset_id_* hashes were written.
+
+        Args:
+            asset_ids (list[int], None): Ids of the assets written, or None
+                                         if any asset may have changed.
+    """
+    message = "*" if asset_ids is None else ",".join(str(asset_id) for asset_id in asset_ids)
+    pipe = redis_server.pipeline(transaction=False)
+    pipe.incr(ASSET_CATALOG_VERSION)
+    pipe.publish(ASSET_CATALOG_CHANNEL, message)
+    pipe.execute()
+    asset_catalog.invalidate(asset_ids)
+
 class Asset(object):
     """Asset class, basic unit of a Portfolio.
 
@@ -149,14 +1260,19 @@ class Asset(object):
 
             Raises:
                 Exception: The quantity argument can't be negative.
+                AssetNotFoundException: The asset does not exist in the
+                                        asset catalog.
         """
         self.id = int(ID)
         self.quantity = float(Q)
         if self.quantity <= 0:
             raise Exception("Asset object can only be created with a strictly positive a quantity Q.")
-        self.asset_class = redis_server.hget("asset_id_"+str(self.id), "class")
-        self.name = redis_server.hget("asset_id_"+str(self.id), "name")
-        self.price = float(redis_server.hget("asset_id_"+str(self.id), "price"))
+        metadata = asset_catalog.get(self.id)
+        if metadata is None:
+            raise AssetNotFoundException()
+        self.asset_class = metadata["class"]
+        self.name = metadata["name"]
+        self.price = metadata["price"]
 
     def buy(self, Q):
         """Buys a quantity Q of this asset.
@@ -196,36 +1312,65 @@ class Asset(object):
         return serialized_data
 
     @staticmethod
-    def deserialize(serialized_data):
-        """Deserializes the string from Redis and returns an Asset object.
+    def parse(serialized_data):
+        """Parses the string from Redis into an asset id and a quantity.
 
-            Determines the asset id and the quantity from the string.
-            Fetches the other asset parameters from Redis with the asset id.
             This is a static method.
 
             Args:
                 serialized_data (str): Two hexadecimal parts joined by ';'.
 
             Returns:
-                Asset: Complete Asset object defined by the serialized_data.
+                (ID, Q) (int, float): Asset id and quantity.
         """
         serialized_data = serialized_data.split(";")
         ID = serialized_data[0].decode("hex")
         q = serialized_data[1].decode("hex")
-        return Asset(ID, float(q))
+        return int(ID), float(q)
 
-    def __eq__(self, other):
-        """Equal method, used to tell whether two Asset are the same.
+    @staticmethod
+    def deserialize(serialized_data):
+        """Deserializes the string from Redis and returns an Asset object.
 
-            Compares each attributes of the two Asset objects and returns
-            True if these are all equal.
+            Determines the asset id and the quantity from the string.
+            Fetches the other asset parameters from the asset catalog with
+            the asset id. This is a static method.
 
             Args:
-                other (Asset): Other Asset object
+                serialized_data (str): Two hexadecimal parts joined by ';'.
 
             Returns:
-                isEqual (bool): True if the other Asset has the same
-                                values as this one.
+                Asset: Complete Asset object defined by the serialized_data.
+        """
+        ID, q = Asset.parse(serialized_data)
+        return Asset(ID, q)
+
+    @staticmethod
+    def prefetch(asset_ids):
+        """Resolves the metadata of several assets at once.
+
+            Assets missing from the asset catalog are fetched from Redis in
+            a single pipelined round trip, so that the Asset objects created
+            afterwards for these ids do not need any round trip.
+            This is a static method.
+
+            Args:
+                asset_ids (list[int]): Unique asset ids.
+        """
+        asset_catalog.prefetch(asset_ids)
+
+    def __eq__(self, other):
+        """Equal method, used to tell whether two Asset are the same.
+
+            Compares each attributes of the two Asset objects and returns
+            True if these are all equal.
+
+            Args:
+                other (Asset): Other Asset object
+
+            Returns:
+                isEqual (bool): True if the other Asset has the same
+                                values as this one.
         """
         return self.id == other.id and self.asset_class == other.asset_class and self.name == other.name and self.price == other.price and self.quantity == other.quantity
 
@@ -277,14 +1422,27 @@ class Portfolio(object):
                                         Redis database or if the asset does
                                         not exist in the portfolio and can't
                                         be created (PUT method).
+                InvalidQuantityException: if Q is not a finite number, or if
+                                          the value of the asset or the NAV
+                                          would not be.
         """
+        if math.isinf(Q) or math.isnan(Q):
+            raise InvalidQuantityException()
         if Q > 0:
-            if ID not in self.assets: # asset was not present in portfolio
+            asset = self.assets.get(ID)
+            if asset is None: # asset was not present in portfolio
                 if not can_be_created:
                     raise AssetNotFoundException()
-                self.assets[ID] = Asset(ID, Q)
+                asset = Asset(ID, Q)
+                quantity = Q
             else: # asset was present in portfolio
-                self.assets[ID].buy(Q)
+                quantity = asset.quantity + Q
+            if math.isinf(quantity * asset.price) or math.isinf(self.nav + asset.price * Q):
+                raise InvalidQuantityException()
+            if ID in self.assets:
+                asset.buy(Q)
+            else:
+                self.assets[ID] = asset
             self.nav += self.assets[ID].price * Q
         elif Q < 0:
             if ID not in self.assets: # asset was not present in portfolio
@@ -305,40 +1463,107 @@ class Portfolio(object):
             self.nav -= self.assets[ID].price * self.assets[ID].quantity
             del self.assets[ID]
 
-    def json_serialize(self, url_root):
+    def json_serialize(self, url_root, holdings=False):
         """Prepares the portfolio object to be serialized in JSON.
 
             Args:
                 url_root (str): root of the url
+                holdings (bool): If true, the details of every asset of the
+                                 portfolio are included.
 
             Returns:
                 data (dict): A dictionary illustrating the portfolio for
                              jsonify to produce.
         """
-        return {
+        data = {
             "user" : self.user,
             "numberOfAssets" : len(self.assets),
             "netAssetValue" : self.nav,
             "links" : [{"rel" : "self", "href" : url_root[:-1] + url_version + "/portfolios/" + self.user}]
             }
+        if holdings:
+            data["assets"] = [{"id" : a_id, "name" : a.name, "class" : a.asset_class, "quantity" : a.quantity, "price" : a.price} for a_id, a in sorted(self.assets.iteritems())]
+        return data
 
+    @timed("Portfolio.serialize")
     def serialize(self):
         """Serializes this Portfolio object into a string to be stored
            into Redis.
 
-            Uses the username and the serialized Assets to generate a
-            string for Redis.
+            Uses the username and the asset ids and quantities to generate
+            a compact binary string for Redis (see Portfolio.encode).
 
             Returns:
-                serialized_data (str): Two hexadecimal parts joined by ';'.
+                serialized_data (str): Compact binary serialized data.
         """
-        user_hex = self.user.encode("hex")
-        assets = "#".join([a.serialize(a_id) for a_id, a in self.assets.iteritems()])
-        assets_hex = assets.encode("hex")
-        serialized_data = user_hex + ";" + assets_hex
-        return serialized_data
+        return Portfolio.encode(self.user, [(a_id, a.quantity) for a_id, a in self.assets.iteritems()])
+
+    @staticmethod
+    def encode(user, holdings):
+        """Encodes a username and holdings in the compact binary format.
+
+            The compact format starts with the PORTFOLIO_FORMAT_COMPACT tag
+            and the length of the username, followed by the username and a
+            fixed width (asset id, quantity) record per holding, sorted by
+            asset id. This is a static method.
+
+            Args:
+                user (str): Name of the owner of the portfolio.
+                holdings (list[(int, float)]): Asset ids and quantities.
+
+            Returns:
+                serialized_data (str): Compact binary serialized data.
+        """
+        records = [PORTFOLIO_HOLDING.pack(ID, q) for ID, q in sorted(holdings)]
+        return PORTFOLIO_HEADER.pack(PORTFOLIO_FORMAT_COMPACT, len(user)) + user + "".join(records)
+
+    @staticmethod
+    def decode(serialized_data):
+        """Decodes the string from Redis into a username and holdings.
+
+            Both the compact binary format and the legacy format (two
+            hexadecimal parts joined by ';') are accepted, so that data
+            written before the compact format still reads correctly.
+            This is a static method.
+
+            Args:
+                serialized_data (str): Compact or legacy serialized data.
+
+            Returns:
+                (user, holdings) (str, list[(int, float)]): Name of the
+                    owner of the portfolio, asset ids and quantities.
+        """
+        if Portfolio.is_compact(serialized_data):
+            _, length = PORTFOLIO_HEADER.unpack_from(serialized_data)
+            start = PORTFOLIO_HEADER.size + length
+            user = serialized_data[PORTFOLIO_HEADER.size:start]
+            holdings = [PORTFOLIO_HOLDING.unpack_from(serialized_data, offset) for offset in range(start, len(serialized_data), PORTFOLIO_HOLDING.size)]
+            return user, holdings
+        serialized_data = serialized_data.split(";")
+        user = serialized_data[0].decode("hex")
+        holdings = []
+        if serialized_data[1]:
+            assets_str = serialized_data[1].decode("hex").split("#")
+            holdings = [Asset.parse(asset_str) for asset_str in assets_str]
+        return user, holdings
+
+    @staticmethod
+    def is_compact(serialized_data):
+        """Tells whether serialized data uses the compact binary format.
+
+            Legacy data only contains hexadecimal digits and separators,
+            so it never starts with the format tag. This is a static method.
+
+            Args:
+                serialized_data (str): Compact or legacy serialized data.
+
+            Returns:
+                isCompact (bool): True if it is in the compact format.
+        """
+        return serialized_data[:1] == chr(PORTFOLIO_FORMAT_COMPACT)
 
     @staticmethod
+    @timed("Portfolio.deserialize")
     def deserialize(serialized_data):
         """Deserializes the string from Redis and returns a Portfolio object.
 
@@ -346,20 +1571,33 @@ class Portfolio(object):
             assets data retrieved from Redis. This is a static method.
 
             Args:
-                serialized_data (str): Two hexadecimal parts joined by ';'.
+                serialized_data (str): Compact or legacy serialized data.
 
             Returns:
                 Portfolio: Complete Portfolio object defined by the
                            serialized_data.
         """
-        serialized_data = serialized_data.split(";")
-        user = serialized_data[0].decode("hex")
+        user, holdings = Portfolio.decode(serialized_data)
+        return Portfolio.from_holdings(user, holdings)
+
+    @staticmethod
+    def from_holdings(user, holdings):
+        """Creates a Portfolio object from asset ids and quantities.
+
+            The metadata of all the assets is resolved in one batch before
+            the Asset objects are created. This is a static method.
+
+            Args:
+                user (str): Name of the owner of the portfolio.
+                holdings (list[(int, float)]): Asset ids and quantities.
+
+            Returns:
+                Portfolio: Complete Portfolio object with its NAV.
+        """
         p = Portfolio(user)
-        assets_lst = []
-        if serialized_data[1]:
-            assets_str = serialized_data[1].decode("hex").split("#")
-            assets_lst = [Asset.deserialize(asset_str) for asset_str in assets_str]
-        for asset in assets_lst:
+        Asset.prefetch([int(ID) for ID, q in holdings])
+        for ID, q in holdings:
+            asset = Asset(ID, q)
             p.assets[asset.id] = asset
             p.nav += float(asset.quantity) * float(asset.price)
         return p
@@ -399,6 +1637,161 @@ class Portfolio(object):
         p.nav = self.nav
         return p
 
+class ValuationEngine(object):
+    """Values every portfolio of the book at once.
+
+        The holdings of all the portfolios are loaded into a sparse users x
+        assets matrix of quantities, stored as the row, column and quantity
+        of each holding, and the prices into a vector indexed like the
+        columns. Every NAV is then the sum of its row of quantity * price,
+        computed in one vectorized pass with NumPy, or in pure Python if
+        NumPy is not installed. The holdings are a snapshot, loaded again
+        once older than max_age seconds, while the prices are read from the
+        asset_id_* hashes at each valuation, as the asset catalog may be
+        stale.
+
+        Attributes:
+            users (list[str]): Name of the user of each row.
+            asset_ids (list[int]): Asset id of each column.
+            rows (array[int]): Row of each holding.
+            columns (array[int]): Column of each holding.
+            quantities (array[float]): Quantity of each holding.
+            loaded_at (float): Time of the last load, or None.
+            load_seconds (float): Duration of the last load.
+            max_age (float): Seconds after which the holdings are reloaded.
+    """
+    def __init__(self, max_age=VALUATION_MAX_AGE):
+        """Constructor of the ValuationEngine class.
+
+            Args:
+                max_age (float): Seconds after which the holdings are
+                                 reloaded.
+        """
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.build([], [])
+        self.loaded_at = None
+        self.load_seconds = 0.0
+
+    def build(self, users, holdings):
+        """Builds the quantity matrix from holdings.
+
+            Args:
+                users (list[str]): Names of all the users, including those
+                                   without holdings.
+                holdings (list[(str, int, float)]): User, asset id and
+                                                    quantity of each holding.
+        """
+        user_rows = dict((user, row) for row, user in enumerate(users))
+        asset_columns = dict()
+        rows, columns, quantities = [], [], []
+        for user, asset_id, quantity in holdings:
+            rows.append(user_rows[user])
+            columns.append(asset_columns.setdefault(asset_id, len(asset_columns)))
+            quantities.append(quantity)
+        asset_ids = [None] * len(asset_columns)
+        for asset_id, column in asset_columns.iteritems():
+            asset_ids[column] = asset_id
+        if numpy is not None:
+            rows = numpy.array(rows, dtype=numpy.int64)
+            columns = numpy.array(columns, dtype=numpy.int64)
+            quantities = numpy.array(quantities, dtype=numpy.float64)
+        self.users, self.asset_ids = list(users), asset_ids
+        self.rows, self.columns, self.quantities = rows, columns, quantities
+
+    def load(self, batch_size=EXPORT_BATCH_SIZE):
+        """Loads the holdings of every user from Redis.
+
+            Users are read in batches of batch_size with SSCAN and one
+            pipelined round trip per batch. SSCAN may return a user twice
+            while the set is rehashed, so only the first time is kept.
+
+            Args:
+                batch_size (int): Number of users per batch.
+        """
+        start = time.time()
+        users, holdings = [], []
+        seen = set()
+        cursor = 0
+        while True:
+            cursor, batch = redis_server.sscan('list_users', cursor, count=batch_size)
+            batch = [user for user in OrderedDict.fromkeys(batch) if user not in seen]
+            seen.update(batch)
+            pipe = redis_server.pipeline(transaction=False)
+            for user in batch:
+                pipe.hget("user_"+user, "data")
+                pipe.hgetall("holdings_"+user)
+            results = pipe.execute()
+            for user, data, held in zip(batch, results[::2], results[1::2]):
+                users.append(user)
+                if data: # legacy layout, not migrated yet
+                    holdings += [(user, ID, q) for ID, q in Portfolio.decode(data)[1]]
+                else:
+                    holdings += [(user, int(ID), float(q)) for ID, q in held.iteritems()]
+            if int(cursor) == 0:
+                break
+        self.build(sorted(users), holdings)
+        self.loaded_at = time.time()
+        self.load_seconds = self.loaded_at - start
+
+    def prices(self):
+        """Returns the vector of prices, indexed like the columns.
+
+            The prices are read from Redis in one pipelined round trip.
+
+            Returns:
+                prices (array[float]): Price of each asset, 0 if it does
+                                       not exist anymore.
+        """
+        prices = fetch_asset_prices(self.asset_ids)
+        prices = [prices.get(asset_id, 0.0) for asset_id in self.asset_ids]
+        if numpy is not None:
+            return numpy.array(prices, dtype=numpy.float64)
+        return prices
+
+    def value(self, reload=False):
+        """Computes the NAV of every portfolio.
+
+            Args:
+                reload (bool): Whether to reload the holdings even if they
+                               are not older than max_age.
+
+            Returns:
+                (users, navs) (list[str], list[float]): Names of the users
+                    and their NAV, in the same order.
+        """
+        with self.lock:
+            if reload or self.loaded_at is None or time.time() - self.loaded_at > self.max_age:
+                self.load()
+            users, rows, columns, quantities = self.users, self.rows, self.columns, self.quantities
+            prices = self.prices()
+        if numpy is not None:
+            navs = numpy.bincount(rows, weights=quantities * prices[columns], minlength=len(users))
+            return users, navs.tolist()
+        navs = [0.0] * len(users)
+        for row, column, quantity in zip(rows, columns, quantities):
+            navs[row] += quantity * prices[column]
+        return users, navs
+
+    def stats(self):
+        """Returns the size and age of the loaded holdings.
+
+            Returns:
+                stats (dict): Numbers of portfolios, assets and holdings,
+                              duration and age of the last load, and
+                              whether NumPy is used.
+        """
+        return {
+            "portfolios" : len(self.users),
+            "assets" : len(self.asset_ids),
+            "holdings" : len(self.quantities),
+            "loadSeconds" : self.load_seconds,
+            "age" : None if self.loaded_at is None else time.time() - self.loaded_at,
+            "numpy" : numpy is not None
+            }
+
+valuation_engine = ValuationEngine()
+
 
 @app.route('/')
 def index():
@@ -426,12 +1819,15 @@ def send_specification(path):
     """Sends the Swagger JS specification from the specification folder.
 
         This is uesd by static/swagger/index.html which includes the
-        specification JS file when executed.
+        specification JS file when executed. The JS specification with
+        the host of the environment is served from memory once rendered.
 
         Returns:
             response (Response): JS content of
                                  static/swagger/specification/***.*
     """
+    if path == "portfolioMgmt.js" and swagger_specification is not None:
+        return Response(swagger_specification, mimetype='application/javascript')
     return app.send_static_file('swagger/specification/' + path)
 
 @app.route('/images/<path:path>')
@@ -480,30 +1876,268 @@ def index_api():
     """
     return reply({"name":app_name, "version":app_version, "url":"/portfolios"}, HTTP_200_OK)
 
+@app.route('/metrics')
+def get_metrics():
+    """Returns the metrics of all the processes of the service.
+
+        Initiated with a GET to /metrics, by a Prometheus server for
+        instance. The counters are summed over all the processes, each
+        one adding its counts to Redis every METRICS_FLUSH_INTERVAL
+        seconds.
+
+        Returns:
+            response (Response): Request counts and histograms of the
+                                 durations of the requests, of check_auth,
+                                 of the Portfolio serialization and of the
+                                 Redis commands, in the Prometheus text
+                                 format.
+    """
+    return Response(metrics.render(), status=HTTP_200_OK, mimetype='text/plain; version=0.0.4')
+
+@app.route(url_version+"/stats", methods=['GET'])
+@requires_auth_admin
+def get_stats():
+    """Returns the internal counters of the service.
+
+        Initiated with a GET to /api/v1/stats.
+
+        Returns:
+            response (Response): Contains the credentials cache, asset
+                                 catalog, valuation engine, portfolios
+                                 listing cache and Redis connection pool
+                                 statistics.
+    """
+    pool = getattr(redis_server, "connection_pool", None)
+    return reply({"authCache" : auth_cache.stats(), "assetCatalog" : asset_catalog.stats(), "valuation" : valuation_engine.stats(),
+                  "portfoliosCache" : portfolios_cache.stats(), "redisPool" : pool.stats() if isinstance(pool, RedisPool) else None}, HTTP_200_OK)
+
+@app.route(url_version+"/assets/prices", methods=['PUT'])
+@requires_auth_admin
+def update_prices():
+    """Updates the price of several assets and revalues their holders.
+
+        Initiated with a PUT to /api/v1/assets/prices with a body
+        {"prices": [{"asset_id": 0, "price": 1290.5}, ...]} of at most
+        PRICES_BATCH_MAX updates. All the prices are written in one
+        pipelined round trip, and only the portfolios holding these assets
+        are revalued. The prices which would make the value of a holding
+        or a NAV out of range are not set, and are reported with a 400
+        status code and the numbers of the other updates.
+
+        Returns:
+            response (Response): Number of assets updated and of portfolios
+                                 revalued OR an error message.
+    """
+    try:
+        payload = json.loads(request.data)
+    except ValueError:
+        return reply({'error' : 'Data {0} is not valid'.format(request.data)}, HTTP_400_BAD_REQUEST)
+    if not is_valid(payload, ['prices']) or not isinstance(payload['prices'], list):
+        return reply({'error' : 'Payload {0} is not valid'.format(payload)}, HTTP_400_BAD_REQUEST)
+    if len(payload['prices']) > PRICES_BATCH_MAX:
+        return reply({'error' : 'At most {0} prices can be updated at once'.format(PRICES_BATCH_MAX)}, HTTP_400_BAD_REQUEST)
+    prices = dict()
+    for update in payload['prices']:
+        try:
+            asset_id, price = int(update['asset_id']), float(update['price'])
+        except (TypeError, KeyError, ValueError):
+            return reply({'error' : 'Price update {0} is not valid'.format(update)}, HTTP_400_BAD_REQUEST)
+        if math.isinf(price) or math.isnan(price):
+            return reply({'error' : 'Price value {0} is not a finite number'.format(update['price'])}, HTTP_400_BAD_REQUEST)
+        if price < 0:
+            return reply({'error' : 'Price value must be positive'}, HTTP_400_BAD_REQUEST)
+        prices[asset_id] = price
+    pipe = redis_server.pipeline(transaction=False)
+    for asset_id in prices:
+        pipe.exists("asset_id_"+str(asset_id))
+    missing = [asset_id for asset_id, exists in zip(prices, pipe.execute()) if not exists]
+    if missing:
+        return reply({'error' : 'Asset ids {0} do not exist in database'.format(sorted(missing))}, HTTP_400_BAD_REQUEST)
+    portfolios, rejected = set_asset_prices(prices)
+    if rejected:
+        return reply({'error' : 'The prices of the assets with ids {0} were not set, as the value of a holding or a NAV would be out of range.'.format(rejected),
+                      "assets" : len(prices) - len(rejected), "portfolios" : portfolios}, HTTP_400_BAD_REQUEST)
+    return reply({"assets" : len(prices), "portfolios" : portfolios}, HTTP_200_OK)
+
+@app.route(url_version+"/assets/import", methods=['POST'])
+@requires_auth_admin
+def import_assets_file():
+    """Creates or updates many assets of the catalog at once.
+
+        Initiated with a POST to /api/v1/assets/import with a CSV body
+        (text/csv) with an id,name,class,price header, with one asset
+        {"id": 4, "name": "silver", "class": "commodity", "price": 17.1}
+        per line (application/x-ndjson) or with a body {"assets": [...]}.
+        CSV and JSON lines are streamed and written in batches of
+        ASSETS_IMPORT_BATCH_SIZE with import_assets.
+
+        Returns:
+            response (Response): Number of rows read, of assets created
+                                 and updated, and the invalid rows OR an
+                                 error message.
+    """
+    if request.mimetype == 'text/csv':
+        rows = csv.DictReader(request.stream)
+    elif request.mimetype == 'application/x-ndjson':
+        rows = parse_ndjson(request.stream)
+    else:
+        try:
+            payload = json.loads(request.data)
+        except ValueError:
+            return reply({'error' : 'Data {0} is not valid'.format(request.data)}, HTTP_400_BAD_REQUEST)
+        if not is_valid(payload, ['assets']) or not isinstance(payload['assets'], list):
+            return reply({'error' : 'Payload {0} is not valid'.format(payload)}, HTTP_400_BAD_REQUEST)
+        rows = payload['assets']
+    return reply(import_assets(rows), HTTP_200_OK)
+
+@app.route(url_version+"/valuation", methods=['GET'])
+@requires_auth_admin
+def get_valuation():
+    """Values the whole book with the valuation engine.
+
+        Initiated with a GET to /api/v1/valuation, optionally with
+        ?navs=true to include the NAV of each portfolio and ?reload=true
+        to reload the holdings even if they are recent enough.
+
+        Returns:
+            response (Response): Contains the assets under management
+                                 (sum of all the NAVs), the number of
+                                 portfolios and holdings valued and the
+                                 age of the holdings.
+    """
+    reload = request.args.get('reload', '').lower() in ('1', 'true', 'yes')
+    users, navs = valuation_engine.value(reload)
+    stats = valuation_engine.stats()
+    data = {"aum" : sum(navs), "portfolios" : len(users), "holdings" : stats["holdings"], "age" : stats["age"]}
+    if request.args.get('navs', '').lower() in ('1', 'true', 'yes'):
+        data["navs"] = dict(zip(users, navs))
+    return reply(data, HTTP_200_OK)
+
 @app.route(url_version+"/portfolios", methods=['GET'])
 @requires_auth_admin
 def list_portfolios():
     """Returns a list of all the Portfolio objects present in Redis.
 
-        Initiated with a GET to /api/v1/portfolios.
+        Initiated with a GET to /api/v1/portfolios. If the cursor or limit
+        query parameters are given (GET /api/v1/portfolios?cursor=0&limit=100),
+        only one page of portfolios is returned, found with a SSCAN of the
+        users set, together with a "next" link to the following page if
+        there is one. The limit is only a hint of the page size for Redis.
+        Responses are cached by portfolios_cache until the portfolio_version
+        counter (bumped by every change of a portfolio or of the price of a
+        held asset) or the asset catalog version changes.
 
         Returns:
-            response (Response): A list of portfolios information.
+            response (Response): A list of portfolios information OR an
+                                 error message.
     """
-    portfolios_array = []
-    for user in redis_server.smembers('list_users'):
-        username = redis_server.hget("user_"+user, "name")
-        if username:
-            data = redis_server.hget("user_"+user, "data")
-            portfolio = Portfolio(user) # in case there is no data, but portfolio still exists
-            if data:
-                portfolio = Portfolio.deserialize(data)
-            json_data = portfolio.json_serialize(request.url_root)
-            portfolios_array.append(json_data)
-    return reply({"portfolios" : portfolios_array}, HTTP_200_OK)
+    generation = tuple(redis_server.mget([PORTFOLIO_VERSION, ASSET_CATALOG_VERSION]))
+    key = (request.url_root, request.args.get('cursor'), request.args.get('limit'))
+    body = portfolios_cache.get(key, generation)
+    if body is not None:
+        return Response(body, status=HTTP_200_OK, mimetype='application/json')
+    if request.args.get('cursor') is None and request.args.get('limit') is None:
+        portfolios = load_portfolios(list(redis_server.smembers('list_users')))
+        response = reply({"portfolios" : [portfolio.json_serialize(request.url_root) for portfolio in portfolios]}, HTTP_200_OK)
+    else:
+        try:
+            users, links = sscan_page('list_users', "/portfolios")
+        except ValueError as e:
+            return reply({'error' : str(e)}, HTTP_400_BAD_REQUEST)
+        portfolios = load_portfolios(users)
+        response = reply({"portfolios" : [portfolio.json_serialize(request.url_root) for portfolio in portfolios], "links" : links}, HTTP_200_OK)
+    portfolios_cache.put(key, generation, response.get_data())
+    return response
+
+@app.route(url_version+"/assets", methods=['GET'])
+@requires_auth_any
+def list_catalog():
+    """Returns the assets of the catalog, one page at a time.
+
+        Initiated with a GET to /api/v1/assets, with the optional class
+        (asset class) and q (name prefix, ignoring case and whitespace
+        runs) filters and the cursor and limit query parameters. With the
+        class filter alone, the page is read with SSCAN from the
+        assets_class_<class> index. Otherwise it is read in name order
+        from the assets_names index with search_assets. The keyspace is
+        never scanned.
+
+        Returns:
+            response (Response): A list of assets (id, name, class and
+                                 price) and a "next" link if there is a
+                                 following page OR an error message.
+    """
+    asset_class = request.args.get('class')
+    prefix = normalize_asset_name(request.args.get('q', ''))
+    query = dict((name, request.args[name]) for name in ['class', 'q'] if name in request.args)
+    try:
+        if asset_class is not None and not prefix:
+            asset_ids, links = sscan_page("assets_class_"+asset_class, "/assets", query)
+            asset_ids = sorted(int(asset_id) for asset_id in asset_ids)
+        else:
+            asset_ids, links = search_assets(prefix, asset_class, query)
+    except ValueError as e:
+        return reply({'error' : str(e)}, HTTP_400_BAD_REQUEST)
+    asset_catalog.prefetch(asset_ids)
+    assets = [asset_catalog.get(asset_id) for asset_id in asset_ids]
+    return reply({"assets" : [asset for asset in assets if asset is not None], "links" : links}, HTTP_200_OK)
+
+@app.route(url_version+"/assets/<asset_id>/holders", methods=['GET'])
+@requires_auth_admin
+def list_holders(asset_id):
+    """Returns the users holding an asset, one page at a time.
+
+        Initiated with a GET to /api/v1/assets/<asset_id>/holders, with the
+        optional cursor and limit query parameters. The users are read from
+        the holders_<asset_id> index with SSCAN, together with a "next"
+        link to the following page if there is one.
+
+        Returns:
+            response (Response): A list of user names OR an error message.
+    """
+    try:
+        asset_id = int(asset_id)
+    except ValueError:
+        return reply({'error' : 'The asset_id {0} is not an integer'.format(asset_id)}, HTTP_400_BAD_REQUEST)
+    if asset_catalog.get(asset_id) is None:
+        return reply({'error' : 'Asset id {0} does not exist in database'.format(asset_id)}, HTTP_404_NOT_FOUND)
+    try:
+        users, links = sscan_page("holders_"+str(asset_id), "/assets/{0}/holders".format(asset_id))
+    except ValueError as e:
+        return reply({'error' : str(e)}, HTTP_400_BAD_REQUEST)
+    return reply({"holders" : sorted(users), "links" : links}, HTTP_200_OK)
+
+@app.route(url_version+"/portfolios/export", methods=['GET'])
+@requires_auth_admin
+def export_portfolios():
+    """Streams all the portfolios present in Redis, one JSON per line.
+
+        Initiated with a GET to /api/v1/portfolios/export, optionally with
+        ?holdings=true to include the assets of each portfolio. Users are
+        read in batches of EXPORT_BATCH_SIZE with SSCAN and one pipelined
+        round trip per batch, and each portfolio is sent as soon as it is
+        serialized, so memory use does not grow with the number of users.
+        As with SSCAN, a portfolio may appear more than once if users are
+        added or removed during the export.
+
+        Returns:
+            response (Response): Streamed NDJSON of portfolios information.
+    """
+    holdings = request.args.get('holdings', '').lower() in ('1', 'true', 'yes')
+    url_root = request.url_root
+    def generate():
+        cursor = 0
+        while True:
+            cursor, users = redis_server.sscan('list_users', cursor, count=EXPORT_BATCH_SIZE)
+            for portfolio in load_portfolios(list(users)):
+                yield json.dumps(portfolio.json_serialize(url_root, holdings)) + "\n"
+            if int(cursor) == 0:
+                break
+    return Response(generate(), status=HTTP_200_OK, mimetype='application/x-ndjson')
 
 @app.route(url_version+"/portfolios/<user>/assets", methods=['GET'])
 @requires_auth
+@conditional
 def list_assets(user):
     """Returns a list of all the assets of a portfolio.
 
@@ -513,56 +2147,124 @@ def list_assets(user):
             response (Response): A list of assets (id and name) OR an
                                  error message.
     """
-    username = redis_server.hget("user_"+user,"name")
-    if not username:
+    portfolio = load_portfolio(user)
+    if portfolio is None:
         return reply({'error' : 'User {0} not found'.format(user)}, HTTP_404_NOT_FOUND)
-    data = redis_server.hget("user_"+user,"data")
-    portfolio = Portfolio(user)
-    if data:
-        portfolio = Portfolio.deserialize(data)
     return reply({'assets' : [{'id' : asset.id, 'name' : asset.name} for asset in portfolio.assets.itervalues()]}, HTTP_200_OK)
 
 @app.route(url_version+"/portfolios/<user>/assets/<asset_id>", methods=['GET'])
 @requires_auth
+@conditional
 def get_asset(user, asset_id):
     """Returns the details of an asset of a Portfolio.
 
         Initiated with a GET to /api/v1/portfolios/<user>/assets/<asset_id>.
+        Only the holding of this asset is read from Redis.
 
         Returns:
             response (Response): Contains the name, quantity and total
                                  value of an asset OR an error message.
     """
-    username = redis_server.hget("user_"+user,"name")
+    asset_id = int(asset_id)
+    pipe = redis_server.pipeline(transaction=False)
+    pipe.hmget("user_"+user, ["name", "data"])
+    pipe.exists("holdings_"+user)
+    pipe.hget("holdings_"+user, asset_id)
+    (username, data), has_holdings, quantity = pipe.execute()
     if not username:
         return reply({'error' : 'User {0} not found'.format(user)}, HTTP_404_NOT_FOUND)
-    data = redis_server.hget("user_"+user,"data")
-    if not data:
+    if not data and not has_holdings:
         return reply({'error' : 'The portfolio of user {0} has no data!'.format(user)}, HTTP_404_NOT_FOUND)
-    portfolio = Portfolio.deserialize(data)
-    asset_id = int(asset_id)
-    if asset_id not in portfolio.assets:
+    if data: # legacy layout, not migrated yet
+        quantity = dict(Portfolio.decode(data)[1]).get(asset_id)
+    if not quantity:
         return reply({'error' : 'Asset with id {0} does not exist in this portfolio'.format(asset_id)}, HTTP_404_NOT_FOUND)
-    return reply({'name' : portfolio.assets[asset_id].name, 'quantity' : portfolio.assets[asset_id].quantity, 'value' : portfolio.assets[asset_id].quantity * portfolio.assets[asset_id].price}, HTTP_200_OK)
+    asset = Asset(asset_id, quantity)
+    return reply({'name' : asset.name, 'quantity' : asset.quantity, 'value' : asset.quantity * asset.price}, HTTP_200_OK)
 
 @app.route(url_version+"/portfolios/<user>/nav", methods=['GET'])
 @requires_auth
+@conditional
 def get_nav(user):
     """Returns the Net Asset Value (NAV) of a Portfolio.
 
         Initiated with a GET to /api/v1/portfolios/<user>/nav.
+        The NAV is kept up to date in the nav field of the user_* hash by
+        the holding and price scripts, so it is a single read. It is only
+        computed if missing, for portfolios not written since it exists.
 
         Returns:
             response (Response): Contains the NAV value.
     """
-    username = redis_server.hget("user_"+user,"name")
+    username, data, nav = redis_server.hmget("user_"+user, ["name", "data", "nav"])
     if not username:
         return reply({'error' : 'User {0} not found'.format(user)}, HTTP_404_NOT_FOUND)
-    data = redis_server.hget("user_"+user,"data")
-    portfolio = Portfolio(user)
-    if data:
+    if data: # legacy layout, not migrated yet
+        nav = Portfolio.deserialize(data).nav
+    elif nav is None:
+        nav = run_lua_script("refresh_nav", ["user_"+user, "holdings_"+user], [user])
+        if nav is None:
+            return reply({'error' : 'User {0} not found'.format(user)}, HTTP_404_NOT_FOUND)
+    return reply({"nav" : float(nav)}, HTTP_200_OK)
+
+@app.route(url_version+"/portfolios/<user>/exposure", methods=['GET'])
+@requires_auth
+@conditional
+def get_exposure(user):
+    """Returns the exposure of a Portfolio by asset class or by asset.
+
+        Initiated with a GET to /api/v1/portfolios/<user>/exposure, with
+        ?by=class (default) or ?by=asset. The exposures are kept up to date
+        in the exposure_class_* and exposure_asset_* hashes by the holding
+        and price scripts, so the read is proportional to the number of
+        classes (or of assets held) and not to the holdings.
+
+        Returns:
+            response (Response): Contains the NAV and the value held in
+                                 each asset class or asset OR an error
+                                 message.
+    """
+    by = request.args.get('by', 'class')
+    if by not in ('class', 'asset'):
+        return reply({'error' : 'Exposure can only be grouped by class or asset, not {0}'.format(by)}, HTTP_400_BAD_REQUEST)
+    pipe = redis_server.pipeline(transaction=False)
+    pipe.hmget("user_"+user, ["name", "data", "nav"])
+    pipe.hgetall("exposure_"+by+"_"+user)
+    (username, data, nav), exposure = pipe.execute()
+    if not username:
+        return reply({'error' : 'User {0} not found'.format(user)}, HTTP_404_NOT_FOUND)
+    if data: # legacy layout, not migrated yet
         portfolio = Portfolio.deserialize(data)
-    return reply({"nav" : portfolio.nav}, HTTP_200_OK)
+        nav, exposure = portfolio.nav, dict()
+        for asset in portfolio.assets.values():
+            key = asset.asset_class if by == 'class' else str(asset.id)
+            exposure[key] = exposure.get(key, 0) + asset.quantity * asset.price
+    elif nav is None:
+        nav = run_lua_script("refresh_nav", ["user_"+user, "holdings_"+user], [user])
+        if nav is None:
+            return reply({'error' : 'User {0} not found'.format(user)}, HTTP_404_NOT_FOUND)
+        exposure = redis_server.hgetall("exposure_"+by+"_"+user)
+    return reply({"nav" : float(nav), "exposure" : exposure_values(exposure)}, HTTP_200_OK)
+
+@app.route(url_version+"/exposure", methods=['GET'])
+@requires_auth_admin
+def get_book_exposure():
+    """Returns the exposure of the whole book by asset class or by asset.
+
+        Initiated with a GET to /api/v1/exposure, with ?by=class (default)
+        or ?by=asset. The book exposures are the sums of the exposures of
+        the portfolios, maintained together with them, so the read is a
+        single HGETALL. Portfolios whose NAV was never stored (legacy or
+        not written since) are not included until rebuild-exposure is run.
+
+        Returns:
+            response (Response): Contains the value held in each asset
+                                 class or asset OR an error message.
+    """
+    by = request.args.get('by', 'class')
+    if by not in ('class', 'asset'):
+        return reply({'error' : 'Exposure can only be grouped by class or asset, not {0}'.format(by)}, HTTP_400_BAD_REQUEST)
+    return reply({"exposure" : exposure_values(redis_server.hgetall("book_exposure_"+by))}, HTTP_200_OK)
 
 @app.route(url_version+"/portfolios", methods=['POST'])
 @requires_auth_admin
@@ -586,12 +2288,11 @@ def create_user():
         if not is_valid(payload, ['password']):
             return reply({'error' : 'Payload is missing the password {0} (SECURED mode on)'.format(payload)}, HTTP_400_BAD_REQUEST)
     user = payload['user']
-    if not redis_server.hget("user_"+user,"name"):
-        redis_server.sadd('list_users', user) # Set of users
-        redis_server.hmset("user_"+user, {"name": user})
+    if run_lua_script("create_user", ["user_"+user, "list_users"], [user]):
         if SECURED:
             hash_password = generate_password_hash(payload['password'])
             redis_server.hmset("password_"+user, {"hash_password":hash_password})
+            auth_cache.invalidate(user)
         return reply("", HTTP_201_CREATED)
     return reply({'error' : 'User {0} already exists'.format(user)}, HTTP_409_CONFLICT)
 
@@ -612,25 +2313,22 @@ def create_asset(user):
         return reply({'error' : 'Data {0} is not valid'.format(request.data)}, HTTP_400_BAD_REQUEST)
     if not is_valid(payload, ['asset_id','quantity']):
         return reply({'error' : 'Payload {0} is not valid'.format(payload)}, HTTP_400_BAD_REQUEST)
-    quantity = float(payload['quantity'])
+    try:
+        quantity = parse_quantity(payload['quantity'])
+    except ValueError as error:
+        return reply({'error' : str(error)}, HTTP_400_BAD_REQUEST)
     if quantity < 0:
         return reply({'error' : 'Quantity value must be positive'}, HTTP_400_BAD_REQUEST)
     asset_id = int(payload['asset_id'])
-    ID = redis_server.hget("asset_id_"+str(asset_id),"id")
-    if ID != 0 and not ID:
+    code = run_trade_script("create_holding", user, asset_id, quantity)
+    if code == TRADE_INVALID_QUANTITY:
+        return reply({'error' : 'The value of {0} units of the asset with id {1} is out of range.'.format(quantity, asset_id)}, HTTP_400_BAD_REQUEST)
+    if code == TRADE_ASSET_NOT_FOUND:
         return reply({'error' : 'Asset id {0} does not exist in database'.format(asset_id)}, HTTP_400_BAD_REQUEST)
-    username = redis_server.hget("user_"+user,"name")
-    if not username:
+    if code == TRADE_USER_NOT_FOUND:
         return reply({'error' : 'User {0} not found'.format(user)}, HTTP_404_NOT_FOUND)
-    data = redis_server.hget("user_"+user, "data")
-    portfolio = Portfolio(user)
-    if data:
-        portfolio = Portfolio.deserialize(data)
-    if asset_id in portfolio.assets:
+    if code == TRADE_ALREADY_EXISTS:
         return reply({'error' : 'Asset with id {0} already exists in portfolio.'.format(asset_id)}, HTTP_409_CONFLICT)
-    portfolio.buy_sell(asset_id, quantity)
-    data = portfolio.serialize()
-    redis_server.hmset("user_"+user, {"data": data})
     return reply("", HTTP_201_CREATED)
 
 @app.route(url_version+"/portfolios/<user>/assets/<asset_id>", methods=['PUT'])
@@ -641,6 +2339,9 @@ def update_asset(user, asset_id):
         Initiated with a PUT to /api/v1/portfolios/<user>/assets/<asset_id>
         with a body {"quantity": -4.2}
 
+        The holding is checked and updated atomically by the buy_sell Lua
+        script, with the same rules as Portfolio.buy_sell.
+
         Returns:
             response (Response): Returns "" or an error message.
     """
@@ -654,24 +2355,104 @@ def update_asset(user, asset_id):
         asset_id = int(asset_id)
     except ValueError:
         return reply({'error' : 'The asset_id {0} is not an integer'.format(asset_id)}, HTTP_400_BAD_REQUEST)
-    quantity = int(payload['quantity'])
-    username = redis_server.hget("user_"+user,"name")
-    if not username:
+    try:
+        quantity = int(parse_quantity(payload['quantity']))
+    except ValueError as error:
+        return reply({'error' : str(error)}, HTTP_400_BAD_REQUEST)
+    code = run_trade_script("buy_sell", user, asset_id, quantity)
+    if code == TRADE_INVALID_QUANTITY:
+        return reply({'error' : 'The value of the asset with id {0} in the portfolio of {1} would be out of range.'.format(asset_id, user)}, HTTP_400_BAD_REQUEST)
+    if code == TRADE_USER_NOT_FOUND:
         return reply({'error' : 'User {0} not found'.format(user)}, HTTP_404_NOT_FOUND)
-    data = redis_server.hget("user_"+user,"data")
-    if not data:
+    if code == TRADE_NO_DATA:
         return reply({'error' : 'No data associated with user {0}'.format(user)}, HTTP_404_NOT_FOUND)
-    portfolio = Portfolio.deserialize(data)
-    try:
-        portfolio.buy_sell(asset_id, quantity, can_be_created=False)
-    except AssetNotFoundException:
+    if code == TRADE_ASSET_NOT_FOUND:
         return reply({'error' : 'Asset with id {0} was not found in the portfolio of {1}.'.format(asset_id, user)}, HTTP_404_NOT_FOUND)
-    except NegativeAssetException:
+    if code == TRADE_NEGATIVE:
         return reply({'error' : 'Selling {0} units of the asset with id {1} in the portfolio of {2} would result in a negative quantity. The operation was aborted.'.format(-quantity, asset_id, user)}, HTTP_400_BAD_REQUEST)
-    data = portfolio.serialize()
-    redis_server.hmset("user_"+user,{"data": data})
     return reply("", HTTP_200_OK)
 
+@app.route(url_version+"/portfolios/<user>/trades", methods=['POST'])
+@requires_auth
+def create_trades(user):
+    """Buys and sells several assets of a user's Portfolio at once.
+
+        Initiated with a POST to /api/v1/portfolios/<user>/trades with
+        a body {"trades": [{"asset_id": 2, "quantity": 10}, {"asset_id": 0,
+        "quantity": -4.2}]} of at most TRADES_MAX_LEGS legs. The legs are
+        applied in order with the rules of Portfolio.buy_sell, an asset
+        being created when bought, and either all of them or none are
+        persisted.
+
+        Returns:
+            response (Response): Returns "" or an error message with the
+                                 index of the leg which failed.
+    """
+    try:
+        payload = json.loads(request.data)
+    except ValueError:
+        return reply({'error' : 'Data {0} is not valid'.format(request.data)}, HTTP_400_BAD_REQUEST)
+    if not is_valid(payload, ['trades']) or not isinstance(payload['trades'], list) or not payload['trades']:
+        return reply({'error' : 'Payload {0} is not valid'.format(payload)}, HTTP_400_BAD_REQUEST)
+    if len(payload['trades']) > TRADES_MAX_LEGS:
+        return reply({'error' : 'At most {0} trades can be made at once'.format(TRADES_MAX_LEGS)}, HTTP_400_BAD_REQUEST)
+    legs = []
+    for trade in payload['trades']:
+        try:
+            legs.append((int(trade['asset_id']), parse_quantity(trade['quantity'])))
+        except (TypeError, KeyError, ValueError):
+            return reply({'error' : 'Trade {0} is not valid'.format(trade), 'leg' : len(legs)}, HTTP_400_BAD_REQUEST)
+    asset_catalog.prefetch([ID for ID, Q in legs])
+    for i, (ID, Q) in enumerate(legs):
+        if asset_catalog.get(ID) is None:
+            return reply({'error' : 'Asset id {0} does not exist in database'.format(ID), 'leg' : i}, HTTP_400_BAD_REQUEST)
+    code, leg = trade_portfolio(user, legs)
+    if code != TRADE_OK:
+        message, rc = trade_error(code, user, *(legs[leg] if leg is not None else (None, None)))
+        if leg is not None:
+            message['leg'] = leg
+        return reply(message, rc)
+    return reply("", HTTP_200_OK)
+
+@app.route(url_version+"/trades", methods=['POST'])
+@requires_auth_admin
+def create_bulk_trades():
+    """Buys and sells assets of many portfolios at once.
+
+        Initiated with a POST to /api/v1/trades with a body {"trades":
+        [{"user": "john", "asset_id": 2, "quantity": 10}, ...]}, or with
+        one such trade per line and the application/x-ndjson content type.
+        The trades are processed in batches of BULK_TRADES_BATCH_SIZE,
+        grouped per user with pipelined reads and writes, and each one is
+        applied with the rules of Portfolio.buy_sell unless it fails.
+
+        Returns:
+            response (Response): Number of trades applied and failed, and
+                                 the status (and error) of each trade in
+                                 order OR an error message.
+    """
+    if request.mimetype == 'application/x-ndjson':
+        trades = parse_ndjson(request.stream)
+    else:
+        try:
+            payload = json.loads(request.data)
+        except ValueError:
+            return reply({'error' : 'Data {0} is not valid'.format(request.data)}, HTTP_400_BAD_REQUEST)
+        if not is_valid(payload, ['trades']) or not isinstance(payload['trades'], list):
+            return reply({'error' : 'Payload {0} is not valid'.format(payload)}, HTTP_400_BAD_REQUEST)
+        trades = payload['trades']
+    results = []
+    batch = []
+    for trade in trades:
+        batch.append(trade)
+        if len(batch) == BULK_TRADES_BATCH_SIZE:
+            results += apply_trades_batch(batch)
+            batch = []
+    results += apply_trades_batch(batch)
+    applied = len([result for result in results if result['status'] == HTTP_200_OK])
+    data = {"applied" : applied, "failed" : len(results) - applied, "results" : results}
+    return Response(json.dumps(data, separators=(',', ':')), status=HTTP_200_OK, mimetype='application/json') # compact, unlike jsonify
+
 @app.route(url_version+"/portfolios/<user>/assets/<asset_id>", methods=['DELETE'])
 @requires_auth
 def delete_asset(user, asset_id):
@@ -682,14 +2463,7 @@ def delete_asset(user, asset_id):
         Returns:
             response (Response): Returns "" with status HTTP_204_NO_CONTENT.
     """
-    username = redis_server.hget("user_"+user,"name")
-    if username:
-        data = redis_server.hget("user_"+user,"data")
-        if data:
-            portfolio = Portfolio.deserialize(data)
-            portfolio.remove_asset(int(asset_id)) #removes or does nothing if no asset
-            data = portfolio.serialize()
-            redis_server.hmset("user_"+user,{"data": data})
+    run_trade_script("remove_holding", user, int(asset_id)) #removes or does nothing if no asset
     return reply("", HTTP_204_NO_CONTENT)
 
 @app.route(url_version+"/portfolios/<user>", methods=['DELETE'])
@@ -704,12 +2478,875 @@ def delete_user(user):
     """
     username = redis_server.hget("user_"+user,"name")
     if username:
-        redis_server.hdel("user_"+username, ["name","data"])
-        redis_server.delete("user_"+username)
-        redis_server.srem('list_users', user)
+        keys = ["user_"+username, "holdings_"+username, "list_users"]
+        if run_lua_script("delete_user", keys, [username]) == TRADE_LEGACY_DATA:
+            migrate_user_holdings(username)
+            run_lua_script("delete_user", keys, [username])
+    auth_cache.invalidate(user)
     return reply("", HTTP_204_NO_CONTENT)
 
 
+@app.errorhandler(ConnectionError)
+@app.errorhandler(TimeoutError)
+def redis_unavailable(error):
+    """Answers 503 when Redis can't serve a request in time.
+
+        This is the case when no connection of the pool is free within
+        REDIS_POOL_TIMEOUT seconds, or when Redis does not answer within
+        REDIS_SOCKET_TIMEOUT seconds or can't be reached.
+
+        Returns:
+            response (Response): Error message with status code
+                                 HTTP_503_SERVICE_UNAVAILABLE.
+    """
+    response = reply({'error' : 'The database is unavailable, please retry later ({0})'.format(error)}, HTTP_503_SERVICE_UNAVAILABLE)
+    response.headers['Retry-After'] = '1'
+    return response
+
+@app.before_request
+def start_request_timer():
+    """Remembers when the request started, for the metrics.
+
+        The Redis commands of the request are traced from there when
+        redis_server is a TracedRedis.
+    """
+    g.started_at = time.time()
+    if isinstance(redis_server, TracedRedis):
+        g.redis_trace = RedisTrace()
+
+@app.after_request
+def observe_request(response):
+    """Counts the request and observes its duration in the metrics.
+
+        The route is the rule of the URL (/api/v1/portfolios/<user> for
+        instance), to keep the number of series bounded.
+
+        Args:
+            response (Response): Response to the request.
+
+        Returns:
+            response (Response): The same response.
+    """
+    record_request(response.status_code)
+    return response
+
+@app.after_request
+def report_redis_trace(response):
+    """Adds the Redis commands of the request to a Server-Timing header.
+
+        A warning is logged when the request made more round trips than
+        REDIS_ROUND_TRIPS_BUDGET, usually one per item of a list (N+1
+        queries) instead of a pipeline or a script, or when it sent the
+        same read command several times. The commands sent while
+        streaming the body come after the headers and are not counted.
+
+        Args:
+            response (Response): Response to the request.
+
+        Returns:
+            response (Response): The same response.
+    """
+    trace = getattr(g, "redis_trace", None)
+    if trace is None:
+        return response
+    g.redis_trace = None
+    response.headers.add("Server-Timing", 'redis;dur={0:.3f};desc="{1} round trip{2}, {3} command{4}"'.format(
+                         trace.seconds * 1000, trace.round_trips, "s" if trace.round_trips != 1 else "",
+                         trace.commands, "s" if trace.commands != 1 else ""))
+    if 0 < REDIS_ROUND_TRIPS_BUDGET < trace.round_trips:
+        trips = sorted(trace.trips.items(), key=lambda item: -item[1])
+        app.logger.warning("{0} {1} made {2} Redis round trips, over the budget of {3}: {4}".format(
+                           request.method, request.path, trace.round_trips, REDIS_ROUND_TRIPS_BUDGET,
+                           ", ".join("{0} x{1}".format(name, count) for name, count in trips)))
+    repeated = trace.repeated_reads()
+    if repeated:
+        app.logger.warning("{0} {1} sent the same Redis reads several times: {2}".format(
+                           request.method, request.path,
+                           ", ".join("{0} {1} x{2}".format(name, args, count) for count, name, args in repeated)))
+    return response
+
+@app.teardown_request
+def observe_failed_request(exception):
+    """Counts a request failed with an unhandled exception as a 500.
+
+        Args:
+            exception (Exception, None): Exception raised by the view.
+    """
+    if exception is not None:
+        record_request(HTTP_500_INTERNAL_SERVER_ERROR)
+
+def record_request(status_code):
+    """Counts the current request once, with its status code.
+
+        Args:
+            status_code (int): Status code of the response.
+    """
+    started_at = getattr(g, "started_at", None)
+    if started_at is None:
+        return
+    g.started_at = None
+    route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+    metrics.inc("portfoliomgmt_http_requests_total", (("method", request.method), ("route", route), ("status", status_code)))
+    metrics.observe("portfoliomgmt_http_request_duration_seconds", (("method", request.method), ("route", route)), time.time() - started_at)
+
+######################################################################
+# REDIS LUA SCRIPTS
+######################################################################
+# Codes returned by the holding scripts
+TRADE_OK = 0
+TRADE_USER_NOT_FOUND = 1
+TRADE_LEGACY_DATA = 2 # holdings still in the user data blob, to migrate first
+TRADE_NO_DATA = 3 # the user has no holding at all
+TRADE_ASSET_NOT_FOUND = 4 # as AssetNotFoundException
+TRADE_NEGATIVE = 5 # as NegativeAssetException
+TRADE_ALREADY_EXISTS = 6
+TRADE_CONFLICT = 7 # holdings modified since they were read
+TRADE_INVALID_QUANTITY = 8 # quantity or value not a finite number
+
+# Functions shared by the scripts maintaining the value of the portfolios:
+# the nav field of the user_* hashes and the exposure by asset class and by
+# asset of each user (exposure_class_*, exposure_asset_* hashes) and of the
+# whole book (book_exposure_class, book_exposure_asset hashes), exposures
+# being initialised together with the nav field. Each change of a holding
+# also sets the version field of the user_* hash to a new value of the
+# portfolio_version counter. They access keys which
+# are not declared in KEYS, so they must only run against a single Redis
+# instance.
+LUA_NAV_FUNCTIONS = """
+local function number(value)
+    return string.format('%.17g', value)
+end
+local function finite(value)
+    return value ~= nil and value == value and value ~= math.huge and value ~= -math.huge
+end
+local function asset_info(asset_id)
+    local asset = redis.call('HMGET', 'asset_id_' .. asset_id, 'price', 'class')
+    return tonumber(asset[1]) or 0, asset[2] or ''
+end
+local function revaluable(holders, asset_id, price, old)
+    if not finite(price) then
+        return false
+    end
+    for _, user in ipairs(holders) do
+        local held = tonumber(redis.call('HGET', 'holdings_' .. user, asset_id))
+        local nav = tonumber(redis.call('HGET', 'user_' .. user, 'nav'))
+        if held and nav and not (finite(held * price) and finite(held * (price - old)) and finite(nav + held * (price - old))) then
+            return false
+        end
+    end
+    return true
+end
+local function add_exposure(name, asset_id, class, value, change)
+    if value == 0 then
+        redis.call('HDEL', 'exposure_asset_' .. name, asset_id)
+    else
+        redis.call('HSET', 'exposure_asset_' .. name, asset_id, number(value))
+    end
+    if change ~= 0 then
+        redis.call('HINCRBYFLOAT', 'exposure_class_' .. name, class, number(change))
+        redis.call('HINCRBYFLOAT', 'book_exposure_class', class, number(change))
+        redis.call('HINCRBYFLOAT', 'book_exposure_asset', asset_id, number(change))
+    end
+end
+local function remove_exposure(name)
+    for _, by in ipairs({'class', 'asset'}) do
+        local exposure = redis.call('HGETALL', 'exposure_' .. by .. '_' .. name)
+        for i = 1, #exposure, 2 do
+            redis.call('HINCRBYFLOAT', 'book_exposure_' .. by, exposure[i], number(-tonumber(exposure[i + 1])))
+        end
+        redis.call('DEL', 'exposure_' .. by .. '_' .. name)
+    end
+end
+local function refresh_value(name)
+    remove_exposure(name)
+    local nav = 0
+    local holdings = redis.call('HGETALL', 'holdings_' .. name)
+    for i = 1, #holdings, 2 do
+        local price, class = asset_info(holdings[i])
+        local value = tonumber(holdings[i + 1]) * price
+        add_exposure(name, holdings[i], class, value, value)
+        nav = nav + value
+    end
+    redis.call('HSET', 'user_' .. name, 'nav', number(nav))
+    return number(nav)
+end
+local function ensure_value(name)
+    if redis.call('HEXISTS', 'user_' .. name, 'nav') == 0 then
+        refresh_value(name)
+    end
+end
+local function holding_changed(name, asset_id, quantity, old_quantity)
+    redis.call('HSET', 'user_' .. name, 'version', redis.call('INCR', 'portfolio_version'))
+    local price, class = asset_info(asset_id)
+    local change = (quantity - old_quantity) * price
+    add_exposure(name, asset_id, class, quantity * price, change)
+    if redis.call('EXISTS', 'holdings_' .. name) == 0 then
+        redis.call('HSET', 'user_' .. name, 'nav', '0')
+        remove_exposure(name) -- float residues of the positions sold
+    elseif change ~= 0 then
+        redis.call('HINCRBYFLOAT', 'user_' .. name, 'nav', number(change))
+    end
+end
+"""
+
+# Functions shared by the scripts writing the name and class of assets,
+# which maintain the indexes of the catalog: a set of asset ids per class
+# (assets_class_* sets) and the assets_names sorted set, whose members are
+# the normalized name and the id of each asset separated by a NUL byte, all
+# with the score 0 to be ordered and searched by name with ZRANGEBYLEX. The
+# names are normalized as with normalize_asset_name.
+LUA_ASSET_FUNCTIONS = """
+local function asset_member(asset_id, name)
+    return string.lower(string.match(string.gsub(name, '%s+', ' '), '^ ?(.-) ?$')) .. '\\0' .. asset_id
+end
+local function index_asset(asset_id, name, class)
+    redis.call('ZADD', 'assets_names', 0, asset_member(asset_id, name))
+    redis.call('SADD', 'assets_class_' .. class, asset_id)
+end
+local function write_asset(asset_key, asset_id, name, class)
+    local old = redis.call('HMGET', asset_key, 'name', 'class')
+    if old[1] then
+        redis.call('ZREM', 'assets_names', asset_member(asset_id, old[1]))
+        redis.call('SREM', 'assets_class_' .. (old[2] or ''), asset_id)
+    end
+    local created = redis.call('HSETNX', asset_key, 'id', asset_id)
+    redis.call('HMSET', asset_key, 'name', name, 'class', class)
+    index_asset(asset_id, name, class)
+    return created, (old[1] and old[1] ~= name) or false
+end
+local function touch_holders(holders_key)
+    local version = redis.call('INCR', 'portfolio_version')
+    for _, user in ipairs(redis.call('SMEMBERS', holders_key)) do
+        if redis.call('EXISTS', 'user_' .. user) == 1 then
+            redis.call('HSET', 'user_' .. user, 'version', version)
+        end
+    end
+end
+"""
+
+# KEYS: user_<user>, holdings_<user>, asset_id_<id>, holders_<id>
+# ARGV: asset id, quantity to buy (positive) or sell (negative), user
+LUA_BUY_SELL = LUA_NAV_FUNCTIONS + """
+local user = redis.call('HMGET', KEYS[1], 'name', 'data')
+if not user[1] then
+    return 1
+end
+if user[2] and user[2] ~= '' then
+    return 2
+end
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    return 3
+end
+local quantity = tonumber(ARGV[2])
+if not finite(quantity) then
+    return 8
+end
+if quantity == 0 then
+    return 0
+end
+local held = redis.call('HGET', KEYS[2], ARGV[1])
+if not held then
+    return 4
+end
+held = tonumber(held)
+if not finite((held + quantity) * asset_info(ARGV[1])) then
+    return 8
+end
+if held + quantity < 0 then
+    return 5
+end
+ensure_value(ARGV[3])
+if held + quantity == 0 then
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    redis.call('SREM', KEYS[4], ARGV[3])
+    holding_changed(ARGV[3], ARGV[1], 0, held)
+else
+    holding_changed(ARGV[3], ARGV[1], tonumber(redis.call('HINCRBYFLOAT', KEYS[2], ARGV[1], ARGV[2])), held)
+end
+return 0
+"""
+
+# KEYS: user_<user>, holdings_<user>, asset_id_<id>, holders_<id>
+# ARGV: asset id, quantity to buy (positive or zero), user
+LUA_CREATE_HOLDING = LUA_NAV_FUNCTIONS + """
+if redis.call('EXISTS', KEYS[3]) == 0 then
+    return 4
+end
+local user = redis.call('HMGET', KEYS[1], 'name', 'data')
+if not user[1] then
+    return 1
+end
+if user[2] and user[2] ~= '' then
+    return 2
+end
+if redis.call('HEXISTS', KEYS[2], ARGV[1]) == 1 then
+    return 6
+end
+local quantity = tonumber(ARGV[2])
+if not finite(quantity) or not finite(quantity * asset_info(ARGV[1])) then
+    return 8
+end
+if quantity > 0 then
+    ensure_value(ARGV[3])
+    redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+    redis.call('SADD', KEYS[4], ARGV[3])
+    holding_changed(ARGV[3], ARGV[1], quantity, 0)
+end
+return 0
+"""
+
+# KEYS: user_<user>, holdings_<user>, asset_id_<id>, holders_<id>
+# ARGV: asset id, quantity (unused), user
+LUA_REMOVE_HOLDING = LUA_NAV_FUNCTIONS + """
+local user = redis.call('HMGET', KEYS[1], 'name', 'data')
+if not user[1] then
+    return 1
+end
+if user[2] and user[2] ~= '' then
+    return 2
+end
+local held = redis.call('HGET', KEYS[2], ARGV[1])
+if held then
+    ensure_value(ARGV[3])
+    redis.call('HDEL', KEYS[2], ARGV[1])
+    redis.call('SREM', KEYS[4], ARGV[3])
+    holding_changed(ARGV[3], ARGV[1], 0, tonumber(held))
+end
+return 0
+"""
+
+# KEYS: user_<user>, holdings_<user>
+# ARGV: user, then for each asset traded: asset id, quantity as read (''
+#       if not held) and new quantity ('' to remove the holding)
+LUA_APPLY_TRADES = LUA_NAV_FUNCTIONS + """
+local user = redis.call('HMGET', KEYS[1], 'name', 'data')
+if not user[1] then
+    return 1
+end
+if user[2] and user[2] ~= '' then
+    return 2
+end
+for i = 2, #ARGV, 3 do
+    if (redis.call('HGET', KEYS[2], ARGV[i]) or '') ~= ARGV[i + 1] then
+        return 7
+    end
+    if ARGV[i + 2] ~= '' then
+        local quantity = tonumber(ARGV[i + 2])
+        if not finite(quantity) or not finite(quantity * asset_info(ARGV[i])) then
+            return 8
+        end
+    end
+end
+ensure_value(ARGV[1])
+for i = 2, #ARGV, 3 do
+    if ARGV[i + 2] == '' then
+        redis.call('HDEL', KEYS[2], ARGV[i])
+        redis.call('SREM', 'holders_' .. ARGV[i], ARGV[1])
+    else
+        redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 2])
+        redis.call('SADD', 'holders_' .. ARGV[i], ARGV[1])
+    end
+    holding_changed(ARGV[1], ARGV[i], tonumber(ARGV[i + 2]) or 0, tonumber(ARGV[i + 1]) or 0)
+end
+return 0
+"""
+
+# KEYS: user_<user>, holdings_<user>
+# ARGV: user
+LUA_REFRESH_NAV = LUA_NAV_FUNCTIONS + """
+if not redis.call('HGET', KEYS[1], 'name') then
+    return false
+end
+return refresh_value(ARGV[1])
+"""
+
+# KEYS: asset_id_<id>, holders_<id>
+# ARGV: asset id, new price
+LUA_SET_PRICE = LUA_NAV_FUNCTIONS + """
+local old, class = asset_info(ARGV[1])
+local price = tonumber(ARGV[2])
+local holders = redis.call('SMEMBERS', KEYS[2])
+if not revaluable(holders, ARGV[1], price, old) then -- before the first write, as scripts are not rolled back
+    return 8
+end
+redis.call('HSET', KEYS[1], 'price', ARGV[2])
+local revalued = {}
+local version = redis.call('INCR', 'portfolio_version')
+for _, user in ipairs(holders) do
+    if redis.call('EXISTS', 'user_' .. user) == 1 then
+        redis.call('HSET', 'user_' .. user, 'version', version)
+    end
+    local held = redis.call('HGET', 'holdings_' .. user, ARGV[1])
+    if held and redis.call('HEXISTS', 'user_' .. user, 'nav') == 1 then
+        local change = tonumber(held) * (price - old)
+        if change ~= 0 then
+            redis.call('HINCRBYFLOAT', 'user_' .. user, 'nav', number(change))
+        end
+        add_exposure(user, ARGV[1], class, tonumber(held) * price, change)
+        revalued[#revalued + 1] = user
+    end
+end
+return revalued
+"""
+
+# KEYS: asset_id_<id>, holders_<id> of each asset
+# ARGV: asset id, name, class and price of each asset
+LUA_UPSERT_ASSETS = LUA_NAV_FUNCTIONS + LUA_ASSET_FUNCTIONS + """
+local function upsert_asset(asset_key, holders_key, asset_id, name, class, price)
+    local old, old_class = asset_info(asset_id)
+    local holders = redis.call('SMEMBERS', holders_key)
+    if not revaluable(holders, asset_id, tonumber(price), old) then -- before the first write
+        return 8
+    end
+    local created, renamed = write_asset(asset_key, asset_id, name, class)
+    redis.call('HSET', asset_key, 'price', price)
+    price = tonumber(price)
+    if created == 1 or (price == old and class == old_class) then
+        if renamed then -- the name is in the bodies of the holders' portfolios
+            touch_holders(holders_key)
+        end
+        return created
+    end
+    local version = redis.call('INCR', 'portfolio_version')
+    for _, user in ipairs(holders) do
+        if redis.call('EXISTS', 'user_' .. user) == 1 then
+            redis.call('HSET', 'user_' .. user, 'version', version)
+        end
+        local held = redis.call('HGET', 'holdings_' .. user, asset_id)
+        if held and redis.call('HEXISTS', 'user_' .. user, 'nav') == 1 then
+            local change = tonumber(held) * (price - old)
+            if change ~= 0 then
+                redis.call('HINCRBYFLOAT', 'user_' .. user, 'nav', number(change))
+            end
+            if class == old_class then
+                add_exposure(user, asset_id, class, tonumber(held) * price, change)
+            else -- the value moves to the new class
+                add_exposure(user, asset_id, old_class, 0, -tonumber(held) * old)
+                add_exposure(user, asset_id, class, tonumber(held) * price, tonumber(held) * price)
+            end
+        end
+    end
+    return created
+end
+local results = {}
+for i = 1, #KEYS / 2 do
+    results[i] = upsert_asset(KEYS[2 * i - 1], KEYS[2 * i], ARGV[4 * i - 3], ARGV[4 * i - 2], ARGV[4 * i - 1], ARGV[4 * i])
+end
+return results
+"""
+
+# KEYS: asset_id_<id> of each asset
+# ARGV: asset id, name, class and price of each asset
+LUA_SEED_ASSETS = LUA_ASSET_FUNCTIONS + """
+for i = 1, #KEYS do
+    local _, renamed = write_asset(KEYS[i], ARGV[4 * i - 3], ARGV[4 * i - 2], ARGV[4 * i - 1])
+    if renamed then
+        touch_holders('holders_' .. ARGV[4 * i - 3])
+    end
+    redis.call('HSETNX', KEYS[i], 'price', ARGV[4 * i])
+end
+return #KEYS
+"""
+
+# KEYS: asset_id_<id> of each asset
+# ARGV: none
+LUA_INDEX_ASSETS = LUA_ASSET_FUNCTIONS + """
+local indexed = 0
+for i = 1, #KEYS do
+    local asset = redis.call('HMGET', KEYS[i], 'id', 'name', 'class')
+    if asset[1] and asset[2] and asset[3] then
+        index_asset(asset[1], asset[2], asset[3])
+        indexed = indexed + 1
+    end
+end
+return indexed
+"""
+
+# KEYS: assets_names, then assets_class_<class> to keep only this class
+# ARGV: normalized name prefix, id of the last asset of the previous page or
+#       an empty string, page size, most members of assets_names to read
+# Returns the id of the last asset read (or an empty string if there is no
+# more), then the ids of the assets found.
+LUA_SEARCH_ASSETS = LUA_ASSET_FUNCTIONS + """
+local min, max = '-', '+'
+if ARGV[1] ~= '' then
+    min, max = '[' .. ARGV[1], '[' .. ARGV[1] .. '\\255'
+end
+if ARGV[2] ~= '' then
+    min = '(' .. ARGV[2]
+end
+local limit, budget = tonumber(ARGV[3]), tonumber(ARGV[4])
+local found = {''}
+local last = nil
+local more = true
+while #found <= limit and budget > 0 and more do
+    local count = math.min(limit, budget)
+    local members = redis.call('ZRANGEBYLEX', KEYS[1], min, max, 'LIMIT', 0, count)
+    budget = budget - #members
+    more = #members == count
+    for i, member in ipairs(members) do
+        local asset_id = string.match(member, '%z(%d+)$')
+        last = member
+        min = '(' .. member
+        if not KEYS[2] or redis.call('SISMEMBER', KEYS[2], asset_id) == 1 then
+            found[#found + 1] = asset_id
+            if #found > limit then
+                more = i < #members or #redis.call('ZRANGEBYLEX', KEYS[1], min, max, 'LIMIT', 0, 1) > 0
+                break
+            end
+        end
+    end
+end
+if more and last then
+    found[1] = last
+end
+return found
+"""
+
+# KEYS: user_<user>, holdings_<user>, list_users
+# ARGV: user
+LUA_DELETE_USER = LUA_NAV_FUNCTIONS + """
+local data = redis.call('HGET', KEYS[1], 'data')
+if data and data ~= '' then
+    return 2
+end
+for _, asset_id in ipairs(redis.call('HKEYS', KEYS[2])) do
+    redis.call('SREM', 'holders_' .. asset_id, ARGV[1])
+end
+remove_exposure(ARGV[1])
+redis.call('DEL', KEYS[1], KEYS[2])
+redis.call('SREM', KEYS[3], ARGV[1])
+redis.call('INCR', 'portfolio_version')
+return 0
+"""
+
+# KEYS: user_<user>, list_users
+# ARGV: user
+# Returns 1 if the user was created, 0 if it already exists. The name and
+# the version are written at once, the version being a new value of the
+# portfolio_version counter for the cached listings.
+LUA_CREATE_USER = """
+local name = redis.call('HGET', KEYS[1], 'name')
+if name and name ~= '' then
+    return 0
+end
+redis.call('SADD', KEYS[2], ARGV[1])
+redis.call('HMSET', KEYS[1], 'name', ARGV[1], 'version', redis.call('INCR', 'portfolio_version'))
+return 1
+"""
+# KEYS: holders_<id>
+# ARGV: asset id, then users to check
+LUA_PRUNE_HOLDERS = """
+local removed = 0
+for i = 2, #ARGV do
+    local data = redis.call('HGET', 'user_' .. ARGV[i], 'data')
+    if (not data or data == '') and redis.call('HEXISTS', 'holdings_' .. ARGV[i], ARGV[1]) == 0 then
+        removed = removed + redis.call('SREM', KEYS[1], ARGV[i])
+    end
+end
+return removed
+"""
+
+# KEYS: user_<user>
+# ARGV: data expected, new data
+LUA_REPLACE_DATA = """
+if redis.call('HGET', KEYS[1], 'data') == ARGV[1] then
+    redis.call('HSET', KEYS[1], 'data', ARGV[2])
+    return 1
+end
+return 0
+"""
+
+# KEYS: user_<user>, holdings_<user>
+# ARGV: data expected, then asset id and quantity of each holding
+LUA_MIGRATE_HOLDINGS = LUA_NAV_FUNCTIONS + """
+if redis.call('HGET', KEYS[1], 'data') ~= ARGV[1] then
+    return 0
+end
+for i = 2, #ARGV, 2 do
+    redis.call('HSET', KEYS[2], ARGV[i], ARGV[i + 1])
+    redis.call('SADD', 'holders_' .. ARGV[i], string.sub(KEYS[1], 6))
+end
+redis.call('HDEL', KEYS[1], 'data')
+refresh_value(string.sub(KEYS[1], 6))
+return 1
+"""
+
+LUA_SCRIPTS = {
+    "buy_sell" : LUA_BUY_SELL,
+    "create_holding" : LUA_CREATE_HOLDING,
+    "remove_holding" : LUA_REMOVE_HOLDING,
+    "apply_trades" : LUA_APPLY_TRADES,
+    "refresh_nav" : LUA_REFRESH_NAV,
+    "set_price" : LUA_SET_PRICE,
+    "upsert_assets" : LUA_UPSERT_ASSETS,
+    "seed_assets" : LUA_SEED_ASSETS,
+    "index_assets" : LUA_INDEX_ASSETS,
+    "search_assets" : LUA_SEARCH_ASSETS,
+    "delete_user" : LUA_DELETE_USER,
+    "create_user" : LUA_CREATE_USER,
+    "prune_holders" : LUA_PRUNE_HOLDERS,
+    "replace_data" : LUA_REPLACE_DATA,
+    "migrate_holdings" : LUA_MIGRATE_HOLDINGS
+    }
+lua_shas = dict() # SHA1 digests of the scripts loaded, by script name
+
+def load_lua_scripts():
+    """Loads all the Lua scripts in Redis and remembers their SHA1 digests.
+
+        The scripts are loaded in a single round trip.
+    """
+    names = list(LUA_SCRIPTS)
+    pipe = redis_server.pipeline(transaction=False)
+    for name in names:
+        pipe.script_load(LUA_SCRIPTS[name])
+    lua_shas.update(zip(names, pipe.execute()))
+
+def run_lua_script(name, keys, args, client=None):
+    """Executes a preloaded Lua script with EVALSHA.
+
+        The script is loaded first if it was not loaded yet or if Redis
+        lost it (restart, SCRIPT FLUSH). When a pipeline is given, the
+        script is only queued in the pipeline, and a lost script only
+        fails in execute: run such pipelines with execute_scripts.
+
+        Args:
+            name (str): Name of the script in LUA_SCRIPTS.
+            keys (list[str]): Keys accessed by the script.
+            args (list): Other arguments of the script.
+            client (Redis, Pipeline, None): Client or pipeline to use
+                                            instead of redis_server.
+
+        Returns:
+            result: Value returned by the script, or the pipeline.
+    """
+    if name not in lua_shas:
+        lua_shas[name] = redis_server.script_load(LUA_SCRIPTS[name])
+    if client is None: # an empty pipeline is falsy
+        client = redis_server
+    try:
+        return client.evalsha(lua_shas[name], len(keys), *(keys + args))
+    except NoScriptError:
+        lua_shas[name] = redis_server.script_load(LUA_SCRIPTS[name])
+        return client.evalsha(lua_shas[name], len(keys), *(keys + args))
+
+def execute_scripts(queue, transaction=False):
+    """Executes a pipeline of Lua scripts, reloading them if Redis lost them.
+
+        The EVALSHA of a pipeline only fails with NoScriptError when the
+        pipeline is executed, after a Redis restart or a SCRIPT FLUSH. All
+        the scripts are then loaded again, and the commands are queued in
+        a new pipeline and sent once more: they must be safe to send
+        twice, as the other commands of the pipeline went through.
+
+        Args:
+            queue (function): Function queueing the commands in the
+                              pipeline given as its argument.
+            transaction (bool): Whether to wrap the commands in
+                                MULTI/EXEC.
+
+        Returns:
+            results (list): Result of each command of the pipeline.
+    """
+    pipe = redis_server.pipeline(transaction=transaction)
+    queue(pipe)
+    try:
+        return pipe.execute()
+    except NoScriptError:
+        load_lua_scripts()
+        pipe = redis_server.pipeline(transaction=transaction)
+        queue(pipe)
+        return pipe.execute()
+
+def run_trade_script(name, user, asset_id, quantity=0):
+    """Executes one of the holding scripts for a user and returns its code.
+
+        If the holdings of the user are still in the legacy data blob, they
+        are moved to the holdings hash and the script is executed again.
+
+        Args:
+            name (str): "buy_sell", "create_holding" or "remove_holding".
+            user (str): Name of the user.
+            asset_id (int): Unique asset id.
+            quantity (float, int): Quantity to buy (positive) or sell
+                                   (negative).
+
+        Returns:
+            code (int): One of the TRADE_* codes.
+    """
+    keys = ["user_"+user, "holdings_"+user, "asset_id_"+str(asset_id), "holders_"+str(asset_id)]
+    args = [asset_id, repr(float(quantity)), user]
+    code = run_lua_script(name, keys, args)
+    if code == TRADE_LEGACY_DATA:
+        migrate_user_holdings(user)
+        code = run_lua_script(name, keys, args)
+    return code
+
+def trade_portfolio(user, legs):
+    """Applies several trades to a portfolio, all or nothing.
+
+        Args:
+            user (str): Name of the user.
+            legs (list[(int, float)]): Asset ids and quantities to buy
+                                       (positive) or sell (negative).
+
+        Returns:
+            (code, leg) (int, int): One of the TRADE_* codes and the index
+                                    of the leg which failed, or None.
+    """
+    codes = trade_portfolios({user : legs})[user]
+    for i, code in enumerate(codes):
+        if code in (TRADE_ASSET_NOT_FOUND, TRADE_NEGATIVE, TRADE_INVALID_QUANTITY):
+            return code, i
+    return codes[0], None
+
+def trade_portfolios(legs_by_user, all_or_nothing=True):
+    """Applies trades to several portfolios.
+
+        The holdings of the traded assets of all the users are read with
+        one pipelined round trip, and the legs of each user are applied in
+        order with Portfolio.buy_sell on a portfolio made of these
+        holdings, an asset being created when bought. The
+        resulting holdings of the traded assets are then written with one
+        pipelined round trip of apply_trades Lua scripts, each only
+        applied if the holdings of its user were not modified meanwhile.
+        Users whose holdings were modified are retried, up to
+        TRADES_RETRIES times in total.
+
+        Args:
+            legs_by_user (dict[str:list[(int, float)]]): Asset ids and
+                quantities to buy (positive) or sell (negative) by user.
+            all_or_nothing (bool): If true, no leg of a user is persisted
+                                   if one of them fails, otherwise only
+                                   the failed legs are skipped.
+
+        Returns:
+            codes (dict[str:list[int]]): TRADE_* code of each leg by user.
+                With all_or_nothing, the legs after a failed one are
+                not attempted and get the TRADE_OK code.
+    """
+    results = dict()
+    pending = dict(legs_by_user)
+    for _ in range(TRADES_RETRIES):
+        if not pending:
+            break
+        users = list(pending)
+        asset_ids = dict((user, sorted(set(ID for ID, Q in pending[user]))) for user in users)
+        pipe = redis_server.pipeline(transaction=False)
+        for user in users:
+            pipe.hmget("user_"+user, ["name", "data"])
+            pipe.hmget("holdings_"+user, asset_ids[user])
+        reads = pipe.execute()
+        writes = []
+        for user, (username, data), quantities in zip(users, reads[::2], reads[1::2]):
+            legs = pending[user]
+            holdings = dict((str(ID), q) for ID, q in zip(asset_ids[user], quantities) if q is not None)
+            if not username:
+                results[user] = [TRADE_USER_NOT_FOUND] * len(legs)
+                del pending[user]
+                continue
+            if data: # legacy layout, migrated before trading
+                migrate_user_holdings(user, data)
+                continue
+            portfolio = Portfolio.from_holdings(user, [(int(ID), float(q)) for ID, q in holdings.iteritems()])
+            codes = [TRADE_OK] * len(legs)
+            for i, (ID, Q) in enumerate(legs):
+                try:
+                    portfolio.buy_sell(ID, Q)
+                except AssetNotFoundException:
+                    codes[i] = TRADE_ASSET_NOT_FOUND
+                except NegativeAssetException:
+                    codes[i] = TRADE_NEGATIVE
+                except InvalidQuantityException:
+                    codes[i] = TRADE_INVALID_QUANTITY
+                if codes[i] != TRADE_OK and all_or_nothing:
+                    break
+            results[user] = codes
+            traded = set(ID for (ID, Q), code in zip(legs, codes) if code == TRADE_OK)
+            if not traded or (all_or_nothing and codes.count(TRADE_OK) != len(codes)):
+                del pending[user]
+                continue
+            args = [user]
+            for ID in sorted(traded):
+                held = portfolio.assets.get(ID)
+                args += [ID, holdings.get(str(ID), ''), repr(float(held.quantity)) if held else '']
+            writes.append((user, args))
+        def queue(pipe):
+            for user, args in writes:
+                run_lua_script("apply_trades", ["user_"+user, "holdings_"+user], args, pipe)
+        for (user, args), code in zip(writes, execute_scripts(queue) if writes else []):
+            if code in (TRADE_USER_NOT_FOUND, TRADE_INVALID_QUANTITY):
+                results[user] = [code] * len(pending[user])
+            if code not in (TRADE_CONFLICT, TRADE_LEGACY_DATA):
+                del pending[user]
+    for user, legs in pending.iteritems():
+        results[user] = [TRADE_CONFLICT] * len(legs)
+    return results
+
+def trade_error(code, user, asset_id, quantity):
+    """Describes the error of a trade from its TRADE_* code.
+
+        Args:
+            code (int): TRADE_* code returned for the trade.
+            user (str): Name of the user.
+            asset_id (int): Unique asset id of the trade.
+            quantity (float): Quantity bought (positive) or sold (negative).
+
+        Returns:
+            (message, rc) (dict, int): Error message and response status
+                                       code, or None and HTTP_200_OK.
+    """
+    if code == TRADE_USER_NOT_FOUND:
+        return {'error' : 'User {0} not found'.format(user)}, HTTP_404_NOT_FOUND
+    if code == TRADE_ASSET_NOT_FOUND:
+        return {'error' : 'Asset with id {0} was not found in the portfolio of {1}.'.format(asset_id, user)}, HTTP_404_NOT_FOUND
+    if code == TRADE_NEGATIVE:
+        return {'error' : 'Selling {0} units of the asset with id {1} in the portfolio of {2} would result in a negative quantity. The operation was aborted.'.format(-quantity, asset_id, user)}, HTTP_400_BAD_REQUEST
+    if code == TRADE_CONFLICT:
+        return {'error' : 'The portfolio of {0} was modified concurrently too many times. The operation was aborted.'.format(user)}, HTTP_409_CONFLICT
+    if code == TRADE_INVALID_QUANTITY:
+        return {'error' : 'Buying {0} units of the asset with id {1} in the portfolio of {2} would result in a value out of range. The operation was aborted.'.format(quantity, asset_id, user)}, HTTP_400_BAD_REQUEST
+    return None, HTTP_200_OK
+
+def apply_trades_batch(trades):
+    """Validates and applies a batch of trades of several users.
+
+        The trades are grouped per user, keeping their order, and applied
+        with trade_portfolios, a failed trade being skipped.
+
+        Args:
+            trades (list): Trades as parsed from the request, expected to
+                           be dictionaries with a user, an asset_id and a
+                           quantity.
+
+        Returns:
+            results (list[dict]): Status, and error message if it failed,
+                                  of each trade.
+    """
+    results = [None] * len(trades)
+    legs_by_user = dict()
+    indexes_by_user = dict()
+    parsed = []
+    for i, trade in enumerate(trades):
+        try:
+            parsed.append((i, unicode(trade['user']), int(trade['asset_id']), parse_quantity(trade['quantity'])))
+        except (TypeError, KeyError, ValueError):
+            results[i] = {'status' : HTTP_400_BAD_REQUEST, 'error' : 'Trade {0} is not valid'.format(trade)}
+    asset_catalog.prefetch([asset_id for i, user, asset_id, quantity in parsed])
+    for i, user, asset_id, quantity in parsed:
+        if asset_catalog.get(asset_id) is None:
+            results[i] = {'status' : HTTP_400_BAD_REQUEST, 'error' : 'Asset id {0} does not exist in database'.format(asset_id)}
+            continue
+        legs_by_user.setdefault(user, []).append((asset_id, quantity))
+        indexes_by_user.setdefault(user, []).append(i)
+    codes = trade_portfolios(legs_by_user, all_or_nothing=False) if legs_by_user else {}
+    for user, indexes in indexes_by_user.iteritems():
+        for i, (asset_id, quantity), code in zip(indexes, legs_by_user[user], codes[user]):
+            message, rc = trade_error(code, user, asset_id, quantity)
+            results[i] = dict(message or {}, status=rc)
+    return results
+
+
 ######################################################################
 # UTILITY FUNCTIONS
 ######################################################################
@@ -729,6 +3366,260 @@ def reply(message, rc):
     response.status_code = rc
     return response
 
+def load_portfolio(user):
+    """Loads the portfolio of a user with one pipelined round trip.
+
+        Args:
+            user (str): Name of the user.
+
+        Returns:
+            portfolio (Portfolio): Portfolio of the user or None if the
+                                   user does not exist.
+    """
+    portfolios = load_portfolios([user])
+    if not portfolios:
+        return None
+    return portfolios[0]
+
+def load_portfolios(users):
+    """Loads the portfolios of several users with one pipelined round trip.
+
+        The holdings are read from the holdings_* hashes, or from the
+        legacy data field of the user_* hashes if not migrated yet. Users
+        that do not exist (anymore) are skipped.
+
+        Args:
+            users (list[str]): Names of the users.
+
+        Returns:
+            portfolios (list[Portfolio]): Portfolios of the existing users.
+    """
+    pipe = redis_server.pipeline(transaction=False)
+    for user in users:
+        pipe.hmget("user_"+user, ["name", "data"])
+        pipe.hgetall("holdings_"+user)
+    results = pipe.execute()
+    portfolios = []
+    for user, (username, data), holdings in zip(users, results[::2], results[1::2]):
+        if username:
+            if data: # legacy layout, not migrated yet
+                portfolio = Portfolio.deserialize(data)
+            else:
+                portfolio = Portfolio.from_holdings(user, [(int(ID), float(q)) for ID, q in holdings.iteritems()])
+            portfolios.append(portfolio)
+    return portfolios
+
+def page_arguments():
+    """Reads the cursor and limit query parameters of a paginated request.
+
+        The limit is capped to PORTFOLIOS_PAGE_LIMIT_MAX.
+
+        Returns:
+            (cursor, limit) (int, int): Cursor, 0 for the first page, and
+                                        size of the page.
+
+        Raises:
+            ValueError: If the cursor or the limit is not valid.
+    """
+    cursor = request.args.get('cursor')
+    limit = request.args.get('limit')
+    try:
+        cursor = int(cursor or 0)
+        limit = int(limit or PORTFOLIOS_PAGE_LIMIT)
+    except ValueError:
+        raise ValueError('The cursor {0} and the limit {1} must be integers'.format(cursor, limit))
+    if cursor < 0 or limit <= 0:
+        raise ValueError('The cursor {0} and the limit {1} must be positive'.format(cursor, limit))
+    return cursor, min(limit, PORTFOLIOS_PAGE_LIMIT_MAX)
+
+def page_links(path, cursor, limit, query=None):
+    """Returns the link of a page to the following one.
+
+        Args:
+            path (str): Path of the resource after the API version.
+            cursor (int, str): Cursor of the next page, 0 if there is none.
+            limit (int): Size of the page.
+            query (dict, None): Other query parameters to keep.
+
+        Returns:
+            links (list[dict]): A "next" link if there is a following page.
+    """
+    if str(cursor) == '0':
+        return []
+    query = dict(query or {}, cursor=cursor, limit=limit)
+    return [{"rel" : "next", "href" : request.url_root[:-1] + url_version + path + "?" + url_encode(query, sort=True)}]
+
+def sscan_page(key, path, query=None):
+    """Reads one page of a set with SSCAN.
+
+        The page is given by the cursor and limit query parameters of the
+        request. The limit is only a hint of the page size for Redis.
+
+        Args:
+            key (str): Key of the set.
+            path (str): Path of the resource after the API version, used
+                        for the link to the next page.
+            query (dict, None): Other query parameters of the next page.
+
+        Returns:
+            (members, links) (list[str], list[dict]): Members of the page
+                and a "next" link if there is a following page.
+
+        Raises:
+            ValueError: If the cursor or the limit is not valid.
+    """
+    cursor, limit = page_arguments()
+    cursor, members = redis_server.sscan(key, cursor, count=limit)
+    return list(members), page_links(path, cursor, limit, query)
+
+def search_assets(prefix, asset_class=None, query=None):
+    """Reads one page of the assets_names index with the search_assets script.
+
+        The page starts after the cursor query parameter, the URL safe
+        base64 (without padding) of the last assets_names member read
+        (normalized name and id), or at the first name without it. Renaming assets between
+        two pages neither skips nor repeats the other assets. With an
+        asset class, at most ASSETS_SEARCH_SCAN_MAX names are read for a
+        page, so it may hold fewer assets than the limit while there is
+        a "next" link.
+
+        Args:
+            prefix (str): Normalized prefix of the names, or empty.
+            asset_class (str, None): Class of the assets, or None for all.
+            query (dict, None): Other query parameters of the next page.
+
+        Returns:
+            (asset_ids, links) (list[int], list[dict]): Asset ids of the
+                page in name order and a "next" link if there is a
+                following page.
+
+        Raises:
+            ValueError: If the cursor or the limit is not valid.
+    """
+    cursor = request.args.get('cursor', '')
+    limit = request.args.get('limit')
+    try:
+        limit = int(limit or PORTFOLIOS_PAGE_LIMIT)
+    except ValueError:
+        raise ValueError('The limit {0} must be an integer'.format(limit))
+    if limit <= 0:
+        raise ValueError('The limit {0} must be positive'.format(limit))
+    limit = min(limit, PORTFOLIOS_PAGE_LIMIT_MAX)
+    after = ''
+    if cursor:
+        try:
+            after = urlsafe_b64decode(cursor.encode('ascii') + '=' * (-len(cursor) % 4))
+        except (TypeError, UnicodeEncodeError):
+            raise ValueError('The cursor {0} is not valid'.format(cursor))
+        if not after.startswith(prefix) or '\0' not in after or not after.rsplit('\0', 1)[1].isdigit():
+            raise ValueError('The cursor {0} is not valid'.format(cursor))
+    keys = ["assets_names"] + (["assets_class_"+asset_class] if asset_class is not None else [])
+    found = run_lua_script("search_assets", keys, [prefix, after, limit, ASSETS_SEARCH_SCAN_MAX])
+    cursor = urlsafe_b64encode(found[0]).rstrip('=') if found[0] else 0
+    return [int(asset_id) for asset_id in found[1:]], page_links("/assets", cursor, limit, query)
+
+def normalize_asset_name(name):
+    """Normalizes an asset name for the assets_names index.
+
+        Whitespace runs are replaced by a single space, leading and
+        trailing whitespace removed and ASCII letters lowercased, as with
+        the asset_member Lua function.
+
+        Args:
+            name (str, unicode): Name of an asset or prefix searched.
+
+        Returns:
+            normalized (str): UTF-8 encoded normalized name.
+    """
+    if isinstance(name, unicode):
+        name = name.encode("utf-8")
+    return " ".join(name.split()).lower()
+
+def exposure_values(exposure):
+    """Converts the fields of an exposure hash to floats.
+
+        Exposures closer to 0 than EXPOSURE_EPSILON are float residues of
+        positions closed, and are left out.
+
+        Args:
+            exposure (dict[str:str]): Values by asset class or asset id.
+
+        Returns:
+            exposure (dict[str:float]): Values by asset class or asset id.
+    """
+    exposure = dict((key, float(value)) for key, value in exposure.iteritems())
+    return dict((key, value) for key, value in exposure.iteritems() if abs(value) > EXPOSURE_EPSILON)
+
+def parse_ndjson(lines):
+    """Parses JSON lines one at a time, without reading them all.
+
+        Args:
+            lines (iterable[str]): Lines of JSON values, blank lines being
+                                   skipped.
+
+        Yields:
+            value: Each parsed value, or the stripped line if it is not
+                   valid JSON, for the caller to report.
+    """
+    for line in lines:
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield line.strip()
+
+def parse_asset(row):
+    """Validates an asset row of an import.
+
+        Args:
+            row (dict): Row with an id, a name, a class and a price, as
+                        parsed from CSV (strings) or JSON.
+
+        Returns:
+            asset (tuple): Id (int), name, class and price (float).
+
+        Raises:
+            ValueError: If a field is missing or not valid.
+    """
+    try:
+        asset_id, name, asset_class, price = int(row['id']), row['name'], row['class'], float(row['price'])
+    except (TypeError, KeyError, ValueError):
+        raise ValueError('Asset {0} is not valid'.format(row))
+    if asset_id < 0:
+        raise ValueError('Asset id {0} must be positive'.format(asset_id))
+    if not isinstance(name, basestring) or not name.strip() or not isinstance(asset_class, basestring) or not asset_class.strip():
+        raise ValueError('Asset {0} must have a name and a class'.format(asset_id))
+    if math.isinf(price) or math.isnan(price):
+        raise ValueError('Price value of asset {0} is not a finite number'.format(asset_id))
+    if price < 0:
+        raise ValueError('Price value of asset {0} must be positive'.format(asset_id))
+    return asset_id, name.strip(), asset_class.strip(), price
+
+def parse_quantity(value):
+    """Converts the quantity of a payload to a finite float.
+
+        JSON numbers out of range like 1e400 are decoded as infinity, and
+        the Lua scripts could not add them to the NAV and the exposures.
+
+        Args:
+            value: Quantity of the payload.
+
+        Returns:
+            quantity (float): The quantity.
+
+        Raises:
+            ValueError: If the quantity is not a number, or is infinite or
+                        NaN.
+    """
+    try:
+        quantity = float(value)
+    except (TypeError, ValueError):
+        raise ValueError('Quantity {0} is not a number'.format(value))
+    if math.isinf(quantity) or math.isnan(quantity):
+        raise ValueError('Quantity {0} is not a finite number'.format(value))
+    return quantity
+
 def is_valid(data, keys=[]):
     """Verifies the payload received contains all the necessary elements.
 
@@ -811,16 +3702,19 @@ def determine_credentials():
         return Credentials("Docker running in Vagrant", "redis", 6379, None, "localhost:5000")
     return Credentials("Vagrant", "127.0.0.1", 6379, None, "localhost:5000")
 
-def update_swagger_specification(swagger_host):
-    """Generates the JS Swagger from the JSON and update the "host" variable.
+def render_swagger_specification(swagger_host):
+    """Generates the JS Swagger from the JSON with the "host" variable.
 
         It reads the JSON Swagger specification to create the JS Swagger
-        specification in the same directory where the JSON content is
-        assigned to the variable spec and where the "host":"...." is
-        replaced by the swagger_host provided (dynamic hostname).
+        specification where the JSON content is assigned to the variable
+        spec and where the "host":"...." is replaced by the swagger_host
+        provided (dynamic hostname). Nothing is written on disk.
 
         Args:
             swagger_host (str): URL to access the swagger UI.
+
+        Returns:
+            specification (str): The JS Swagger specification.
     """
     spec_dir = os.path.dirname(__file__)
     if len(spec_dir): # Not docker container
@@ -828,47 +3722,576 @@ def update_swagger_specification(swagger_host):
     spec_dir += "static/swagger/specification/"
     with open(spec_dir + "portfolioMgmt.json") as f:
         spec_lines = f.readlines()
-    with open(spec_dir + "portfolioMgmt.js", 'w') as f:
-        f.write("var spec = ")
-        for i in range(len(spec_lines)):
-            if '"host"' in spec_lines[i] and i < 20:
-                pos = spec_lines[i].find('"host"')
-                spec_lines[i] = spec_lines[i][:pos+6] + ': "'+swagger_host+'",\n'
-            f.write(spec_lines[i])
-        f.write(";")
-
-def init_redis(hostname, port, password):
+    for i in range(min(len(spec_lines), 20)):
+        if '"host"' in spec_lines[i]:
+            pos = spec_lines[i].find('"host"')
+            spec_lines[i] = spec_lines[i][:pos+6] + ': "'+swagger_host+'",\n'
+    return "var spec = " + "".join(spec_lines) + ";"
+
+def init_redis(hostname, port, password, setup=True):
     """Initializes the connection to the Redis server and checks for errors.
 
+        The Lua scripts are loaded and the asset catalog of the process is
+        filled and subscribed to the asset changes. With setup, the common
+        assets and the admin credentials are also written to Redis if they
+        are missing, which only needs to be done once when starting
+        several processes. The client traces the commands of each request
+        unless REDIS_TRACE_ENABLED is false.
+
         Args:
             hostname (str): Hostname of the Redis service.
             port (int): Port of the Redis service.
             password (None, str): Password to access the Redis service.
+            setup (bool): Whether to fill the database with the common
+                          assets and the admin credentials.
 
         Raises:
             RedisConnectionException: If Redis can't be pinged.
     """
     global redis_server
-    redis_server = Redis(host=hostname, port=port, password=password)
+    redis_server = Redis(connection_pool=RedisPool(host=hostname, port=port, password=password))
+    if REDIS_TRACE_ENABLED:
+        redis_server = TracedRedis(redis_server)
     try:
         redis_server.ping()
     except ConnectionError:
         raise RedisConnectionException()
-    fill_database_assets()
-    if SECURED:
-        admin_username = "admin"
-        admin_password = "admin_password"
-        hash_password = generate_password_hash(admin_password)
-        redis_server.hmset("admin_password_"+admin_username, {"hash_password":hash_password})
+    load_lua_scripts()
+    metrics.start()
+    if setup:
+        fill_database_assets()
+        if SECURED:
+            fill_database_admin()
+    asset_catalog.load()
+    asset_catalog.subscribe()
+
+def create_app(setup=True):
+    """WSGI application factory.
+
+        Connects the process to Redis with the credentials of the
+        environment, renders the Swagger specification and returns the
+        Flask application, for instance to run it with gunicorn
+        "server:create_app()". The cold start time is printed, and the
+        warnings of the application, like the requests over their Redis
+        round trips budget, are written to stderr.
+
+        Args:
+            setup (bool): Whether to fill the database with the common
+                          assets and the admin credentials.
+
+        Returns:
+            app (Flask): The WSGI application.
+
+        Raises:
+            RedisConnectionException: If Redis can't be pinged.
+    """
+    global swagger_specification
+    creds = determine_credentials()
+    init_redis(creds.host, creds.port, creds.password, setup)
+    swagger_specification = render_swagger_specification(creds.swagger_host)
+    if not app.debug: # the Flask logger only writes in debug mode
+        handler = logging.StreamHandler()
+        handler.setLevel(logging.WARNING)
+        app.logger.addHandler(handler)
+    print("Process {0} started in {1:.0f} ms".format(os.getpid(), (time.time() - STARTED_AT) * 1000))
+    return app
+
+def serve(port, workers, threads):
+    """Serves the API with a pre-forking gunicorn server.
+
+        The caller does the startup work (database setup, Swagger
+        specification) once in the master process. Each worker imports
+        this module and calls create_app after the fork, so it has its
+        own Redis connections, asset catalog and subscriber thread, and
+        runs the code on disk when it starts: a SIGHUP to the master
+        starts new workers and stops the old ones gracefully, after
+        their current requests, without dropping connections.
+
+        Args:
+            port (int): Port to listen on.
+            workers (int): Number of worker processes.
+            threads (int): Number of threads per worker.
+    """
+    def worker_exit(arbiter, worker):
+        process = __import__("server")
+        process.asset_catalog.unsubscribe()
+        process.metrics.flush()
+
+    class Application(gunicorn.app.base.BaseApplication):
+        def load_config(self):
+            self.cfg.set("bind", "0.0.0.0:{0}".format(port))
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            self.cfg.set("timeout", SERVER_TIMEOUT)
+            self.cfg.set("graceful_timeout", SERVER_GRACEFUL_TIMEOUT)
+            self.cfg.set("proc_name", "portfoliomgmt")
+            self.cfg.set("worker_exit", worker_exit)
+
+        def load(self):
+            return __import__("server").create_app(setup=False)
+
+    asset_catalog.unsubscribe() # only the workers serve requests
+    Application().run()
+
+def serve_async(port, workers, connections):
+    """Serves the API with gunicorn gevent workers.
+
+        Each request runs in a greenlet which yields to the others while
+        it waits for Redis or for the client, so a worker serves up to
+        connections clients at the same time with the same routes and
+        domain model. gevent must patch the standard library before
+        redis is imported, which this process already did, so after the
+        startup work done by the caller, this process is replaced by a
+        new gunicorn master which imports nothing of the application.
+        The workers then behave as with serve, including the reload on
+        SIGHUP.
+
+        Args:
+            port (int): Port to listen on.
+            workers (int): Number of worker processes.
+            connections (int): Number of concurrent clients per worker.
+    """
+    os.execv(sys.executable, [sys.executable, "-m", "gunicorn.app.wsgiapp",
+                              "--bind", "0.0.0.0:{0}".format(port),
+                              "--workers", str(workers),
+                              "--worker-class", "gevent",
+                              "--worker-connections", str(connections),
+                              "--timeout", str(SERVER_TIMEOUT),
+                              "--graceful-timeout", str(SERVER_GRACEFUL_TIMEOUT),
+                              "--name", "portfoliomgmt",
+                              "--chdir", os.path.dirname(os.path.abspath(__file__)),
+                              "server:create_app(setup=False)"])
 
 def fill_database_assets():
     """Fill the Redis database with common assets to all users.
 
+        Nothing is written if the database was already filled with this
+        SEED_VERSION, so restarting the processes costs one round trip.
+        Otherwise the assets are written and indexed in a single
+        transaction, where the price of an existing asset is kept as it
+        may have changed since, and the asset catalogs are notified.
+    """
+    if int(redis_server.get(SEED_VERSION_KEY) or 0) >= SEED_VERSION:
+        return
+    assets = [
+        {"id": 0,"name":"gold","price":1286.59,"class":"commodity"},
+        {"id": 1,"name":"NYC real estate index","price":16255.18,"class":"real-estate"},
+        {"id": 2,"name":"brent crude oil","price":51.45,"class":"commodity"},
+        {"id": 3,"name":"US 10Y T-Note","price":130.77,"class":"fixed income"}
+        ]
+    def queue(pipe):
+        run_lua_script("seed_assets", ["asset_id_"+str(asset["id"]) for asset in assets],
+                       [value for asset in assets for value in (asset["id"], asset["name"], asset["class"], asset["price"])], pipe)
+        pipe.set(SEED_VERSION_KEY, SEED_VERSION)
+        pipe.incr(ASSET_CATALOG_VERSION)
+        pipe.publish(ASSET_CATALOG_CHANNEL, ",".join(str(asset["id"]) for asset in assets))
+    execute_scripts(queue, transaction=True)
+    asset_catalog.invalidate([asset["id"] for asset in assets])
+
+def fill_database_admin():
+    """Writes the credentials of the admin user if they are missing.
+
+        The password is only hashed, which is slow on purpose, when the
+        admin user does not exist yet.
+    """
+    admin_username = "admin"
+    admin_password = "admin_password"
+    if not redis_server.hexists("admin_password_"+admin_username, "hash_password"):
+        hash_password = generate_password_hash(admin_password)
+        redis_server.hsetnx("admin_password_"+admin_username, "hash_password", hash_password)
+
+def set_asset_prices(prices):
+    """Sets the price of assets and revalues the portfolios holding them.
+
+        The prices are written with one pipelined round trip. For each
+        asset, the price is written and the NAV of each holder found in
+        the holders_* index is adjusted by quantity * (new price - old
+        price) in the same Lua script. A price is not written at all if
+        the value of a holding or a NAV would not be a finite number.
+
+        Args:
+            prices (dict[int:float]): New price by asset id.
+
+        Returns:
+            (portfolios, rejected) (int, list[int]): Number of portfolios
+                revalued and ids of the assets whose price was not set.
+    """
+    if not prices:
+        return 0, []
+    asset_ids = list(prices)
+    def queue(pipe):
+        for asset_id in asset_ids:
+            run_lua_script("set_price", ["asset_id_"+str(asset_id), "holders_"+str(asset_id)], [asset_id, repr(float(prices[asset_id]))], pipe)
+    results = execute_scripts(queue)
+    rejected = sorted(asset_id for asset_id, users in zip(asset_ids, results) if users == TRADE_INVALID_QUANTITY)
+    revalued = [users for users in results if users != TRADE_INVALID_QUANTITY]
+    if len(rejected) < len(asset_ids):
+        notify_asset_change(sorted(set(asset_ids) - set(rejected)))
+    return len(set(user for users in revalued for user in users)), rejected
+
+def import_assets(rows, batch_size=ASSETS_IMPORT_BATCH_SIZE):
+    """Creates or updates the assets of an import, in batches.
+
+        The rows are consumed as they are read, so the memory used only
+        depends on batch_size. Each batch is written with one pipelined
+        round trip of upsert_assets scripts, each one writing up to
+        ASSETS_IMPORT_SCRIPT_SIZE assets to save the encoding of as many
+        commands. The script writes each asset and, if the price or the
+        class of an existing asset changed, revalues its holders and
+        moves their exposures. The asset catalogs are then notified.
+        Invalid rows are skipped and reported, as well as the assets
+        whose price would put the value of a holding or a NAV out of
+        range, which the script leaves unchanged.
+
+        Args:
+            rows (iterable[dict]): Rows with an id, a name, a class and a
+                                   price.
+            batch_size (int): Number of assets per batch.
+
+        Returns:
+            report (dict): Number of rows read, of assets created and
+                           updated, of invalid rows and the errors of the
+                           first ASSETS_IMPORT_ERRORS_MAX invalid rows.
+    """
+    report = {"read" : 0, "created" : 0, "updated" : 0, "invalid" : 0, "errors" : []}
+    batch = []
+    for row in rows:
+        report["read"] += 1
+        try:
+            batch.append((report["read"], parse_asset(row)))
+        except ValueError as error:
+            report["invalid"] += 1
+            if len(report["errors"]) < ASSETS_IMPORT_ERRORS_MAX:
+                report["errors"].append('Row {0}: {1}'.format(report["read"], error))
+        if len(batch) == batch_size:
+            import_assets_batch(batch, report)
+            batch = []
+    import_assets_batch(batch, report)
+    return report
+
+def import_assets_batch(assets, report):
+    """Writes a batch of validated assets and counts them in a report.
+
+        Args:
+            assets (list[tuple]): Row number and id, name, class and price
+                                  of each asset.
+            report (dict): Report of import_assets to update.
+    """
+    if not assets:
+        return
+    def queue(pipe):
+        for start in range(0, len(assets), ASSETS_IMPORT_SCRIPT_SIZE):
+            keys, args = [], []
+            for _, (asset_id, name, asset_class, price) in assets[start:start+ASSETS_IMPORT_SCRIPT_SIZE]:
+                keys += ["asset_id_"+str(asset_id), "holders_"+str(asset_id)]
+                args += [asset_id, name, asset_class, repr(price)]
+            run_lua_script("upsert_assets", keys, args, pipe)
+    results = [result for results in execute_scripts(queue) for result in results]
+    written = []
+    for (row, asset), result in zip(assets, results):
+        if result == TRADE_INVALID_QUANTITY:
+            report["invalid"] += 1
+            if len(report["errors"]) < ASSETS_IMPORT_ERRORS_MAX:
+                report["errors"].append('Row {0}: The price of asset {1} would put the value of a holding or a NAV out of range'.format(row, asset[0]))
+        else:
+            report["created" if result else "updated"] += 1
+            written.append(asset[0])
+    if written:
+        notify_asset_change(sorted(set(written)))
+
+def scan_batches(match, batch_size):
+    """Iterates over the keys matching a pattern, in batches.
+
+        Args:
+            match (str): Glob-style pattern of the keys.
+            batch_size (int): Number of keys per batch.
+
+        Yields:
+            keys (list[str]): Up to batch_size keys.
+    """
+    keys = []
+    for key in redis_server.scan_iter(match=match, count=batch_size):
+        keys.append(key)
+        if len(keys) == batch_size:
+            yield keys
+            keys = []
+    if keys:
+        yield keys
+
+def fetch_asset_prices(asset_ids):
+    """Reads the prices of assets from Redis in one pipelined round trip.
+
+        The prices are the ones the Lua scripts value the holdings with,
+        unlike those of the asset catalog, which may be stale.
+
+        Args:
+            asset_ids (iterable[int]): Unique asset ids.
+
+        Returns:
+            prices (dict): Price (float) of each asset id that exists.
+    """
+    asset_ids = sorted(set(asset_ids))
+    if not asset_ids:
+        return dict()
+    pipe = redis_server.pipeline(transaction=False)
+    for asset_id in asset_ids:
+        pipe.hget("asset_id_"+str(asset_id), "price")
+    return dict((asset_id, float(price)) for asset_id, price in zip(asset_ids, pipe.execute()) if price is not None)
+
+def migrate_portfolios_encoding(batch_size=MIGRATION_BATCH_SIZE):
+    """Rewrites the legacy data of every user_* hash in the compact format.
+
+        The user_* keys are scanned in batches of batch_size. The data of a
+        batch is read with one pipelined round trip and the converted data
+        is written back with another one, each write only being applied if
+        the data was not modified meanwhile, so the service can keep
+        running during the migration.
+
+        Args:
+            batch_size (int): Number of user_* keys per batch.
+
+        Returns:
+            report (dict): Number of portfolios scanned, migrated and
+                           skipped, and Redis used memory before and after.
+    """
+    load_lua_scripts()
+    report = {"scanned" : 0, "migrated" : 0, "skipped" : 0}
+    report["usedMemoryBefore"] = redis_server.info("memory")["used_memory"]
+    for keys in scan_batches("user_*", batch_size):
+        pipe = redis_server.pipeline(transaction=False)
+        for key in keys:
+            pipe.hget(key, "data")
+        legacy = [(key, data) for key, data in zip(keys, pipe.execute()) if data and not Portfolio.is_compact(data)]
+        report["scanned"] += len(keys)
+        if not legacy:
+            continue
+        def queue(pipe):
+            for key, data in legacy:
+                run_lua_script("replace_data", [key], [data, Portfolio.encode(*Portfolio.decode(data))], pipe)
+        replaced = execute_scripts(queue)
+        report["migrated"] += sum(replaced)
+        report["skipped"] += len(replaced) - sum(replaced)
+    report["usedMemoryAfter"] = redis_server.info("memory")["used_memory"]
+    return report
+
+def holdings_arguments(data):
+    """Prepares the arguments of LUA_MIGRATE_HOLDINGS for a data blob.
+
+        Args:
+            data (str): Compact or legacy serialized data of a user_* hash.
+
+        Returns:
+            (args, holdings) (list[str], list[(int, float)]): Script
+                arguments and holdings decoded from the data.
     """
-    redis_server.hmset("asset_id_0", {"id": 0,"name":"gold","price":1286.59,"class":"commodity"})
-    redis_server.hmset("asset_id_1", {"id": 1,"name":"NYC real estate index","price":16255.18,"class":"real-estate"})
-    redis_server.hmset("asset_id_2", {"id": 2,"name":"brent crude oil","price":51.45,"class":"commodity"})
-    redis_server.hmset("asset_id_3", {"id": 3,"name":"US 10Y T-Note","price":130.77,"class":"fixed income"})
+    holdings = Portfolio.decode(data)[1]
+    args = [data]
+    for ID, q in holdings:
+        args += [ID, repr(q)]
+    return args, holdings
+
+def migrate_user_holdings(user, data=None):
+    """Moves the data blob of a user to its holdings_* hash.
+
+        The move is done atomically and only if the data was not modified
+        meanwhile, otherwise the data is read again.
+
+        Args:
+            user (str): Name of the user.
+            data (str, None): Data of the user_* hash, as last read, or
+                              None to read it.
+
+        Returns:
+            holdings (list[(int, float)]): Asset ids and quantities moved.
+    """
+    if data is None:
+        data = redis_server.hget("user_"+user, "data")
+    holdings = []
+    while data:
+        args, holdings = holdings_arguments(data)
+        if run_lua_script("migrate_holdings", ["user_"+user, "holdings_"+user], args):
+            break
+        data = redis_server.hget("user_"+user, "data")
+    return holdings
+
+def migrate_holdings(batch_size=MIGRATION_BATCH_SIZE):
+    """Moves the data blob of every user_* hash to its holdings_* hash.
+
+        The user_* keys are scanned in batches of batch_size, with one
+        pipelined round trip to read the data of a batch and one to move
+        it, each move only being applied if the data was not modified
+        meanwhile. The service keeps working during the migration since
+        it reads both layouts.
+
+        Args:
+            batch_size (int): Number of user_* keys per batch.
+
+        Returns:
+            report (dict): Number of portfolios scanned, migrated and
+                           skipped.
+    """
+    load_lua_scripts()
+    report = {"scanned" : 0, "migrated" : 0, "skipped" : 0}
+    for keys in scan_batches("user_*", batch_size):
+        pipe = redis_server.pipeline(transaction=False)
+        for key in keys:
+            pipe.hget(key, "data")
+        legacy = [(key, data) for key, data in zip(keys, pipe.execute()) if data]
+        report["scanned"] += len(keys)
+        if not legacy:
+            continue
+        def queue(pipe):
+            for key, data in legacy:
+                run_lua_script("migrate_holdings", [key, "holdings_"+key[len("user_"):]], holdings_arguments(data)[0], pipe)
+        migrated = execute_scripts(queue)
+        report["migrated"] += sum(migrated)
+        report["skipped"] += len(migrated) - sum(migrated)
+    return report
+
+def verify_navs(batch_size=MIGRATION_BATCH_SIZE, repair=False):
+    """Recomputes the NAV of every portfolio and compares it to the stored one.
+
+        The user_* keys are scanned in batches of batch_size, with one
+        pipelined round trip per batch to read the stored NAVs and the
+        holdings, and another one to read the prices of the assets held
+        from their asset_id_* hashes, as the Lua scripts do. A NAV drifts if it differs from the recomputed one by
+        more than NAV_DRIFT_TOLERANCE relatively. Portfolios still in the
+        legacy data blob have no stored NAV and are only counted.
+
+        Args:
+            batch_size (int): Number of user_* keys per batch.
+            repair (bool): Whether to store the recomputed NAV of drifted
+                           portfolios and of those without NAV.
+
+        Returns:
+            report (dict): Number of portfolios scanned, legacy, without
+                           NAV, drifted and repaired, largest drift and
+                           names of (up to 100) drifted users.
+    """
+    report = {"scanned" : 0, "legacy" : 0, "missing" : 0, "drifted" : 0, "repaired" : 0, "maxDrift" : 0.0, "users" : []}
+    for keys in scan_batches("user_*", batch_size):
+        users = [key[len("user_"):] for key in keys]
+        pipe = redis_server.pipeline(transaction=False)
+        for user in users:
+            pipe.hmget("user_"+user, ["name", "data", "nav"])
+            pipe.hgetall("holdings_"+user)
+        results = pipe.execute()
+        holdings = [[(int(ID), float(q)) for ID, q in h.iteritems()] for h in results[1::2]]
+        prices = fetch_asset_prices(ID for h in holdings for ID, _ in h)
+        stale = []
+        for user, (username, data, nav), held in zip(users, results[::2], holdings):
+            if not username:
+                continue
+            report["scanned"] += 1
+            if data:
+                report["legacy"] += 1
+                continue
+            if nav is None:
+                report["missing"] += 1
+                stale.append(user)
+                continue
+            expected = sum(q * prices.get(ID, 0.0) for ID, q in held)
+            drift = abs(float(nav) - expected)
+            if drift > NAV_DRIFT_TOLERANCE * max(1.0, abs(expected)):
+                report["drifted"] += 1
+                report["maxDrift"] = max(report["maxDrift"], drift)
+                if len(report["users"]) < 100:
+                    report["users"].append(user)
+                stale.append(user)
+        if repair and stale:
+            def queue(pipe):
+                for user in stale:
+                    run_lua_script("refresh_nav", ["user_"+user, "holdings_"+user], [user], pipe)
+            report["repaired"] += len([nav for nav in execute_scripts(queue) if nav is not None])
+    return report
+
+def rebuild_holders(batch_size=MIGRATION_BATCH_SIZE):
+    """Regenerates the holders_* index from the holdings of every user.
+
+        The user_* keys are scanned in batches of batch_size, with one
+        pipelined round trip to read the holdings of a batch (from the
+        holdings_* hash or the legacy data blob) and one to add the users
+        to the holders_* sets. The holders_* sets are then scanned in
+        batches and the users not holding the asset anymore are removed,
+        each check being atomic, so the service can keep running.
+
+        Args:
+            batch_size (int): Number of keys per batch.
+
+        Returns:
+            report (dict): Number of users scanned and of index entries
+                           added and removed.
+    """
+    report = {"scanned" : 0, "added" : 0, "removed" : 0}
+    for keys in scan_batches("user_*", batch_size):
+        users = [key[len("user_"):] for key in keys]
+        pipe = redis_server.pipeline(transaction=False)
+        for user in users:
+            pipe.hget("user_"+user, "data")
+            pipe.hkeys("holdings_"+user)
+        results = pipe.execute()
+        pipe = redis_server.pipeline(transaction=False)
+        for user, data, asset_ids in zip(users, results[::2], results[1::2]):
+            if data: # legacy layout, not migrated yet
+                asset_ids = [ID for ID, _ in Portfolio.decode(data)[1]]
+            for asset_id in asset_ids:
+                pipe.sadd("holders_"+str(asset_id), user)
+        report["scanned"] += len(users)
+        report["added"] += sum(pipe.execute())
+    for keys in scan_batches("holders_*", batch_size):
+        pipe = redis_server.pipeline(transaction=False)
+        for key in keys:
+            pipe.smembers(key)
+        members = pipe.execute()
+        def queue(pipe):
+            for key, users in zip(keys, members):
+                run_lua_script("prune_holders", [key], [key[len("holders_"):]] + list(users), pipe)
+        report["removed"] += sum(execute_scripts(queue))
+    return report
+
+def rebuild_exposure(batch_size=MIGRATION_BATCH_SIZE):
+    """Recomputes the NAV and the exposures of every portfolio.
+
+        The user_* keys are scanned in batches of batch_size, with one
+        pipelined round trip to run the refresh_nav script for each user
+        of a batch. The script removes the previous exposures of the user
+        from the book before adding the new ones, so the service can keep
+        running. It must be run once after upgrading, for the portfolios
+        whose NAV was stored before their exposures were maintained.
+
+        Args:
+            batch_size (int): Number of keys per batch.
+
+        Returns:
+            report (dict): Number of portfolios refreshed.
+    """
+    report = {"refreshed" : 0}
+    for keys in scan_batches("user_*", batch_size):
+        def queue(pipe):
+            for key in keys:
+                user = key[len("user_"):]
+                run_lua_script("refresh_nav", [key, "holdings_"+user], [user], pipe)
+        report["refreshed"] += len([nav for nav in execute_scripts(queue) if nav is not None])
+    return report
+
+def rebuild_asset_index(batch_size=MIGRATION_BATCH_SIZE):
+    """Adds every asset to the assets_class_* and assets_names indexes.
+
+        The asset_id_* keys are scanned in batches of batch_size, with one
+        round trip to run the index_assets script for a batch. It must be
+        run once after upgrading from a version without these indexes,
+        for GET /api/v1/assets to find the assets written before.
+
+        Args:
+            batch_size (int): Number of keys per batch.
+
+        Returns:
+            report (dict): Number of assets indexed.
+    """
+    report = {"indexed" : 0}
+    for keys in scan_batches("asset_id_*", batch_size):
+        report["indexed"] += int(run_lua_script("index_assets", keys, []))
+    return report
 
 # def fill_database_fakeusers():
     # redis_server.hmset("user_john", {"name": "john","data":""})
@@ -882,12 +4305,62 @@ def fill_database_assets():
 #   M A I N
 ######################################################################
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=app_name)
+    parser.add_argument("command", nargs="?", default="run", choices=["run", "serve", "serve-async", "migrate-encoding", "migrate-holdings", "verify-nav", "rebuild-holders", "rebuild-exposure", "import-assets", "rebuild-asset-index"],
+                        help="run the development server (default), serve with several worker processes (with threads or gevent), migrate the stored portfolios to the compact encoding or to the holdings hashes, verify the stored NAVs, rebuild the index of asset holders, recompute the exposures, import assets from a file or rebuild the indexes of the asset catalog")
+    parser.add_argument("file", nargs="?", help="with import-assets, CSV file (.csv) or JSON lines file of assets")
+    parser.add_argument("--batch-size", type=int, help="number of keys per batch for migrations, of assets per batch for imports")
+    parser.add_argument("--repair", action="store_true", help="with verify-nav, store the recomputed NAV of drifted portfolios")
+    parser.add_argument("--workers", type=int, default=SERVER_WORKERS, help="with serve, number of worker processes")
+    parser.add_argument("--threads", type=int, default=SERVER_THREADS, help="with serve, number of threads per worker")
+    parser.add_argument("--connections", type=int, default=SERVER_CONNECTIONS, help="with serve-async, number of concurrent clients per worker")
+    args = parser.parse_args()
+    if args.command == "import-assets" and args.file is None:
+        parser.error("import-assets requires a file")
+    if args.batch_size is None:
+        args.batch_size = ASSETS_IMPORT_BATCH_SIZE if args.command == "import-assets" else MIGRATION_BATCH_SIZE
+    if args.command in ["serve", "serve-async"] and gunicorn is None:
+        print("The {0} command requires gunicorn. Stopping...\n\n".format(args.command))
+        exit(1)
+    if args.command == "serve-async" and gevent is None:
+        print("The serve-async command requires gevent. Stopping...\n\n")
+        exit(1)
     creds = determine_credentials()
     try:
         init_redis(creds.host, creds.port, creds.password)
     except RedisConnectionException:
         print("The server could not connect to Redis. Stopping...\n\n")
         exit(1)
-    update_swagger_specification(creds.swagger_host)
+    if args.command == "migrate-encoding":
+        print(migrate_portfolios_encoding(args.batch_size))
+        exit(0)
+    if args.command == "migrate-holdings":
+        print(migrate_holdings(args.batch_size))
+        exit(0)
+    if args.command == "rebuild-holders":
+        print(rebuild_holders(args.batch_size))
+        exit(0)
+    if args.command == "rebuild-exposure":
+        print(rebuild_exposure(args.batch_size))
+        exit(0)
+    if args.command == "rebuild-asset-index":
+        print(rebuild_asset_index(args.batch_size))
+        exit(0)
+    if args.command == "import-assets":
+        with open(args.file, 'rb') as f:
+            report = import_assets(csv.DictReader(f) if args.file.lower().endswith(".csv") else parse_ndjson(f), args.batch_size)
+        print(report)
+        exit(1 if report["invalid"] else 0)
+    if args.command == "verify-nav":
+        report = verify_navs(args.batch_size, args.repair)
+        print(report)
+        exit(1 if report["drifted"] and not args.repair else 0)
+    swagger_specification = render_swagger_specification(creds.swagger_host)
     port = os.getenv('PORT', '5000')
+    print("Started in {0:.0f} ms".format((time.time() - STARTED_AT) * 1000))
+    if args.command == "serve":
+        serve(int(port), args.workers, args.threads)
+        exit(0)
+    if args.command == "serve-async":
+        serve_async(int(port), args.workers, args.connections)
     app.run(host='0.0.0.0', port=int(port), debug=True)
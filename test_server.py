@@ -1,18 +1,48 @@
 import unittest
+import os
 import json
 import sys
+import fnmatch
+import math
+import struct
+import re
+import logging
+import random
+import threading
 from base64 import b64encode
-from werkzeug.security import generate_password_hash
+from redis import Redis, ConnectionError
+from werkzeug.security import generate_password_hash, check_password_hash
 
 # Status Codes
 HTTP_200_OK = 200
 HTTP_201_CREATED = 201
 HTTP_204_NO_CONTENT = 204
 HTTP_400_BAD_REQUEST = 400
+HTTP_401_UNAUTHORIZED = 401
 HTTP_404_NOT_FOUND = 404
 HTTP_409_CONFLICT = 409
 url_version = "/api/v1"
 
+class FakePipeline(object):
+    def __init__(self, redis):
+        self.redis = redis
+        self.commands = []
+
+    def __getattr__(self, name):
+        method = getattr(self.redis, name)
+        def queue(*args, **kwargs):
+            self.commands.append((method, args, kwargs))
+            return self
+        return queue
+
+    def __len__(self):
+        return len(self.commands) # an empty pipeline is falsy, like in redis-py
+
+    def execute(self):
+        results = [method(*args, **kwargs) for method, args, kwargs in self.commands]
+        self.commands = []
+        return results
+
 class FakeRedisServer(object):
     def __init__(self, database=None):
         """ database is a dict of a dict:
@@ -25,6 +55,7 @@ class FakeRedisServer(object):
         global server
         server = __import__("server", globals(), locals(), [''], -1)
         self.database = database
+        self.scripts_flushed = False
         
     def hget(self, key, field):
         """
@@ -33,8 +64,13 @@ class FakeRedisServer(object):
         * key "user_john" and field "name"/"data"
         """
         if key not in self.database:
-            return []
-        return self.database[key][field]
+            return None
+        return self.database[key].get(str(field))
+    
+    def hgetall(self, key):
+        if key not in self.database:
+            return {}
+        return dict(self.database[key])
     
     def hmset(self, key, dictionary):
         if key not in self.database:
@@ -42,9 +78,393 @@ class FakeRedisServer(object):
         for subkey in dictionary:
             self.database[key][subkey] = dictionary[subkey]
             
-    def hdel(self, key, dictionary):
-        for subkey in dictionary:
-            del self.database[key][subkey]
+    def hmget(self, key, fields):
+        if key not in self.database:
+            return [None for field in fields]
+        return [self.database[key].get(str(field)) for field in fields]
+    
+    def get(self, key):
+        return self.database.get(key)
+    
+    def mget(self, keys):
+        return [self.get(key) for key in keys]
+    
+    def set(self, key, value):
+        self.database[key] = str(value)
+        return True
+    
+    def hset(self, key, field, value):
+        added = int(not self.hexists(key, field))
+        self.database.setdefault(key, dict())[str(field)] = value
+        return added
+    
+    def sscan(self, key, cursor=0, match=None, count=None):
+        members = sorted(self.smembers(key))
+        count = count or 10
+        page = members[cursor:cursor+count]
+        if cursor + count >= len(members):
+            return 0, page
+        return cursor + count, page
+    
+    def incr(self, key):
+        self.database[key] = int(self.database.get(key, 0)) + 1
+        return self.database[key]
+    
+    def publish(self, channel, message):
+        return 0
+    
+    def scan_iter(self, match="*", count=None):
+        for key in list(self.database):
+            if fnmatch.fnmatchcase(key, match):
+                yield key
+    
+    def pipeline(self, transaction=True):
+        return FakePipeline(self)
+    
+    def info(self, section=None):
+        return {"used_memory": 0}
+    
+    def script_load(self, source):
+        self.scripts_flushed = False
+        for name, script in server.LUA_SCRIPTS.items():
+            if script == source:
+                return name
+    
+    def script_flush(self):
+        self.scripts_flushed = True
+
+    def evalsha(self, sha, numkeys, *keys_and_args):
+        if self.scripts_flushed or not hasattr(self, sha):
+            raise server.NoScriptError()
+        return getattr(self, sha)(list(keys_and_args[:numkeys]), list(keys_and_args[numkeys:]))
+    
+    def holdings_code(self, keys):
+        if self.hget(keys[0], "name") in [None, []]:
+            return server.TRADE_USER_NOT_FOUND
+        if self.hget(keys[0], "data"):
+            return server.TRADE_LEGACY_DATA
+        return server.TRADE_OK
+    
+    def asset_info(self, asset_id):
+        price, asset_class = self.hmget("asset_id_"+str(asset_id), ["price", "class"])
+        return float(price or 0), asset_class or ''
+    
+    def add_exposure(self, user, asset_id, asset_class, value, change):
+        if value == 0:
+            self.hdel("exposure_asset_"+user, asset_id)
+        else:
+            self.database.setdefault("exposure_asset_"+user, dict())[str(asset_id)] = repr(value)
+        if change != 0:
+            self.hincrbyfloat("exposure_class_"+user, asset_class, change)
+            self.hincrbyfloat("book_exposure_class", asset_class, change)
+            self.hincrbyfloat("book_exposure_asset", asset_id, change)
+    
+    def remove_exposure(self, user):
+        for by in ["class", "asset"]:
+            for field, value in self.hgetall("exposure_"+by+"_"+user).items():
+                self.hincrbyfloat("book_exposure_"+by, field, -float(value))
+            self.delete("exposure_"+by+"_"+user)
+    
+    def refresh_value(self, user):
+        self.remove_exposure(user)
+        nav = 0.0
+        for ID, q in self.hgetall("holdings_"+user).items():
+            price, asset_class = self.asset_info(ID)
+            value = float(q) * price
+            self.add_exposure(user, ID, asset_class, value, value)
+            nav += value
+        self.database["user_"+user]["nav"] = repr(nav)
+        return repr(nav)
+    
+    def ensure_value(self, user):
+        if not self.hexists("user_"+user, "nav"):
+            self.refresh_value(user)
+    
+    def holding_changed(self, user, asset_id, quantity, old_quantity):
+        self.database["user_"+user]["version"] = self.incr("portfolio_version")
+        price, asset_class = self.asset_info(asset_id)
+        change = (quantity - old_quantity) * price
+        self.add_exposure(user, asset_id, asset_class, quantity * price, change)
+        if "holdings_"+user not in self.database:
+            self.database["user_"+user]["nav"] = "0"
+            self.remove_exposure(user)
+        elif change != 0:
+            self.hincrbyfloat("user_"+user, "nav", change)
+    
+    def buy_sell(self, keys, args):
+        code = self.holdings_code(keys)
+        if code != server.TRADE_OK:
+            return code
+        if keys[1] not in self.database:
+            return server.TRADE_NO_DATA
+        quantity = float(args[1])
+        if math.isinf(quantity) or math.isnan(quantity):
+            return server.TRADE_INVALID_QUANTITY
+        if quantity == 0:
+            return server.TRADE_OK
+        if not self.hexists(keys[1], args[0]):
+            return server.TRADE_ASSET_NOT_FOUND
+        held = float(self.hget(keys[1], args[0]))
+        if math.isinf((held + quantity) * self.asset_info(args[0])[0]):
+            return server.TRADE_INVALID_QUANTITY
+        if held + quantity < 0:
+            return server.TRADE_NEGATIVE
+        self.ensure_value(args[2])
+        if held + quantity == 0:
+            self.hdel(keys[1], args[0])
+            self.srem(keys[3], args[2])
+            self.holding_changed(args[2], args[0], 0, held)
+        else:
+            self.holding_changed(args[2], args[0], self.hincrbyfloat(keys[1], args[0], quantity), held)
+        return server.TRADE_OK
+    
+    def create_holding(self, keys, args):
+        if keys[2] not in self.database:
+            return server.TRADE_ASSET_NOT_FOUND
+        code = self.holdings_code(keys)
+        if code != server.TRADE_OK:
+            return code
+        if self.hexists(keys[1], args[0]):
+            return server.TRADE_ALREADY_EXISTS
+        if math.isinf(float(args[1]) * self.asset_info(args[0])[0]) or math.isnan(float(args[1])):
+            return server.TRADE_INVALID_QUANTITY
+        if float(args[1]) > 0:
+            self.ensure_value(args[2])
+            self.database.setdefault(keys[1], dict())[str(args[0])] = args[1]
+            self.sadd(keys[3], args[2])
+            self.holding_changed(args[2], args[0], float(args[1]), 0)
+        return server.TRADE_OK
+    
+    def remove_holding(self, keys, args):
+        code = self.holdings_code(keys)
+        if code != server.TRADE_OK:
+            return code
+        if self.hexists(keys[1], args[0]):
+            held = float(self.hget(keys[1], args[0]))
+            self.ensure_value(args[2])
+            self.hdel(keys[1], args[0])
+            self.srem(keys[3], args[2])
+            self.holding_changed(args[2], args[0], 0, held)
+        return server.TRADE_OK
+    
+    def apply_trades(self, keys, args):
+        code = self.holdings_code(keys)
+        if code != server.TRADE_OK:
+            return code
+        legs = [args[i:i + 3] for i in range(1, len(args), 3)]
+        for asset_id, old, new in legs:
+            if (self.hget(keys[1], asset_id) or '') != old:
+                return server.TRADE_CONFLICT
+            if new != '' and (math.isnan(float(new)) or math.isinf(float(new) * self.asset_info(asset_id)[0])):
+                return server.TRADE_INVALID_QUANTITY
+        self.ensure_value(args[0])
+        for asset_id, old, new in legs:
+            if new == '':
+                self.hdel(keys[1], asset_id)
+                self.srem("holders_"+str(asset_id), args[0])
+            else:
+                self.database.setdefault(keys[1], dict())[str(asset_id)] = new
+                self.sadd("holders_"+str(asset_id), args[0])
+            self.holding_changed(args[0], asset_id, float(new or 0), float(old or 0))
+        return server.TRADE_OK
+    
+    def refresh_nav(self, keys, args):
+        if keys[0] not in self.database:
+            return None
+        return self.refresh_value(args[0])
+    
+    def set_price(self, keys, args):
+        old, asset_class = self.asset_info(args[0])
+        price = float(args[1])
+        holders = sorted(self.smembers(keys[1]))
+        if not self.revaluable(holders, args[0], price, old):
+            return server.TRADE_INVALID_QUANTITY
+        self.database.setdefault(keys[0], dict())["price"] = args[1]
+        revalued = []
+        version = self.incr("portfolio_version")
+        for user in holders:
+            if "user_"+user in self.database:
+                self.database["user_"+user]["version"] = version
+            if self.hexists("holdings_"+user, args[0]) and self.hexists("user_"+user, "nav"):
+                held = float(self.hget("holdings_"+user, args[0]))
+                change = held * (price - old)
+                if change != 0:
+                    self.hincrbyfloat("user_"+user, "nav", change)
+                self.add_exposure(user, args[0], asset_class, held * price, change)
+                revalued.append(user)
+        return revalued
+    
+    def revaluable(self, holders, asset_id, price, old):
+        if math.isinf(price) or math.isnan(price):
+            return False
+        for user in holders:
+            if self.hexists("holdings_"+user, asset_id) and self.hexists("user_"+user, "nav"):
+                held = float(self.hget("holdings_"+user, asset_id))
+                if math.isinf(held * price) or math.isinf(float(self.hget("user_"+user, "nav")) + held * (price - old)):
+                    return False
+        return True
+    
+    def upsert_asset(self, keys, args):
+        old, old_class = self.asset_info(args[0])
+        if not self.revaluable(sorted(self.smembers(keys[1])), args[0], float(args[3]), old):
+            return server.TRADE_INVALID_QUANTITY
+        created, renamed = self.write_asset(keys[0], args[0], args[1], args[2])
+        self.database[keys[0]]["price"] = args[3]
+        price = float(args[3])
+        if created or (price == old and args[2] == old_class):
+            if renamed:
+                self.touch_holders(keys[1])
+            return created
+        version = self.incr("portfolio_version")
+        for user in sorted(self.smembers(keys[1])):
+            if "user_"+user in self.database:
+                self.database["user_"+user]["version"] = version
+            if self.hexists("holdings_"+user, args[0]) and self.hexists("user_"+user, "nav"):
+                held = float(self.hget("holdings_"+user, args[0]))
+                change = held * (price - old)
+                if change != 0:
+                    self.hincrbyfloat("user_"+user, "nav", change)
+                if args[2] == old_class:
+                    self.add_exposure(user, args[0], args[2], held * price, change)
+                else:
+                    self.add_exposure(user, args[0], old_class, 0, -held * old)
+                    self.add_exposure(user, args[0], args[2], held * price, held * price)
+        return created
+    
+    def asset_member(self, asset_id, name):
+        return server.normalize_asset_name(name) + "\0" + str(asset_id)
+    
+    def index_asset(self, asset_id, name, asset_class):
+        self.sadd("assets_names", self.asset_member(asset_id, name))
+        self.sadd("assets_class_"+asset_class, str(asset_id))
+    
+    def write_asset(self, key, asset_id, name, asset_class):
+        old_name, old_class = self.hmget(key, ["name", "class"])
+        if old_name is not None:
+            self.srem("assets_names", self.asset_member(asset_id, old_name))
+            self.srem("assets_class_"+(old_class or ""), str(asset_id))
+        created = self.hsetnx(key, "id", asset_id)
+        self.database[key].update({"name":name, "class":asset_class})
+        self.index_asset(asset_id, name, asset_class)
+        return created, old_name is not None and old_name != name
+    
+    def touch_holders(self, key):
+        version = self.incr("portfolio_version")
+        for user in self.smembers(key):
+            if "user_"+user in self.database:
+                self.database["user_"+user]["version"] = version
+    
+    def seed_assets(self, keys, args):
+        for i, key in enumerate(keys):
+            if self.write_asset(key, *args[4*i:4*i+3])[1]:
+                self.touch_holders("holders_"+str(args[4*i]))
+            self.hsetnx(key, "price", args[4*i+3])
+        return len(keys)
+    
+    def index_assets(self, keys, args):
+        indexed = 0
+        for key in keys:
+            asset_id, name, asset_class = self.hmget(key, ["id", "name", "class"])
+            if None not in (asset_id, name, asset_class):
+                self.index_asset(asset_id, name, asset_class)
+                indexed += 1
+        return indexed
+    
+    def search_assets(self, keys, args):
+        prefix, after, limit, budget = args[0], args[1], int(args[2]), int(args[3])
+        members = sorted(member for member in self.smembers(keys[0]) if member.startswith(prefix))
+        members = [member for member in members if member > after]
+        found, read = [], 0
+        for member in members[:budget]:
+            asset_id = member.split("\0")[1]
+            read += 1
+            if len(keys) == 1 or asset_id in self.smembers(keys[1]):
+                found.append(asset_id)
+                if len(found) == limit:
+                    break
+        return [member if read < len(members) else ''] + found
+    
+    def upsert_assets(self, keys, args):
+        return [self.upsert_asset(keys[2*i:2*i+2], args[4*i:4*i+4]) for i in range(len(keys) / 2)]
+    
+    def create_user(self, keys, args):
+        if self.hget(keys[0], "name"):
+            return 0
+        self.sadd(keys[1], args[0])
+        self.database.setdefault(keys[0], dict()).update({"name":args[0], "version":self.incr("portfolio_version")})
+        return 1
+    
+    def delete_user(self, keys, args):
+        if self.hget(keys[0], "data"):
+            return server.TRADE_LEGACY_DATA
+        for asset_id in self.hkeys(keys[1]):
+            self.srem("holders_"+asset_id, args[0])
+        self.remove_exposure(args[0])
+        self.delete(keys[0])
+        self.delete(keys[1])
+        self.srem(keys[2], args[0])
+        self.incr("portfolio_version")
+        return server.TRADE_OK
+    
+    def prune_holders(self, keys, args):
+        removed = 0
+        for user in args[1:]:
+            if not self.hget("user_"+user, "data") and not self.hexists("holdings_"+user, args[0]):
+                removed += self.srem(keys[0], user)
+        return removed
+    
+    def migrate_holdings(self, keys, args):
+        if self.database[keys[0]].get("data") != args[0]:
+            return 0
+        for i in range(1, len(args), 2):
+            self.database.setdefault(keys[1], dict())[str(args[i])] = args[i + 1]
+            self.sadd("holders_"+str(args[i]), keys[0][len("user_"):])
+        del self.database[keys[0]]["data"]
+        self.refresh_value(keys[0][len("user_"):])
+        return 1
+    
+    def replace_data(self, keys, args):
+        if self.database[keys[0]].get("data") != args[0]:
+            return 0
+        self.database[keys[0]]["data"] = args[1]
+        return 1
+    
+    def hdel(self, key, *fields):
+        if len(fields) == 1 and isinstance(fields[0], list):
+            fields = fields[0]
+        deleted = 0
+        for field in fields:
+            if key in self.database and str(field) in self.database[key]:
+                del self.database[key][str(field)]
+                deleted += 1
+        if key in self.database and not self.database[key]:
+            del self.database[key]
+        return deleted
+    
+    def hexists(self, key, field):
+        return key in self.database and str(field) in self.database[key]
+    
+    def hsetnx(self, key, field, value):
+        if self.hexists(key, field):
+            return 0
+        self.database.setdefault(key, dict())[str(field)] = str(value)
+        return 1
+    
+    def hincrby(self, key, field, amount=1):
+        value = int(self.database.setdefault(key, dict()).get(str(field), 0)) + amount
+        self.database[key][str(field)] = str(value)
+        return value
+    
+    def hincrbyfloat(self, key, field, amount):
+        value = float(self.database.setdefault(key, dict()).get(str(field), 0)) + amount
+        self.database[key][str(field)] = repr(value)
+        return value
+    
+    def hkeys(self, key):
+        return list(self.database.get(key, dict()))
+    
+    def exists(self, key):
+        return key in self.database
     
     def smembers(self, key="list_users"):
         if key not in self.database:
@@ -54,13 +474,20 @@ class FakeRedisServer(object):
     def sadd(self, key="list_users", user="john"):
         if key not in self.database:
             self.database[key] = set()
+        added = int(user not in self.database[key])
         self.database[key].add(user)
+        return added
     
     def srem(self, key="list_users", user="john"):
+        if user not in self.database.get(key, set()):
+            return 0
         self.database[key].remove(user)
+        if not self.database[key]:
+            del self.database[key]
+        return 1
         
     def delete(self, key):
-        del self.database[key]
+        return int(self.database.pop(key, None) is not None)
         
     def ping(self):
         raise server.ConnectionError()
@@ -203,6 +630,9 @@ class Asset(unittest.TestCase):
         data = "31;352e35"
         asset = server.Asset.deserialize(data)
         self.assertEquals(asset, server.Asset("1", 5.5))
+
+    def test_parse(self):
+        self.assertEquals(server.Asset.parse("31;352e35"), (1, 5.5))
    
 class FakeAsset(object):
     def __init__(self, ID, Q):
@@ -229,13 +659,22 @@ class FakeAsset(object):
         return serialized_data
     
     @staticmethod
-    def deserialize(serialized_data):
-        if serialized_data is None:
-            return
+    def parse(serialized_data):
         serialized_data = serialized_data.split(";")
         ID = serialized_data[0].decode("hex")
         q = serialized_data[1].decode("hex")
-        return FakeAsset(ID, float(q))
+        return int(ID), float(q)
+
+    @staticmethod
+    def deserialize(serialized_data):
+        if serialized_data is None:
+            return
+        ID, q = FakeAsset.parse(serialized_data)
+        return FakeAsset(ID, q)
+
+    @staticmethod
+    def prefetch(asset_ids):
+        return
 
     def __eq__(self, other):
         return self.id == other.id and self.quantity == other.quantity
@@ -368,13 +807,51 @@ class Portfolio(unittest.TestCase):
         json_data = portfolio.json_serialize(url_root)
         self.assertEquals(json_data, {"user":user, "numberOfAssets":2, "netAssetValue":nav, "links": [{"rel":"self", "href": url_root[:-1]+url_version+"/portfolios/"+user}]})
 
+    def test_json_serialize_holdings(self):
+        user = "john"
+        portfolio = server.Portfolio(user)
+        portfolio.assets = {1: FakeAsset(1, 7.0), 0: FakeAsset(0, 5.0)}
+        json_data = portfolio.json_serialize("http://localhost:5000/", holdings=True)
+        self.assertEquals([a["id"] for a in json_data["assets"]], [0, 1])
+        self.assertEquals(json_data["assets"][1], {"id":1, "name":None, "class":None, "quantity":7.0, "price":2.5})
+
     def test_serialize(self):
         user = "john"
         portfolio = server.Portfolio(user)
         portfolio.assets = {0: FakeAsset(0, 5.0), 1: FakeAsset(1, 6.0)}
         portfolio.nav = 2.5 * 5.0 + 2.5 * 6.0
         data = portfolio.serialize()
-        self.assertEquals(data, "6a6f686e;33303b3335326533302333313b333632653330")
+        self.assertEquals(data, "\x01\x04\x00john" + "\x00\x00\x00\x00" + struct.pack("<d", 5.0) + "\x01\x00\x00\x00" + struct.pack("<d", 6.0))
+    
+    def test_encode_sorted(self):
+        self.assertEquals(server.Portfolio.encode("john", [(1, 6.0), (0, 5.0)]), server.Portfolio.encode("john", [(0, 5.0), (1, 6.0)]))
+    
+    def test_decode_compact(self):
+        data = server.Portfolio.encode("john", [(0, 5.0), (1, 1.0/3)])
+        self.assertTrue(server.Portfolio.is_compact(data))
+        self.assertEquals(server.Portfolio.decode(data), ("john", [(0, 5.0), (1, 1.0/3)]))
+    
+    def test_decode_compact_empty(self):
+        data = server.Portfolio.encode("john", [])
+        self.assertEquals(server.Portfolio.decode(data), ("john", []))
+    
+    def test_decode_legacy(self):
+        data = "6a6f686e;33303b3335326533302333313b333632653330"
+        self.assertFalse(server.Portfolio.is_compact(data))
+        self.assertEquals(server.Portfolio.decode(data), ("john", [(0, 5.0), (1, 6.0)]))
+        self.assertEquals(server.Portfolio.decode("6a6f686e;"), ("john", []))
+    
+    def test_deserialize_compact(self):
+        user = "john"
+        portfolio_expected = server.Portfolio(user)
+        portfolio_expected.assets = {0: FakeAsset(0, 5.0), 1: FakeAsset(1, 6.0)}
+        portfolio_expected.nav = 2.5 * 5.0 + 2.5 * 6.0
+        data = portfolio_expected.serialize()
+        temp = server.Asset
+        server.Asset = FakeAsset
+        portfolio = server.Portfolio.deserialize(data)
+        server.Asset = temp
+        self.assertEquals(portfolio, portfolio_expected)
     
     def test_deserialize(self):
         user = "john"
@@ -452,6 +929,7 @@ class Static(unittest.TestCase):
 
 class GET(unittest.TestCase):
     def setUp(self):
+        global server
         server = __import__("server", globals(), locals(), [''], -1)
         server.SECURED = False
         self.app = server.app.test_client()
@@ -480,6 +958,205 @@ class GET(unittest.TestCase):
         self.assertEquals(parsed_data["portfolios"][0]["links"][0]["href"], "http://localhost"+url_version+"/portfolios/john")
         self.assertEquals(parsed_data["portfolios"][1]["links"][0]["href"], "http://localhost"+url_version+"/portfolios/jeremy")
     
+    def test_list_portfolios_paginated(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":10,"class":"commodity"}
+        database["user_alice"] = {"name":"alice", "data":"616c696365;33303b3335"}
+        database["user_bob"] = {"name":"bob", "data":""}
+        database["user_cathy"] = {"name":"cathy", "data":""}
+        database["list_users"] = set(["alice", "bob", "cathy", "deleted"])
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.get(url_version+"/portfolios?limit=2")
+        parsed_data = json.loads(response.data)
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals([p["user"] for p in parsed_data["portfolios"]], ["alice", "bob"])
+        self.assertEquals(parsed_data["portfolios"][0]["netAssetValue"], 50)
+        self.assertEquals(parsed_data["links"], [{"rel":"next", "href":"http://localhost"+url_version+"/portfolios?cursor=2&limit=2"}])
+        response = self.app.get(url_version+"/portfolios?cursor=2&limit=2")
+        parsed_data = json.loads(response.data)
+        self.assertEquals([p["user"] for p in parsed_data["portfolios"]], ["cathy"])
+        self.assertEquals(parsed_data["links"], [])
+
+    def test_get_valuation(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":10,"class":"commodity"}
+        database["asset_id_1"] = {"id": 1,"name":"NYC real estate index","price":20,"class":"real-estate"}
+        database["user_john"] = {"name":"john"}
+        database["holdings_john"] = {"0":"5.0", "1":"0.5"}
+        database["user_jeremy"] = {"name":"jeremy", "data":"6a6572656d79;33303b3335"}
+        database["user_alice"] = {"name":"alice"}
+        database["list_users"] = set(["john", "jeremy", "alice"])
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.get(url_version+"/valuation?navs=true")
+        parsed_data = json.loads(response.data)
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals(parsed_data["navs"], {"john":60, "jeremy":50, "alice":0})
+        self.assertEquals((parsed_data["aum"], parsed_data["portfolios"], parsed_data["holdings"]), (110, 3, 3))
+        database["asset_id_0"]["price"] = 12 # the asset catalog is not notified
+        database["holdings_alice"] = {"1":"1.0"}
+        response = self.app.get(url_version+"/valuation")
+        self.assertEquals(json.loads(response.data)["aum"], 130)
+        self.assertFalse("navs" in json.loads(response.data))
+        response = self.app.get(url_version+"/valuation?reload=true")
+        self.assertEquals(json.loads(response.data)["aum"], 150)
+
+    def test_valuation_engine_sscan_duplicates(self):
+        class FakeRedisServerRehashing(FakeRedisServer):
+            def sscan(self, key, cursor=0, match=None, count=None):
+                if cursor == 0: # the set is rehashed between the two calls
+                    return 1, ["john", "alice"]
+                return 0, ["john", "jeremy", "jeremy"]
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":10,"class":"commodity"}
+        database["holdings_john"] = {"0":"5.0"}
+        database["holdings_jeremy"] = {"0":"1.0"}
+        server.redis_server = FakeRedisServerRehashing(database)
+        engine = server.ValuationEngine()
+        engine.load()
+        self.assertEquals(engine.value(), (["alice", "jeremy", "john"], [0.0, 10.0, 50.0]))
+        self.assertEquals(engine.stats()["holdings"], 2)
+
+    def test_valuation_engine_without_numpy(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":10,"class":"commodity"}
+        server.redis_server = FakeRedisServer(database)
+        server.numpy = None
+        engine = server.ValuationEngine()
+        engine.build(["john", "alice", "jeremy"], [("john", 0, 5.0), ("jeremy", 0, 1.0), ("john", 7, 1.0)])
+        engine.loaded_at = server.time.time()
+        self.assertEquals(engine.value(), (["john", "alice", "jeremy"], [50.0, 0.0, 10.0]))
+        self.assertFalse(engine.stats()["numpy"])
+
+    def test_list_holders(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":10,"class":"commodity"}
+        database["holders_0"] = set(["alice", "bob", "cathy"])
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.get(url_version+"/assets/0/holders?limit=2")
+        parsed_data = json.loads(response.data)
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals(parsed_data["holders"], ["alice", "bob"])
+        self.assertEquals(parsed_data["links"], [{"rel":"next", "href":"http://localhost"+url_version+"/assets/0/holders?cursor=2&limit=2"}])
+        response = self.app.get(url_version+"/assets/0/holders?cursor=2&limit=2")
+        self.assertEquals(json.loads(response.data), {"holders":["cathy"], "links":[]})
+
+    def test_list_catalog(self):
+        server.redis_server = FakeRedisServer(dict())
+        server.fill_database_assets()
+        server.import_assets([{"id": 4, "name": "Gold  Bar", "class": "metal", "price": 5}, {"id": 5, "name": "golden", "class": "equity", "price": 7}])
+        response = self.app.get(url_version+"/assets?q=GOLD&limit=2")
+        parsed_data = json.loads(response.data)
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals([asset["name"] for asset in parsed_data["assets"]], ["gold", "Gold  Bar"])
+        self.assertEquals(parsed_data["assets"][1], {"id":4, "name":"Gold  Bar", "class":"metal", "price":5.0})
+        self.assertEquals(parsed_data["links"], [{"rel":"next", "href":"http://localhost"+url_version+"/assets?cursor=Z29sZCBiYXIANA&limit=2&q=GOLD"}])
+        response = self.app.get(url_version+"/assets?cursor=Z29sZCBiYXIANA&limit=2&q=GOLD")
+        self.assertEquals(json.loads(response.data), {"assets":[{"id":5, "name":"golden", "class":"equity", "price":7.0}], "links":[]})
+        response = self.app.get(url_version+"/assets?q=gold&class=commodity")
+        self.assertEquals([asset["id"] for asset in json.loads(response.data)["assets"]], [0])
+        response = self.app.get(url_version+"/assets?class=commodity")
+        self.assertEquals([asset["id"] for asset in json.loads(response.data)["assets"]], [0, 2])
+        response = self.app.get(url_version+"/assets")
+        self.assertEquals([asset["id"] for asset in json.loads(response.data)["assets"]], [2, 0, 4, 5, 1, 3])
+
+    def test_list_catalog_renamed(self):
+        database = dict()
+        server.redis_server = FakeRedisServer(database)
+        server.import_assets([{"id": 4, "name": "silver", "class": "metal", "price": 5}])
+        server.import_assets([{"id": 4, "name": "platinum", "class": "precious metal", "price": 5}])
+        self.assertEquals(database["assets_names"], set(["platinum\x004"]))
+        self.assertEquals(database["assets_class_precious metal"], set(["4"]))
+        self.assertFalse("assets_class_metal" in database)
+        response = self.app.get(url_version+"/assets?q=silver")
+        self.assertEquals(json.loads(response.data)["assets"], [])
+
+    def test_list_catalog_renamed_between_pages(self):
+        server.redis_server = FakeRedisServer(dict())
+        server.import_assets([{"id": i, "name": name, "class": "metal", "price": 5} for i, name in enumerate(["iron", "lead", "nickel", "tin"])])
+        response = self.app.get(url_version+"/assets?limit=2")
+        parsed_data = json.loads(response.data)
+        self.assertEquals([asset["id"] for asset in parsed_data["assets"]], [0, 1])
+        server.import_assets([{"id": 1, "name": "zinc", "class": "metal", "price": 5}])
+        response = self.app.get(parsed_data["links"][0]["href"][len("http://localhost"):])
+        self.assertEquals([asset["id"] for asset in json.loads(response.data)["assets"]], [2, 3])
+        server.import_assets([{"id": 3, "name": "aluminium", "class": "metal", "price": 5}])
+        response = self.app.get(parsed_data["links"][0]["href"][len("http://localhost"):])
+        self.assertEquals([asset["id"] for asset in json.loads(response.data)["assets"]], [2, 1])
+
+    def test_list_catalog_not_valid(self):
+        server.redis_server = FakeRedisServer(dict())
+        response = self.app.get(url_version+"/assets?cursor=abc")
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        response = self.app.get(url_version+"/assets?cursor=8")
+        self.assertEquals(json.loads(response.data)["error"], "The cursor 8 is not valid")
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        response = self.app.get(url_version+"/assets?cursor=Z29sZAB4")
+        self.assertEquals(json.loads(response.data)["error"], "The cursor Z29sZAB4 is not valid")
+        response = self.app.get(url_version+"/assets?cursor=Z29sZAAw&q=silver")
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        response = self.app.get(url_version+"/assets?limit=0")
+        self.assertEquals(json.loads(response.data)["error"], "The limit 0 must be positive")
+
+    def test_list_catalog_SECURED(self):
+        server.SECURED = True
+        database = dict()
+        database["password_john"] = {"hash_password":generate_password_hash("12345")}
+        database["admin_password_admin"] = {"hash_password":generate_password_hash("admin_password")}
+        server.redis_server = FakeRedisServer(database)
+        server.fill_database_assets()
+        response = self.app.get(url_version+"/assets")
+        self.assertEquals(response.status_code, HTTP_401_UNAUTHORIZED)
+        response = self.app.get(url_version+"/assets", headers={'Authorization': 'Basic %s' % b64encode('john:54321')})
+        self.assertEquals(response.status_code, HTTP_401_UNAUTHORIZED)
+        response = self.app.get(url_version+"/assets", headers={'Authorization': 'Basic %s' % b64encode('john:12345')})
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals(len(json.loads(response.data)["assets"]), 4)
+        response = self.app.get(url_version+"/assets", headers={'Authorization': 'Basic %s' % b64encode('admin:admin_password')})
+        self.assertEquals(response.status_code, HTTP_200_OK)
+
+    def test_list_holders_not_found(self):
+        server.redis_server = FakeRedisServer(dict())
+        response = self.app.get(url_version+"/assets/7/holders")
+        self.assertEquals(response.status_code, HTTP_404_NOT_FOUND)
+        response = self.app.get(url_version+"/assets/abc/holders")
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_list_portfolios_paginated_not_valid(self):
+        server.redis_server = FakeRedisServer(dict())
+        response = self.app.get(url_version+"/portfolios?cursor=abc")
+        parsed_data = json.loads(response.data)
+        self.assertEquals(parsed_data["error"], "The cursor abc and the limit None must be integers")
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        response = self.app.get(url_version+"/portfolios?limit=0")
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_export_portfolios(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":10,"class":"commodity"}
+        database["user_alice"] = {"name":"alice", "data":"616c696365;33303b3335"}
+        database["user_bob"] = {"name":"bob", "data":""}
+        database["user_cathy"] = {"name":"cathy", "data":""}
+        database["list_users"] = set(["alice", "bob", "cathy"])
+        server.redis_server = FakeRedisServer(database)
+        server.EXPORT_BATCH_SIZE = 2
+        response = self.app.get(url_version+"/portfolios/export")
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals(response.mimetype, "application/x-ndjson")
+        lines = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEquals([line["user"] for line in lines], ["alice", "bob", "cathy"])
+        self.assertEquals(lines[0]["netAssetValue"], 50)
+        self.assertFalse("assets" in lines[0])
+
+    def test_export_portfolios_holdings(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":10,"class":"commodity"}
+        database["user_alice"] = {"name":"alice", "data":"616c696365;33303b3335"}
+        database["list_users"] = set(["alice"])
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.get(url_version+"/portfolios/export?holdings=true")
+        lines = [json.loads(line) for line in response.data.splitlines()]
+        self.assertEquals(lines[0]["assets"], [{"id":0, "name":"gold", "class":"commodity", "quantity":5.0, "price":10.0}])
+
     def test_list_assets(self):
         database = dict()
         database["asset_id_0"] = {"id": 0,"name":"gold","price":1286.59,"class":"commodity"}
@@ -551,6 +1228,114 @@ class GET(unittest.TestCase):
         self.assertEquals(parsed_data["nav"], 6432.95)
         self.assertEquals(response.status_code, HTTP_200_OK)
     
+    def test_get_asset_holdings(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":1286.59,"class":"commodity"}
+        database["user_john"] = {"name":"john"}
+        database["holdings_john"] = {"0":"5.0"}
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.get(url_version+"/portfolios/john/assets/0")
+        parsed_data = json.loads(response.data)
+        self.assertEquals(parsed_data["quantity"], 5.0)
+        self.assertEquals(parsed_data["value"], 5.0*1286.59)
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        response = self.app.get(url_version+"/portfolios/john/assets/1")
+        self.assertEquals(response.status_code, HTTP_404_NOT_FOUND)
+
+    def test_get_nav_holdings(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":10,"class":"commodity"}
+        database["asset_id_1"] = {"id": 1,"name":"NYC real estate index","price":20,"class":"real-estate"}
+        database["user_john"] = {"name":"john"}
+        database["holdings_john"] = {"0":"5.0", "1":"0.5"}
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.get(url_version+"/portfolios/john/nav")
+        parsed_data = json.loads(response.data)
+        self.assertEquals(parsed_data["nav"], 60)
+        self.assertEquals(float(database["user_john"]["nav"]), 60)
+
+    def test_get_nav_stored(self):
+        database = dict()
+        database["user_john"] = {"name":"john", "nav":"42.5"}
+        database["holdings_john"] = {"0":"5.0"}
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.get(url_version+"/portfolios/john/nav")
+        parsed_data = json.loads(response.data)
+        self.assertEquals(parsed_data["nav"], 42.5)
+
+    def test_get_nav_etag(self):
+        database = dict()
+        database["user_john"] = {"name":"john", "nav":"42.5", "version":"5"}
+        database["holdings_john"] = {"0":"5.0"}
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.get(url_version+"/portfolios/john/nav")
+        self.assertEquals(response.headers["ETag"], '"5"')
+        response = self.app.get(url_version+"/portfolios/john/nav", headers={"If-None-Match": '"5"'})
+        self.assertEquals(response.status_code, server.HTTP_304_NOT_MODIFIED)
+        self.assertEquals(response.data, "")
+        self.assertEquals(response.headers["ETag"], '"5"')
+        response = self.app.get(url_version+"/portfolios/john/nav", headers={"If-None-Match": '"4"'})
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        response = self.app.get(url_version+"/portfolios/jeremy/nav", headers={"If-None-Match": '"0"'})
+        self.assertEquals(response.status_code, HTTP_404_NOT_FOUND)
+
+    def test_etag_changes(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":"10.0","class":"commodity"}
+        database["asset_id_1"] = {"id": 1,"name":"silver","price":"1.0","class":"commodity"}
+        database["user_john"] = {"name":"john"}
+        database["holdings_john"] = {"0":"5.0"}
+        database["holders_0"] = set(["john"])
+        server.redis_server = FakeRedisServer(database)
+        etags = []
+        for change in [lambda: None, lambda: server.run_trade_script("buy_sell", "john", 0, 1), lambda: server.set_asset_prices({0: 12}), lambda: server.set_asset_prices({1: 2})]:
+            change()
+            for path in ["/nav", "/assets", "/assets/0", "/exposure"]:
+                response = self.app.get(url_version+"/portfolios/john"+path)
+                self.assertEquals(response.headers["ETag"], self.app.get(url_version+"/portfolios/john/nav").headers["ETag"])
+            etags.append(response.headers["ETag"])
+        self.assertEquals(len(set(etags[:3])), 3)
+        self.assertEquals(etags[3], etags[2])
+
+    def test_etag_legacy(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":"10.0","class":"commodity"}
+        database["user_jeremy"] = {"name":"jeremy", "data":server.Portfolio.encode("jeremy", [(0, 5.0)])}
+        database["holders_0"] = set(["jeremy"])
+        server.redis_server = FakeRedisServer(database)
+        etags = []
+        for change in [lambda: None, lambda: server.set_asset_prices({0: 12}), lambda: database["user_jeremy"].update({"data":server.Portfolio.encode("jeremy", [(0, 6.0)])})]:
+            change()
+            response = self.app.get(url_version+"/portfolios/jeremy/assets")
+            self.assertEquals(response.status_code, HTTP_200_OK)
+            etags.append(response.headers["ETag"])
+            response = self.app.get(url_version+"/portfolios/jeremy/assets", headers={"If-None-Match": etags[-1]})
+            self.assertEquals(response.status_code, server.HTTP_304_NOT_MODIFIED)
+        self.assertEquals(len(set(etags)), 3)
+        self.assertTrue("data" in database["user_jeremy"])
+
+    def test_etag_asset_renamed(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"old gold","price":"10.0","class":"commodity"}
+        database["user_john"] = {"name":"john", "nav":"50.0"}
+        database["holdings_john"] = {"0":"5.0"}
+        database["holders_0"] = set(["john"])
+        server.redis_server = FakeRedisServer(database)
+        etag = self.app.get(url_version+"/portfolios/john/assets").headers["ETag"]
+        server.fill_database_assets() # the seed renames asset 0 to gold
+        response = self.app.get(url_version+"/portfolios/john/assets", headers={"If-None-Match": etag})
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals(json.loads(response.data)["assets"][0]["name"], "gold")
+        etag = response.headers["ETag"]
+        server.import_assets([{"id": 0, "name": "Gold", "class": "commodity", "price": 10}])
+        response = self.app.get(url_version+"/portfolios/john/assets/0", headers={"If-None-Match": etag})
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals(json.loads(response.data)["name"], "Gold")
+        etag = response.headers["ETag"]
+        server.import_assets([{"id": 0, "name": "Gold", "class": "commodity", "price": 10}]) # unchanged
+        response = self.app.get(url_version+"/portfolios/john/assets/0", headers={"If-None-Match": etag})
+        self.assertEquals(response.status_code, server.HTTP_304_NOT_MODIFIED)
+    
     def test_get_nav_no_username(self):
         database = dict()
         database["asset_id_0"] = {"id": 0,"name":"gold","price":1286.59,"class":"commodity"}
@@ -560,6 +1345,55 @@ class GET(unittest.TestCase):
         self.assertEquals(parsed_data["error"], "User john not found")
         self.assertEquals(response.status_code, HTTP_404_NOT_FOUND)
     
+    def test_get_exposure(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":10,"class":"commodity"}
+        database["asset_id_1"] = {"id": 1,"name":"silver","price":2,"class":"commodity"}
+        database["asset_id_2"] = {"id": 2,"name":"NYC real estate index","price":20,"class":"real-estate"}
+        database["user_john"] = {"name":"john"}
+        database["holdings_john"] = {"0":"5.0", "1":"10.0", "2":"0.5"}
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.get(url_version+"/portfolios/john/exposure")
+        parsed_data = json.loads(response.data)
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals(parsed_data, {"nav" : 80, "exposure" : {"commodity" : 70, "real-estate" : 10}})
+        self.assertEquals(float(database["user_john"]["nav"]), 80)
+        response = self.app.get(url_version+"/portfolios/john/exposure?by=asset")
+        parsed_data = json.loads(response.data)
+        self.assertEquals(parsed_data["exposure"], {"0" : 50, "1" : 20, "2" : 10})
+
+    def test_get_exposure_legacy(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":1286.59,"class":"commodity"}
+        database["user_john"] = {"name":"john", "data":"6a6f686e;33303b3335"}
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.get(url_version+"/portfolios/john/exposure")
+        parsed_data = json.loads(response.data)
+        self.assertEquals(parsed_data["exposure"], {"commodity" : 6432.95})
+        self.assertFalse("exposure_class_john" in database)
+
+    def test_get_exposure_not_valid(self):
+        server.redis_server = FakeRedisServer(dict())
+        response = self.app.get(url_version+"/portfolios/john/exposure")
+        self.assertEquals(response.status_code, HTTP_404_NOT_FOUND)
+        response = self.app.get(url_version+"/portfolios/john/exposure?by=user")
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        response = self.app.get(url_version+"/exposure?by=user")
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_get_book_exposure(self):
+        database = dict()
+        database["book_exposure_class"] = {"commodity":"70.0", "real-estate":"1e-12"}
+        database["book_exposure_asset"] = {"0":"50.0", "1":"20.0"}
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.get(url_version+"/exposure")
+        parsed_data = json.loads(response.data)
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals(parsed_data["exposure"], {"commodity" : 70})
+        response = self.app.get(url_version+"/exposure?by=asset")
+        parsed_data = json.loads(response.data)
+        self.assertEquals(parsed_data["exposure"], {"0" : 50, "1" : 20})
+    
 class POST(unittest.TestCase):
     def setUp(self):
         global server
@@ -579,6 +1413,7 @@ class POST(unittest.TestCase):
             data_empty = True
         self.assertTrue(data_empty)
         self.assertEquals(response.status_code, HTTP_201_CREATED)
+        self.assertEquals(database["user_john"]["version"], 1)
         
     def test_create_user_SECURED(self):
         server.SECURED = True
@@ -646,6 +1481,18 @@ class POST(unittest.TestCase):
         self.assertTrue(data_empty)
         self.assertEquals(response.status_code, HTTP_201_CREATED)
     
+    def test_create_asset_not_finite(self):
+        database = dict()
+        database["user_john"] = {"name":"john", "nav":"0"}
+        database["asset_id_1"] = {"id": 1,"name":"NYC real estate index","price":16255.18,"class":"real-estate"}
+        server.redis_server = FakeRedisServer(database)
+        for quantity in ["1e400", "NaN", '"ten"']:
+            response = self.app.post(url_version+"/portfolios/john/assets", data='{"asset_id":1,"quantity":'+quantity+'}')
+            self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        self.assertFalse("holdings_john" in database)
+        self.assertFalse("holders_1" in database)
+        self.assertEquals(server.run_trade_script("create_holding", "john", 1, float("inf")), server.TRADE_INVALID_QUANTITY)
+    
     def test_create_asset_neg(self):
         database = dict()
         database["user_john"] = {"name":"john", "data":"6a6f686e;33303b3335"}
@@ -699,6 +1546,31 @@ class POST(unittest.TestCase):
         self.assertEquals(parsed_data["error"], "Asset with id 0 already exists in portfolio.")
         self.assertEquals(response.status_code, HTTP_409_CONFLICT)
     
+    def test_create_asset_holdings(self):
+        database = dict()
+        database["user_john"] = {"name":"john"}
+        database["holdings_john"] = {"0":"5.0"}
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":1286.59,"class":"commodity"}
+        database["asset_id_1"] = {"id": 1,"name":"NYC real estate index","price":16255.18,"class":"real-estate"}
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.post(url_version+"/portfolios/john/assets", data='{"asset_id":1,"quantity":10}')
+        self.assertEquals(response.status_code, HTTP_201_CREATED)
+        self.assertEquals(database["holdings_john"], {"0":"5.0", "1":"10.0"})
+        response = self.app.post(url_version+"/portfolios/john/assets", data='{"asset_id":1,"quantity":10}')
+        self.assertEquals(response.status_code, HTTP_409_CONFLICT)
+
+    def test_create_asset_migrates_legacy(self):
+        database = dict()
+        database["user_john"] = {"name":"john", "data":"6a6f686e;33303b3335"}
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":1286.59,"class":"commodity"}
+        database["asset_id_1"] = {"id": 1,"name":"NYC real estate index","price":16255.18,"class":"real-estate"}
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.post(url_version+"/portfolios/john/assets", data='{"asset_id":1,"quantity":10}')
+        self.assertEquals(response.status_code, HTTP_201_CREATED)
+        self.assertEquals(database["user_john"]["name"], "john")
+        self.assertFalse("data" in database["user_john"])
+        self.assertEquals(database["holdings_john"], {"0":"5.0", "1":"10.0"})
+
 class PUT(unittest.TestCase):
     def setUp(self):
         server = __import__("server", globals(), locals(), [''], -1)
@@ -720,6 +1592,19 @@ class PUT(unittest.TestCase):
         self.assertTrue(data_empty)
         self.assertEquals(response.status_code, HTTP_200_OK)
     
+    def test_update_asset_not_finite(self):
+        database = dict()
+        database["user_john"] = {"name":"john", "nav":"50.0"}
+        database["holdings_john"] = {"0":"5.0"}
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":10,"class":"commodity"}
+        server.redis_server = FakeRedisServer(database)
+        for quantity in ["1e400", "-1e400", "NaN", "1e308"]:
+            response = self.app.put(url_version+"/portfolios/john/assets/0", data='{"quantity":'+quantity+'}')
+            self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        self.assertEquals(database["holdings_john"], {"0":"5.0"})
+        self.assertEquals(database["user_john"]["nav"], "50.0")
+        self.assertEquals(server.run_trade_script("buy_sell", "john", 0, float("nan")), server.TRADE_INVALID_QUANTITY)
+    
     def test_update_asset_data_not_valid(self):
         response = self.app.put(url_version+"/portfolios/john/assets/0", data='notjson')
         parsed_data = json.loads(response.data)
@@ -779,16 +1664,352 @@ class PUT(unittest.TestCase):
         self.assertEquals(parsed_data["error"], "Selling 20 units of the asset with id 0 in the portfolio of john would result in a negative quantity. The operation was aborted.")
         self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
     
-class DELETE(unittest.TestCase):
-    def setUp(self):
-        server = __import__("server", globals(), locals(), [''], -1)
-        server.SECURED = False
-        self.app = server.app.test_client()
-        
-    def tearDown(self):
-        del sys.modules[server.__name__]
+    def test_update_asset_holdings(self):
+        database = dict()
+        database["user_john"] = {"name":"john"}
+        database["holdings_john"] = {"0":"5.0"}
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":1286.59,"class":"commodity"}
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.put(url_version+"/portfolios/john/assets/0", data='{"quantity":10}')
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals(float(database["holdings_john"]["0"]), 15.0)
+        response = self.app.put(url_version+"/portfolios/john/assets/0", data='{"quantity":-16}')
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        self.assertEquals(float(database["holdings_john"]["0"]), 15.0)
+        response = self.app.put(url_version+"/portfolios/john/assets/0", data='{"quantity":-15}')
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertFalse("holdings_john" in database)
 
-    def test_delete_asset(self):
+    def test_update_asset_migrates_legacy(self):
+        database = dict()
+        database["user_john"] = {"name":"john", "data":"6a6f686e;33303b3335"}
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":1286.59,"class":"commodity"}
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.put(url_version+"/portfolios/john/assets/0", data='{"quantity":-2}')
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals(database["user_john"]["name"], "john")
+        self.assertFalse("data" in database["user_john"])
+        self.assertEquals(float(database["holdings_john"]["0"]), 3.0)
+
+    def test_update_asset_nav(self):
+        database = dict()
+        database["user_john"] = {"name":"john"}
+        database["holdings_john"] = {"0":"5.0"}
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":10,"class":"commodity"}
+        database["asset_id_1"] = {"id": 1,"name":"NYC real estate index","price":20,"class":"real-estate"}
+        server.redis_server = FakeRedisServer(database)
+        self.app.put(url_version+"/portfolios/john/assets/0", data='{"quantity":-2}')
+        self.assertEquals(float(database["user_john"]["nav"]), 30)
+        self.app.post(url_version+"/portfolios/john/assets", data='{"asset_id":1,"quantity":2}')
+        self.assertEquals(float(database["user_john"]["nav"]), 70)
+        self.app.delete(url_version+"/portfolios/john/assets/0")
+        self.assertEquals(float(database["user_john"]["nav"]), 40)
+        self.app.put(url_version+"/portfolios/john/assets/1", data='{"quantity":-2}')
+        self.assertEquals(database["user_john"]["nav"], "0")
+
+    def test_update_prices(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":"10.0","class":"commodity"}
+        database["asset_id_1"] = {"id": 1,"name":"NYC real estate index","price":"20.0","class":"real-estate"}
+        database["asset_id_2"] = {"id": 2,"name":"brent crude oil","price":"5.0","class":"commodity"}
+        database["user_john"] = {"name":"john", "nav":"70.0"}
+        database["holdings_john"] = {"0":"5.0", "1":"1.0"}
+        database["user_jeremy"] = {"name":"jeremy", "nav":"20.0"}
+        database["holdings_jeremy"] = {"1":"1.0"}
+        database["user_alice"] = {"name":"alice", "nav":"5.0"}
+        database["holdings_alice"] = {"2":"1.0"}
+        database["holders_0"] = set(["john"])
+        database["holders_1"] = set(["john", "jeremy"])
+        database["holders_2"] = set(["alice"])
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.put(url_version+"/assets/prices", data='{"prices":[{"asset_id":0,"price":11},{"asset_id":1,"price":25.5}]}')
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals(json.loads(response.data), {"assets":2, "portfolios":2})
+        self.assertEquals(float(database["user_john"]["nav"]), 80.5)
+        self.assertEquals(float(database["user_jeremy"]["nav"]), 25.5)
+        self.assertEquals(database["user_alice"]["nav"], "5.0")
+
+    def test_update_prices_scripts_flushed(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":"10.0","class":"commodity"}
+        database["user_john"] = {"name":"john", "nav":"50.0"}
+        database["holdings_john"] = {"0":"5.0"}
+        database["holders_0"] = set(["john"])
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.put(url_version+"/assets/prices", data='{"prices":[{"asset_id":0,"price":11}]}')
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        server.redis_server.script_flush() # Redis restarted
+        response = self.app.put(url_version+"/assets/prices", data='{"prices":[{"asset_id":0,"price":12}]}')
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals(json.loads(response.data), {"assets":1, "portfolios":1})
+        self.assertEquals(float(database["user_john"]["nav"]), 60)
+        self.assertFalse(server.redis_server.scripts_flushed)
+
+    def test_update_prices_not_valid(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":"10.0","class":"commodity"}
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.put(url_version+"/assets/prices", data='{"prices":[{"asset_id":0,"price":11},{"asset_id":7,"price":1}]}')
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        self.assertEquals(json.loads(response.data)["error"], "Asset ids [7] do not exist in database")
+        self.assertEquals(database["asset_id_0"]["price"], "10.0")
+        response = self.app.put(url_version+"/assets/prices", data='{"prices":[{"asset_id":0}]}')
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        response = self.app.put(url_version+"/assets/prices", data='{"prices":[{"asset_id":0,"price":-1}]}')
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        server.PRICES_BATCH_MAX = 1
+        response = self.app.put(url_version+"/assets/prices", data='{"prices":[{"asset_id":0,"price":1},{"asset_id":0,"price":2}]}')
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_update_prices_not_finite(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":"10.0","class":"commodity"}
+        database["asset_id_1"] = {"id": 1,"name":"silver","price":"2.0","class":"commodity"}
+        database["user_john"] = {"name":"john", "nav":"70.0"}
+        database["holdings_john"] = {"0":"5.0", "1":"10.0"}
+        database["holders_0"] = set(["john"])
+        database["holders_1"] = set(["john"])
+        server.redis_server = FakeRedisServer(database)
+        for price in ["Infinity", "NaN", '"inf"']:
+            response = self.app.put(url_version+"/assets/prices", data='{"prices":[{"asset_id":0,"price":'+price+'}]}')
+            self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        response = self.app.put(url_version+"/assets/prices", data='{"prices":[{"asset_id":0,"price":1e308},{"asset_id":1,"price":3}]}')
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        parsed_data = json.loads(response.data)
+        self.assertEquals(parsed_data["error"], "The prices of the assets with ids [0] were not set, as the value of a holding or a NAV would be out of range.")
+        self.assertEquals((parsed_data["assets"], parsed_data["portfolios"]), (1, 1))
+        self.assertEquals(database["asset_id_0"]["price"], "10.0")
+        self.assertEquals(float(database["user_john"]["nav"]), 80)
+
+    def test_import_assets(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":"10.0","class":"commodity"}
+        database["user_john"] = {"name":"john", "nav":"50.0"}
+        database["holdings_john"] = {"0":"5.0"}
+        database["holders_0"] = set(["john"])
+        database["exposure_class_john"] = {"commodity":"50.0"}
+        database["exposure_asset_john"] = {"0":"50.0"}
+        server.redis_server = FakeRedisServer(database)
+        data = "id,name,class,price\r\n0,gold,metal,12\r\n1,silver,metal,17.5\r\n2,,metal,1\r\n3,copper,metal,-1\r\n"
+        response = self.app.post(url_version+"/assets/import", data=data, content_type="text/csv")
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        report = json.loads(response.data)
+        self.assertEquals((report["read"], report["created"], report["updated"], report["invalid"]), (4, 1, 1, 2))
+        self.assertEquals(report["errors"], ["Row 3: Asset 2 must have a name and a class", "Row 4: Price value of asset 3 must be positive"])
+        self.assertEquals(database["asset_id_1"], {"id":"1", "name":"silver", "class":"metal", "price":"17.5"})
+        self.assertEquals(float(database["user_john"]["nav"]), 60)
+        self.assertEquals(server.exposure_values(database["exposure_class_john"]), {"metal":60})
+        self.assertEquals(database["exposure_asset_john"], {"0":"60.0"})
+
+    def test_import_assets_json(self):
+        database = dict()
+        server.redis_server = FakeRedisServer(database)
+        data = '{"id":4,"name":"silver","class":"commodity","price":17.1}\n\n{"id":5}\nnot json\n'
+        response = self.app.post(url_version+"/assets/import", data=data, content_type="application/x-ndjson")
+        report = json.loads(response.data)
+        self.assertEquals((report["read"], report["created"], report["invalid"]), (3, 1, 2))
+        self.assertEquals(database["asset_id_4"]["price"], "17.1")
+        response = self.app.post(url_version+"/assets/import", data='{"assets":[{"id":4,"name":"silver","class":"commodity","price":18}]}')
+        self.assertEquals(json.loads(response.data)["updated"], 1)
+        self.assertEquals(database["asset_id_4"]["price"], "18.0")
+        response = self.app.post(url_version+"/assets/import", data='{"asset":[]}')
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+
+    def test_import_assets_batches(self):
+        database = dict()
+        server.redis_server = FakeRedisServer(database)
+        rows = [{"id": i, "name": "asset "+str(i), "class": "equity", "price": i} for i in range(5)]
+        server.ASSETS_IMPORT_ERRORS_MAX = 1
+        report = server.import_assets(rows + [{"id": -1}, {"id": -2}], batch_size=2)
+        self.assertEquals((report["created"], report["invalid"], len(report["errors"])), (5, 2, 1))
+        self.assertEquals(int(database["asset_catalog_version"]), 3)
+
+    def test_import_assets_scripts_flushed(self):
+        database = dict()
+        server.redis_server = FakeRedisServer(database)
+        self.assertEquals(server.import_assets([{"id": 4, "name": "silver", "class": "commodity", "price": 17}])["created"], 1)
+        server.redis_server.script_flush() # Redis restarted
+        response = self.app.post(url_version+"/assets/import", data='{"assets":[{"id":4,"name":"silver","class":"commodity","price":18}]}')
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals(json.loads(response.data)["updated"], 1)
+        self.assertEquals(database["asset_id_4"]["price"], "18.0")
+
+    def test_import_assets_out_of_range(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":"10.0","class":"commodity"}
+        database["user_john"] = {"name":"john", "nav":"50.0"}
+        database["holdings_john"] = {"0":"5.0"}
+        database["holders_0"] = set(["john"])
+        server.redis_server = FakeRedisServer(database)
+        data = "id,name,class,price\r\n0,gold,commodity,1e308\r\n7,silver,metal,17\r\n8,copper,metal,nan\r\n"
+        response = self.app.post(url_version+"/assets/import", data=data, content_type="text/csv")
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        report = json.loads(response.data)
+        self.assertEquals((report["read"], report["created"], report["updated"], report["invalid"]), (3, 1, 0, 2))
+        self.assertEquals(sorted(report["errors"]), ["Row 1: The price of asset 0 would put the value of a holding or a NAV out of range",
+                                                     "Row 3: Price value of asset 8 is not a finite number"])
+        self.assertEquals(database["asset_id_0"]["price"], "10.0")
+        self.assertEquals(database["user_john"]["nav"], "50.0")
+        self.assertEquals(database["asset_id_7"]["price"], "17.0")
+        self.assertEquals(int(database["asset_catalog_version"]), 1)
+
+    def test_update_asset_no_holding(self):
+        database = dict()
+        database["user_john"] = {"name":"john"}
+        database["holdings_john"] = {"1":"5.0"}
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.put(url_version+"/portfolios/john/assets/0", data='{"quantity":5}')
+        self.assertEquals(response.status_code, HTTP_404_NOT_FOUND)
+        self.assertEquals(database["holdings_john"], {"1":"5.0"})
+
+    def test_run_lua_script_reloads(self):
+        server.redis_server = FakeRedisServer({"user_john": {"name":"john"}})
+        server.lua_shas["remove_holding"] = "flushed"
+        self.assertEquals(server.run_lua_script("remove_holding", ["user_john", "holdings_john"], [0]), server.TRADE_OK)
+        self.assertEquals(server.lua_shas["remove_holding"], "remove_holding")
+
+    def test_run_trade_script_codes(self):
+        database = dict()
+        database["user_john"] = {"name":"john"}
+        database["holdings_john"] = {"0":"5.0"}
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":1286.59,"class":"commodity"}
+        server.redis_server = FakeRedisServer(database)
+        self.assertEquals(server.run_trade_script("buy_sell", "jane", 0, 1), server.TRADE_USER_NOT_FOUND)
+        self.assertEquals(server.run_trade_script("buy_sell", "john", 0, -6), server.TRADE_NEGATIVE)
+        self.assertEquals(server.run_trade_script("create_holding", "john", 0, 1), server.TRADE_ALREADY_EXISTS)
+        self.assertEquals(server.run_trade_script("create_holding", "john", 7, 1), server.TRADE_ASSET_NOT_FOUND)
+        self.assertEquals(server.run_trade_script("remove_holding", "john", 0), server.TRADE_OK)
+        self.assertEquals(server.run_trade_script("buy_sell", "john", 0, 1), server.TRADE_NO_DATA)
+
+class Trades(unittest.TestCase):
+    def setUp(self):
+        server = __import__("server", globals(), locals(), [''], -1)
+        server.SECURED = False
+        self.app = server.app.test_client()
+        self.database = dict()
+        self.database["user_john"] = {"name":"john"}
+        self.database["holdings_john"] = {"0":"5.0", "1":"1.0"}
+        self.database["holders_0"] = set(["john"])
+        self.database["holders_1"] = set(["john"])
+        self.database["asset_id_0"] = {"id": 0,"name":"gold","price":10,"class":"commodity"}
+        self.database["asset_id_1"] = {"id": 1,"name":"NYC real estate index","price":20,"class":"real-estate"}
+        self.database["asset_id_2"] = {"id": 2,"name":"brent crude oil","price":5,"class":"commodity"}
+        server.redis_server = FakeRedisServer(self.database)
+        
+    def tearDown(self):
+        del sys.modules[server.__name__]
+
+    def test_create_trades(self):
+        response = self.app.post(url_version+"/portfolios/john/trades", data='{"trades":[{"asset_id":0,"quantity":-2},{"asset_id":1,"quantity":-1},{"asset_id":2,"quantity":4},{"asset_id":0,"quantity":0.5}]}')
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals(self.database["holdings_john"], {"0":"3.5", "2":"4.0"})
+        self.assertEquals(float(self.database["user_john"]["nav"]), 55)
+        self.assertFalse("holders_1" in self.database)
+        self.assertEquals(self.database["holders_2"], set(["john"]))
+
+    def test_create_trades_not_finite(self):
+        for quantity in ["1e400", "-1e400", "NaN"]:
+            response = self.app.post(url_version+"/portfolios/john/trades", data='{"trades":[{"asset_id":2,"quantity":1},{"asset_id":1,"quantity":'+quantity+'}]}')
+            self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+            self.assertEquals(json.loads(response.data)["leg"], 1)
+        response = self.app.post(url_version+"/portfolios/john/trades", data='{"trades":[{"asset_id":2,"quantity":1},{"asset_id":0,"quantity":1e308}]}')
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        self.assertEquals(json.loads(response.data)["leg"], 1)
+        self.assertEquals(self.database["holdings_john"], {"0":"5.0", "1":"1.0"})
+        self.assertFalse("holders_2" in self.database)
+        code = server.run_lua_script("apply_trades", ["user_john", "holdings_john"], ["john", 0, "5.0", "inf"])
+        self.assertEquals(code, server.TRADE_INVALID_QUANTITY)
+        self.assertEquals(self.database["holdings_john"], {"0":"5.0", "1":"1.0"})
+
+    def test_create_trades_all_or_nothing(self):
+        response = self.app.post(url_version+"/portfolios/john/trades", data='{"trades":[{"asset_id":2,"quantity":4},{"asset_id":0,"quantity":-6}]}')
+        parsed_data = json.loads(response.data)
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        self.assertEquals(parsed_data["leg"], 1)
+        self.assertEquals(self.database["holdings_john"], {"0":"5.0", "1":"1.0"})
+        response = self.app.post(url_version+"/portfolios/john/trades", data='{"trades":[{"asset_id":0,"quantity":1},{"asset_id":2,"quantity":-1}]}')
+        self.assertEquals(response.status_code, HTTP_404_NOT_FOUND)
+        self.assertEquals(json.loads(response.data)["leg"], 1)
+        self.assertEquals(self.database["holdings_john"], {"0":"5.0", "1":"1.0"})
+
+    def test_create_trades_not_valid(self):
+        response = self.app.post(url_version+"/portfolios/john/trades", data='{"trades":[{"asset_id":0,"quantity":1},{"asset_id":7,"quantity":1}]}')
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        self.assertEquals(json.loads(response.data), {"error":"Asset id 7 does not exist in database", "leg":1})
+        response = self.app.post(url_version+"/portfolios/john/trades", data='{"trades":[]}')
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        response = self.app.post(url_version+"/portfolios/john/trades", data='{"trades":[{"asset_id":0}]}')
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        response = self.app.post(url_version+"/portfolios/jane/trades", data='{"trades":[{"asset_id":0,"quantity":1}]}')
+        self.assertEquals(response.status_code, HTTP_404_NOT_FOUND)
+
+    def test_create_trades_concurrent_update(self):
+        database = self.database
+        class ConcurrentRedisServer(FakeRedisServer):
+            def apply_trades(self, keys, args):
+                if database["holdings_john"]["0"] == "5.0":
+                    database["holdings_john"]["0"] = "6.0" # trade done meanwhile
+                return FakeRedisServer.apply_trades(self, keys, args)
+        server.redis_server = ConcurrentRedisServer(database)
+        response = self.app.post(url_version+"/portfolios/john/trades", data='{"trades":[{"asset_id":0,"quantity":1}]}')
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals(database["holdings_john"]["0"], "7.0")
+
+    def test_create_trades_migrates_legacy(self):
+        self.database["user_john"] = {"name":"john", "data":"6a6f686e;33303b3335"}
+        del self.database["holdings_john"]
+        response = self.app.post(url_version+"/portfolios/john/trades", data='{"trades":[{"asset_id":0,"quantity":-5}]}')
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertFalse("holdings_john" in self.database)
+        self.assertEquals(self.database["user_john"]["nav"], "0")
+
+    def test_create_bulk_trades(self):
+        self.database["user_jeremy"] = {"name":"jeremy"}
+        server.BULK_TRADES_BATCH_SIZE = 2
+        trades = [{"user":"john","asset_id":0,"quantity":-5}, {"user":"jeremy","asset_id":2,"quantity":3},
+                  {"user":"john","asset_id":1,"quantity":-2}, {"user":"jane","asset_id":0,"quantity":1},
+                  {"user":"john","asset_id":7,"quantity":1}, {"user":"jeremy","asset_id":2,"quantity":-1}, {"user":"john"}]
+        response = self.app.post(url_version+"/trades", data=json.dumps({"trades":trades}))
+        parsed_data = json.loads(response.data)
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals((parsed_data["applied"], parsed_data["failed"]), (3, 4))
+        self.assertEquals([result["status"] for result in parsed_data["results"]], [200, 200, 400, 404, 400, 200, 400])
+        self.assertEquals(parsed_data["results"][3]["error"], "User jane not found")
+        self.assertEquals(self.database["holdings_john"], {"1":"1.0"})
+        self.assertEquals(self.database["holdings_jeremy"], {"2":"2.0"})
+        self.assertEquals(float(self.database["user_jeremy"]["nav"]), 10)
+
+    def test_create_bulk_trades_ndjson(self):
+        data = '{"user":"john","asset_id":0,"quantity":1}\nnot json\n\n{"user":"john","asset_id":0,"quantity":2}\n'
+        response = self.app.post(url_version+"/trades", data=data, content_type="application/x-ndjson")
+        parsed_data = json.loads(response.data)
+        self.assertEquals([result["status"] for result in parsed_data["results"]], [200, 400, 200])
+        self.assertEquals(self.database["holdings_john"]["0"], "8.0")
+
+    def test_create_bulk_trades_not_finite(self):
+        data = '\n'.join(['{"user":"john","asset_id":0,"quantity":1e400}', '{"user":"john","asset_id":0,"quantity":NaN}',
+                          '{"user":"john","asset_id":0,"quantity":1e308}', '{"user":"john","asset_id":1,"quantity":-1}'])
+        response = self.app.post(url_version+"/trades", data=data, content_type="application/x-ndjson")
+        parsed_data = json.loads(response.data)
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals([result["status"] for result in parsed_data["results"]], [400, 400, 400, 200])
+        self.assertEquals(self.database["holdings_john"], {"0":"5.0"})
+        self.assertEquals(float(self.database["user_john"]["nav"]), 50)
+
+    def test_create_bulk_trades_not_valid(self):
+        response = self.app.post(url_version+"/trades", data='{"trades":3}')
+        self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+
+class DELETE(unittest.TestCase):
+    def setUp(self):
+        server = __import__("server", globals(), locals(), [''], -1)
+        server.SECURED = False
+        self.app = server.app.test_client()
+        
+    def tearDown(self):
+        del sys.modules[server.__name__]
+
+    def test_delete_asset(self):
         database = dict()
         database["user_john"] = {"name":"john", "data":"6a6f686e;33303b3335"}
         database["asset_id_0"] = {"id": 0,"name":"gold","price":1286.59,"class":"commodity"}
@@ -808,6 +2029,37 @@ class DELETE(unittest.TestCase):
         self.assertEquals(response.data, '')
         self.assertEquals(response.status_code, HTTP_204_NO_CONTENT)
     
+    def test_delete_asset_holdings(self):
+        database = dict()
+        database["user_john"] = {"name":"john"}
+        database["holdings_john"] = {"0":"5.0", "1":"2.0"}
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.delete(url_version+"/portfolios/john/assets/0")
+        self.assertEquals(response.status_code, HTTP_204_NO_CONTENT)
+        self.assertEquals(database["holdings_john"], {"1":"2.0"})
+
+    def test_delete_user_holdings(self):
+        database = dict()
+        database["user_john"] = {"name":"john"}
+        database["holdings_john"] = {"0":"5.0"}
+        database["list_users"] = set(["john"])
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.delete(url_version+"/portfolios/john")
+        self.assertEquals(response.status_code, HTTP_204_NO_CONTENT)
+        self.assertFalse("holdings_john" in database)
+
+    def test_delete_user_holders(self):
+        database = dict()
+        database["user_john"] = {"name":"john", "data":"6a6f686e;33303b3335"}
+        database["holders_0"] = set(["john", "jeremy"])
+        database["list_users"] = set(["john", "jeremy"])
+        server.redis_server = FakeRedisServer(database)
+        response = self.app.delete(url_version+"/portfolios/john")
+        self.assertEquals(response.status_code, HTTP_204_NO_CONTENT)
+        self.assertEquals(database["holders_0"], set(["jeremy"]))
+        self.assertEquals(database["list_users"], set(["jeremy"]))
+        self.assertFalse("user_john" in database)
+
 class Utility(unittest.TestCase):
     def setUp(self):
         server = __import__("server", globals(), locals(), [''], -1)
@@ -825,11 +2077,42 @@ class Utility(unittest.TestCase):
         valid = server.is_valid(data, ["key2"])
         self.assertFalse(valid)
         
+    def test_run_lua_script_empty_pipeline(self):
+        server.redis_server = FakeRedisServer(dict())
+        pipe = server.redis_server.pipeline()
+        self.assertTrue(server.run_lua_script("buy_sell", ["user_john"], [], client=pipe) is pipe)
+        self.assertEquals(len(pipe), 1)
+
     def test_init_redis_connection(self):
         server.redis_server = FakeRedisServer()
         with self.assertRaises(server.RedisConnectionException):
             server.init_redis("localhost:5000", 5000, None)
             
+    def test_create_app(self):
+        init_redis = server.init_redis
+        calls = []
+        server.init_redis = lambda *args: calls.append(args)
+        try:
+            self.assertTrue(server.create_app(setup=False) is server.app)
+        finally:
+            server.init_redis = init_redis
+        creds = server.determine_credentials()
+        self.assertEquals(calls, [(creds.host, creds.port, creds.password, False)])
+            
+    def test_serve_async(self):
+        execv = os.execv
+        calls = []
+        os.execv = lambda path, args: calls.append(args)
+        try:
+            server.serve_async(5000, 2, 100)
+        finally:
+            os.execv = execv
+        args = calls[0]
+        self.assertEquals(args[-1], "server:create_app(setup=False)")
+        self.assertEquals(args[args.index("--worker-class") + 1], "gevent")
+        self.assertEquals(args[args.index("--worker-connections") + 1], "100")
+        self.assertEquals(args[args.index("--bind") + 1], "0.0.0.0:5000")
+            
     #def test_init_redis_admin(self):
     #    server.SECURED = True
     #    database = dict()
@@ -837,6 +2120,822 @@ class Utility(unittest.TestCase):
     #    server.init_redis("localhost:5000", 5000, None)
     #    self.assertEquals(server.redis_server.database["admin_password_admin"], {"hash_password":""})
             
+class AuthCache(unittest.TestCase):
+    def setUp(self):
+        server = __import__("server", globals(), locals(), [''], -1)
+        server.SECURED = True
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        del sys.modules[server.__name__]
+
+    def test_lookup_miss_then_hit(self):
+        cache = server.AuthCache(10, 60)
+        self.assertFalse(cache.lookup("john", "12345", "hash"))
+        cache.store("john", "12345", "hash")
+        self.assertTrue(cache.lookup("john", "12345", "hash"))
+        self.assertEquals(cache.hits, 1)
+        self.assertEquals(cache.misses, 1)
+
+    def test_no_plaintext_stored(self):
+        cache = server.AuthCache(10, 60)
+        cache.store("john", "12345", "hash")
+        self.assertFalse("12345" in str(cache.entries))
+
+    def test_wrong_password(self):
+        cache = server.AuthCache(10, 60)
+        cache.store("john", "12345", "hash")
+        self.assertFalse(cache.lookup("john", "54321", "hash"))
+
+    def test_stored_hash_changed(self):
+        cache = server.AuthCache(10, 60)
+        cache.store("john", "12345", "hash")
+        self.assertFalse(cache.lookup("john", "12345", "new_hash"))
+        self.assertFalse(cache.lookup("john", "12345", "hash"))
+
+    def test_expired(self):
+        cache = server.AuthCache(10, -1)
+        cache.store("john", "12345", "hash")
+        self.assertFalse(cache.lookup("john", "12345", "hash"))
+
+    def test_bounded(self):
+        cache = server.AuthCache(2, 60)
+        cache.store("john", "1", "hash")
+        cache.store("jeremy", "2", "hash")
+        cache.store("alice", "3", "hash")
+        self.assertEquals(len(cache.entries), 2)
+        self.assertFalse(cache.lookup("john", "1", "hash"))
+        self.assertTrue(cache.lookup("alice", "3", "hash"))
+
+    def test_invalidate(self):
+        cache = server.AuthCache(10, 60)
+        cache.store("john", "12345", "hash")
+        cache.store("john", "12345", "hash", admin=True)
+        cache.invalidate("john")
+        self.assertFalse(cache.lookup("john", "12345", "hash"))
+        self.assertTrue(cache.lookup("john", "12345", "hash", admin=True))
+
+    def test_stats(self):
+        cache = server.AuthCache(10, 60)
+        cache.store("john", "12345", "hash")
+        cache.lookup("john", "12345", "hash")
+        cache.lookup("john", "wrong", "hash")
+        stats = cache.stats()
+        self.assertEquals(stats["size"], 1)
+        self.assertEquals(stats["hits"], 1)
+        self.assertEquals(stats["misses"], 1)
+        self.assertEquals(stats["hitRatio"], 0.5)
+
+    def test_check_auth_cached(self):
+        database = dict()
+        database["password_john"] = {"hash_password":generate_password_hash("12345")}
+        server.redis_server = FakeRedisServer(database)
+        self.assertTrue(server.check_auth("john", "12345"))
+        self.assertTrue(server.check_auth("john", "12345"))
+        self.assertFalse(server.check_auth("john", "wrong"))
+        self.assertEquals(server.auth_cache.hits, 1)
+        self.assertEquals(server.auth_cache.misses, 2)
+
+    def test_check_auth_password_changed(self):
+        database = dict()
+        database["password_john"] = {"hash_password":generate_password_hash("12345")}
+        server.redis_server = FakeRedisServer(database)
+        self.assertTrue(server.check_auth("john", "12345"))
+        database["password_john"] = {"hash_password":generate_password_hash("67890")}
+        self.assertFalse(server.check_auth("john", "12345"))
+        self.assertTrue(server.check_auth("john", "67890"))
+
+    def test_delete_user_invalidates(self):
+        admin_authorization = {'Authorization': 'Basic %s' % b64encode('admin:admin_password')}
+        database = dict()
+        database["admin_password_admin"] = {"hash_password":generate_password_hash("admin_password")}
+        database["password_john"] = {"hash_password":generate_password_hash("12345")}
+        database["user_john"] = {"name":"john", "data":""}
+        database["list_users"] = set(["john"])
+        server.redis_server = FakeRedisServer(database)
+        self.assertTrue(server.check_auth("john", "12345"))
+        response = self.app.delete(url_version+"/portfolios/john", headers=admin_authorization)
+        self.assertEquals(response.status_code, HTTP_204_NO_CONTENT)
+        self.assertEquals([k for k in server.auth_cache.entries if k[1] == "john"], [])
+
+    def test_get_stats(self):
+        admin_authorization = {'Authorization': 'Basic %s' % b64encode('admin:admin_password')}
+        database = dict()
+        database["admin_password_admin"] = {"hash_password":generate_password_hash("admin_password")}
+        server.redis_server = FakeRedisServer(database)
+        self.app.get(url_version+"/stats", headers=admin_authorization)
+        response = self.app.get(url_version+"/stats", headers=admin_authorization)
+        parsed_data = json.loads(response.data)
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals(parsed_data["authCache"]["hits"], 1)
+        self.assertEquals(parsed_data["authCache"]["misses"], 1)
+
+class Metrics(unittest.TestCase):
+    def setUp(self):
+        server = __import__("server", globals(), locals(), [''], -1)
+        server.SECURED = False
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        del sys.modules[server.__name__]
+
+    def test_get_metrics(self):
+        database = dict()
+        database["user_john"] = {"name":"john", "nav":"50.0"}
+        server.redis_server = FakeRedisServer(database)
+        self.app.get(url_version+"/portfolios/john/nav")
+        self.app.get(url_version+"/portfolios/jeremy/nav")
+        self.app.get("/nowhere")
+        server.metrics.observe("portfoliomgmt_function_duration_seconds", (("function", "check_auth"),), 0.003)
+        server.metrics.observe("portfoliomgmt_function_duration_seconds", (("function", "check_auth"),), 20)
+        response = self.app.get("/metrics")
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        lines = response.data.splitlines()
+        self.assertTrue('portfoliomgmt_http_requests_total{method="GET",route="/api/v1/portfolios/<user>/nav",status="200"} 1' in lines)
+        self.assertTrue('portfoliomgmt_http_requests_total{method="GET",route="/api/v1/portfolios/<user>/nav",status="404"} 1' in lines)
+        self.assertTrue('portfoliomgmt_http_requests_total{method="GET",route="unmatched",status="404"} 1' in lines)
+        self.assertTrue('portfoliomgmt_http_request_duration_seconds_count{method="GET",route="/api/v1/portfolios/<user>/nav"} 2' in lines)
+        self.assertTrue("# TYPE portfoliomgmt_function_duration_seconds histogram" in lines)
+        buckets = [line for line in lines if line.startswith('portfoliomgmt_function_duration_seconds_bucket')]
+        self.assertEquals(buckets[0], 'portfoliomgmt_function_duration_seconds_bucket{function="check_auth",le="0.005"} 1')
+        self.assertEquals(buckets[-2:], ['portfoliomgmt_function_duration_seconds_bucket{function="check_auth",le="10"} 1',
+                                         'portfoliomgmt_function_duration_seconds_bucket{function="check_auth",le="+Inf"} 2'])
+        self.assertTrue('portfoliomgmt_function_duration_seconds_sum{function="check_auth"} 20.003' in lines)
+
+    def test_processes_aggregated(self):
+        database = dict()
+        server.redis_server = FakeRedisServer(database)
+        workers = [server.Metrics(), server.Metrics()]
+        for worker in workers:
+            worker.inc("portfoliomgmt_http_requests_total", (("method", "GET"), ("route", "/"), ("status", 200)), 2)
+            worker.flush()
+        workers[0].inc("portfoliomgmt_http_requests_total", (("method", "GET"), ("route", "/"), ("status", 200)))
+        workers[0].flush()
+        self.assertEquals(database[server.METRICS_KEY], {'portfoliomgmt_http_requests_total{method="GET",route="/",status="200"}' : "5"})
+        self.assertTrue('route="/",status="200"} 5\n' in workers[1].render())
+
+    def test_flush_unavailable(self):
+        class FakeRedisServerDown(FakeRedisServer):
+            def hincrby(self, key, field, amount=1):
+                raise server.ConnectionError("down")
+        server.redis_server = FakeRedisServerDown(dict())
+        metrics = server.Metrics()
+        metrics.inc("portfoliomgmt_http_requests_total", (("status", 200),))
+        metrics.observe("portfoliomgmt_function_duration_seconds", (("function", "f"),), 0.1)
+        metrics.flush()
+        database = dict()
+        server.redis_server = FakeRedisServer(database)
+        metrics.flush()
+        self.assertEquals(database[server.METRICS_KEY]['portfoliomgmt_http_requests_total{status="200"}'], "1")
+        self.assertEquals(database[server.METRICS_KEY]['portfoliomgmt_function_duration_seconds_count{function="f"}'], "1")
+
+    def test_redis_commands_observed(self):
+        pool = server.RedisPool(connection_class=FakeConnection)
+        pool.release(pool.get_connection("HGET"))
+        pool.release(pool.get_connection("MULTI"))
+        pool.release(pool.get_connection("pubsub"))
+        self.assertEquals(sorted(labels for metric, labels in server.metrics.histograms),
+                          [(("command", "HGET"),), (("command", "PIPELINE"),)])
+
+class PortfoliosCache(unittest.TestCase):
+    def setUp(self):
+        server = __import__("server", globals(), locals(), [''], -1)
+        server.SECURED = False
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        del sys.modules[server.__name__]
+
+    def test_get_miss_then_hit(self):
+        cache = server.ResponseCache(10, 60)
+        self.assertEquals(cache.get(("root",), ("1", "1")), None)
+        cache.put(("root",), ("1", "1"), "body")
+        self.assertEquals(cache.get(("root",), ("1", "1")), "body")
+        self.assertEquals(cache.get(("root",), ("2", "1")), None)
+        self.assertEquals(cache.stats()["hitRatio"], 1.0 / 3)
+
+    def test_expired(self):
+        cache = server.ResponseCache(10, -1)
+        cache.put(("root",), ("1", "1"), "body")
+        self.assertEquals(cache.get(("root",), ("1", "1")), None)
+
+    def test_bounded(self):
+        cache = server.ResponseCache(2, 60)
+        for page in range(3):
+            cache.put(("root", page), ("1", "1"), "body")
+        self.assertEquals(len(cache.entries), 2)
+        self.assertEquals(cache.get(("root", 0), ("1", "1")), None)
+        self.assertEquals(cache.get(("root", 2), ("1", "1")), "body")
+
+    def test_list_portfolios_cached(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":"10.0","class":"commodity"}
+        database["user_john"] = {"name":"john"}
+        database["holdings_john"] = {"0":"5.0"}
+        database["holders_0"] = set(["john"])
+        database["list_users"] = set(["john"])
+        server.redis_server = FakeRedisServer(database)
+        listing = lambda: json.loads(self.app.get(url_version+"/portfolios").data)["portfolios"]
+        self.assertEquals(len(listing()), 1)
+        del database["user_john"] # not a write handler, not seen
+        database["user_john"] = {"name":"john"}
+        self.assertEquals(listing()[0]["netAssetValue"], 50)
+        self.assertEquals(server.portfolios_cache.hits, 1)
+        self.app.post(url_version+"/portfolios", data='{"user":"jeremy"}')
+        self.assertEquals(len(listing()), 2)
+        server.run_trade_script("buy_sell", "john", 0, 1)
+        self.assertEquals([p["netAssetValue"] for p in listing() if p["user"] == "john"], [60])
+        server.set_asset_prices({0: 20})
+        self.assertEquals([p["netAssetValue"] for p in listing() if p["user"] == "john"], [120])
+        self.app.delete(url_version+"/portfolios/jeremy")
+        self.assertEquals(len(listing()), 1)
+        self.assertEquals(len(json.loads(self.app.get(url_version+"/portfolios?limit=10").data)["portfolios"]), 1)
+        self.assertEquals(server.portfolios_cache.stats()["hits"], 1)
+
+class FakeConnection(object):
+    def __init__(self, **kwargs):
+        self.pid = os.getpid()
+        self.kwargs = kwargs
+        self.disconnected = False
+    
+    def send_command(self, *args):
+        raise server.ConnectionError()
+    
+    def disconnect(self):
+        self.disconnected = True
+
+class RedisPool(unittest.TestCase):
+    def setUp(self):
+        server = __import__("server", globals(), locals(), [''], -1)
+        server.SECURED = False
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        del sys.modules[server.__name__]
+
+    def test_exhausted(self):
+        pool = server.RedisPool(max_connections=1, timeout=0.01, connection_class=FakeConnection)
+        connection = pool.get_connection("GET")
+        self.assertEquals(connection.kwargs["socket_timeout"], server.REDIS_SOCKET_TIMEOUT)
+        with self.assertRaises(server.RedisPoolExhaustedException):
+            pool.get_connection("GET")
+        stats = pool.stats()
+        self.assertEquals((stats["opened"], stats["inUse"], stats["idle"], stats["waits"], stats["timeouts"]), (1, 1, 0, 1, 1))
+        pool.release(connection)
+        self.assertTrue(pool.get_connection("GET") is connection)
+        self.assertEquals(pool.stats()["idle"], 0)
+
+    def test_not_blocking(self):
+        pool = server.RedisPool(max_connections=1, timeout=10, blocking=False, connection_class=FakeConnection)
+        pool.get_connection("GET")
+        with self.assertRaises(server.RedisPoolExhaustedException):
+            pool.get_connection("GET")
+        self.assertEquals((pool.stats()["waits"], pool.stats()["timeouts"]), (0, 1))
+
+    def test_health_check(self):
+        pool = server.RedisPool(health_check_interval=30, connection_class=FakeConnection)
+        connection = pool.get_connection("GET")
+        pool.release(connection)
+        self.assertFalse(pool.get_connection("GET").disconnected)
+        pool.release(connection)
+        connection.released_at -= 60
+        self.assertTrue(pool.get_connection("GET").disconnected)
+        self.assertEquals((pool.stats()["healthChecks"], pool.stats()["reconnects"]), (1, 1))
+
+    def test_redis_unavailable(self):
+        class FakeRedisServerStalled(FakeRedisServer):
+            def hmget(self, key, fields):
+                raise server.RedisPoolExhaustedException("No Redis connection available (pool of 1)")
+        server.redis_server = FakeRedisServerStalled(dict())
+        response = self.app.get(url_version+"/portfolios/john/nav")
+        self.assertEquals(response.status_code, server.HTTP_503_SERVICE_UNAVAILABLE)
+        self.assertEquals(response.headers["Retry-After"], "1")
+        self.assertTrue("pool of 1" in json.loads(response.data)["error"])
+
+def redis_round_trips(response):
+    """ Returns the Redis round trips of a request, from its Server-Timing header """
+    match = re.search(r'redis;dur=[0-9.]+;desc="([0-9]+) round trips?, ([0-9]+) commands?"', response.headers.get("Server-Timing", ""))
+    return int(match.group(1)) if match else None
+
+class WarningsHandler(logging.Handler):
+    def __init__(self):
+        logging.Handler.__init__(self, logging.WARNING)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(record.getMessage())
+
+class RedisTrace(unittest.TestCase):
+    def setUp(self):
+        server = __import__("server", globals(), locals(), [''], -1)
+        server.SECURED = False
+        self.app = server.app.test_client()
+        self.warnings = WarningsHandler()
+        server.app.logger.addHandler(self.warnings)
+        self.database = dict()
+        self.database["asset_id_0"] = {"id": 0,"name":"gold","price":10,"class":"commodity"}
+        self.database["asset_id_1"] = {"id": 1,"name":"silver","price":2,"class":"commodity"}
+        self.database["asset_id_2"] = {"id": 2,"name":"NYC real estate index","price":20,"class":"real-estate"}
+        self.database["user_john"] = {"name":"john", "nav":"70.0"}
+        self.database["holdings_john"] = {"0":"5.0", "1":"10.0"}
+        self.database["exposure_class_john"] = {"commodity":"70.0"}
+        self.database["exposure_asset_john"] = {"0":"50.0", "1":"20.0"}
+        self.database["list_users"] = set(["john"])
+        server.redis_server = server.TracedRedis(FakeRedisServer(self.database))
+        server.load_lua_scripts() # as init_redis, outside of the requests traced
+        server.asset_catalog.load()
+
+    def tearDown(self):
+        server.app.logger.removeHandler(self.warnings)
+        del sys.modules[server.__name__]
+
+    def test_round_trips_by_handler(self):
+        requests = [("get", url_version+"/portfolios", 3),
+                    ("get", url_version+"/portfolios", 1), # cached
+                    ("get", url_version+"/portfolios/john/assets", 2),
+                    ("get", url_version+"/portfolios/john/assets/0", 2),
+                    ("get", url_version+"/portfolios/john/nav", 2),
+                    ("get", url_version+"/portfolios/john/exposure", 2),
+                    ("get", url_version+"/valuation", 3), # holdings loaded, then prices
+                    ("put", url_version+"/portfolios/john/assets/0", 1),
+                    ("post", url_version+"/portfolios/john/trades", 2),
+                    ("delete", url_version+"/portfolios/john/assets/1", 1)]
+        bodies = {"put" : '{"quantity":1}', "post" : '{"trades":[{"asset_id":0,"quantity":1},{"asset_id":2,"quantity":1}]}'}
+        for method, url, round_trips in requests:
+            response = getattr(self.app, method)(url, data=bodies.get(method))
+            self.assertTrue(response.status_code < 300, url)
+            self.assertEquals((method, url, redis_round_trips(response)), (method, url, round_trips))
+        self.assertEquals(self.warnings.messages, [])
+
+    def test_server_timing(self):
+        with server.app.test_request_context("/"):
+            server.start_request_timer()
+            server.redis_server.hget("user_john", "name")
+            pipe = server.redis_server.pipeline(transaction=False)
+            self.assertEquals(len(pipe), 0)
+            pipe.execute() # nothing sent
+            pipe.hget("asset_id_0", "price").hget("asset_id_1", "price")
+            self.assertEquals(len(pipe), 2)
+            self.assertEquals(pipe.execute(), [10, 2])
+            response = server.report_redis_trace(server.app.response_class())
+        self.assertTrue(re.match(r'^redis;dur=[0-9]+\.[0-9]{3};desc="2 round trips, 3 commands"$', response.headers["Server-Timing"]))
+        self.assertEquals(redis_round_trips(response), 2)
+
+    def test_round_trips_budget(self):
+        server.REDIS_ROUND_TRIPS_BUDGET = 2
+        with server.app.test_request_context("/api/v1/portfolios/john"):
+            server.start_request_timer()
+            for asset_id in ["0", "1", "2"]:
+                server.redis_server.hget("asset_id_"+asset_id, "price")
+            server.redis_server.hgetall("holdings_john")
+            server.report_redis_trace(server.app.response_class())
+        self.assertEquals(self.warnings.messages, ["GET /api/v1/portfolios/john made 4 Redis round trips, over the budget of 2: HGET x3, HGETALL x1"])
+
+    def test_repeated_reads(self):
+        with server.app.test_request_context("/api/v1/portfolios/john", method="PUT"):
+            server.start_request_timer()
+            server.redis_server.hget("user_john", "name")
+            pipe = server.redis_server.pipeline(transaction=False)
+            pipe.hget("user_john", "name").hmget("user_john", ["nav"]).hincrby("counter", "field", 1)
+            pipe.execute()
+            server.redis_server.hmget("user_john", ["nav"])
+            server.redis_server.hincrby("counter", "field", 1) # not a read
+            server.report_redis_trace(server.app.response_class())
+        self.assertEquals(self.warnings.messages, ["PUT /api/v1/portfolios/john sent the same Redis reads several times: "
+                                                   "HMGET ('user_john', ['nav']) x2, HGET ('user_john', 'name') x2"])
+
+    def test_not_traced(self):
+        self.assertEquals(server.redis_server.hget("user_john", "name"), "john") # outside of a request
+        server.redis_server = FakeRedisServer(self.database)
+        response = self.app.get(url_version+"/portfolios/john/nav")
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertFalse("Server-Timing" in response.headers)
+
+def real_redis_server():
+    """ Returns a client of the database REDIS_TEST_DB (15) of a real
+    Redis at REDIS_TEST_HOST:REDIS_TEST_PORT, flushed, or None if Redis is
+    not available.
+    """
+    redis = Redis(host=os.getenv("REDIS_TEST_HOST", "localhost"),
+                  port=int(os.getenv("REDIS_TEST_PORT", 6379)),
+                  db=int(os.getenv("REDIS_TEST_DB", 15)))
+    try:
+        redis.flushdb()
+    except ConnectionError:
+        return None
+    return redis
+
+class Concurrency(unittest.TestCase):
+    """ Runs the Lua scripts from several threads on a real Redis (see
+    real_redis_server). Skipped if Redis is not available.
+    """
+    def setUp(self):
+        global server
+        server = __import__("server", globals(), locals(), [''], -1)
+        server.SECURED = False
+        self.app = server.app.test_client()
+        server.redis_server = real_redis_server()
+        if server.redis_server is None:
+            del sys.modules[server.__name__]
+            self.skipTest("Redis is not available")
+        server.load_lua_scripts()
+
+    def tearDown(self):
+        server.redis_server.flushdb()
+        del sys.modules[server.__name__]
+
+    def test_buy_sell_threads(self):
+        server.redis_server.hmset("asset_id_4", {"id": 4, "name": "silver", "class": "commodity", "price": 2.5})
+        self.app.post(url_version+"/portfolios", data='{"user":"john"}')
+        self.app.post(url_version+"/portfolios/john/assets", data='{"asset_id":4,"quantity":1000}')
+        codes = []
+        def trade():
+            for _ in range(50):
+                codes.append(server.run_trade_script("buy_sell", "john", 4, 3))
+                codes.append(server.run_trade_script("buy_sell", "john", 4, -1))
+        threads = [threading.Thread(target=trade) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(codes, [server.TRADE_OK] * 800)
+        response = self.app.get(url_version+"/portfolios/john/assets/4")
+        self.assertEquals(json.loads(response.data)["quantity"], 1800)
+        response = self.app.get(url_version+"/portfolios/john/nav")
+        self.assertEquals(json.loads(response.data)["nav"], 4500)
+
+class ExposureFuzz(unittest.TestCase):
+    """ Checks that the exposures maintained by the Lua scripts of a real
+    Redis (see real_redis_server) are the ones recomputed by
+    rebuild_exposure after random operations. Skipped if Redis is not
+    available.
+    """
+    def setUp(self):
+        global server
+        server = __import__("server", globals(), locals(), [''], -1)
+        server.SECURED = False
+        self.app = server.app.test_client()
+        server.redis_server = real_redis_server()
+        if server.redis_server is None:
+            del sys.modules[server.__name__]
+            self.skipTest("Redis is not available")
+        server.load_lua_scripts()
+
+    def tearDown(self):
+        server.redis_server.flushdb()
+        del sys.modules[server.__name__]
+
+    def exposures(self):
+        redis = server.redis_server
+        keys = ["book_exposure_class", "book_exposure_asset"]
+        values = dict()
+        for user in redis.smembers("list_users"):
+            values[("user_"+user, "nav")] = float(redis.hget("user_"+user, "nav") or 0) # not stored before any trade
+            keys += ["exposure_class_"+user, "exposure_asset_"+user]
+        for key in keys:
+            for field, value in server.exposure_values(redis.hgetall(key)).iteritems():
+                values[(key, field)] = value
+        return values
+
+    def test_rebuild_exposure_random_operations(self):
+        rand = random.Random(15)
+        users = ["user%d" % i for i in range(30)]
+        classes = ["commodity", "equity", "fixed income"]
+        def asset(asset_id):
+            return {"id": asset_id, "name": "asset %d" % asset_id, "class": rand.choice(classes), "price": round(rand.uniform(1, 100), 2)}
+        server.import_assets([asset(asset_id) for asset_id in range(20)])
+        for user in users:
+            self.app.post(url_version+"/portfolios", data=json.dumps({"user": user}))
+        for _ in range(3000):
+            user, asset_id, quantity = rand.choice(users), rand.randrange(20), rand.randint(-10, 20)
+            operation = rand.random()
+            if operation < 0.2:
+                self.app.post(url_version+"/portfolios/"+user+"/assets", data=json.dumps({"asset_id": asset_id, "quantity": abs(quantity) + 1}))
+            elif operation < 0.45:
+                self.app.put(url_version+"/portfolios/"+user+"/assets/"+str(asset_id), data=json.dumps({"quantity": quantity}))
+            elif operation < 0.55:
+                self.app.delete(url_version+"/portfolios/"+user+"/assets/"+str(asset_id))
+            elif operation < 0.7:
+                trades = [{"asset_id": rand.randrange(20), "quantity": rand.randint(-5, 10) + 0.5} for _ in range(3)]
+                self.app.post(url_version+"/portfolios/"+user+"/trades", data=json.dumps({"trades": trades}))
+            elif operation < 0.8:
+                trades = [{"user": rand.choice(users), "asset_id": rand.randrange(20), "quantity": rand.randint(-5, 10)} for _ in range(5)]
+                self.app.post(url_version+"/trades", data=json.dumps({"trades": trades}))
+            elif operation < 0.9:
+                prices = [{"asset_id": rand.randrange(20), "price": round(rand.uniform(1, 100), 2)} for _ in range(2)]
+                self.app.put(url_version+"/assets/prices", data=json.dumps({"prices": prices}))
+            elif operation < 0.95:
+                server.import_assets([asset(asset_id)])
+            elif operation < 0.98:
+                self.app.delete(url_version+"/portfolios/"+user)
+            else:
+                self.app.post(url_version+"/portfolios", data=json.dumps({"user": user}))
+        maintained = self.exposures()
+        self.assertTrue(("book_exposure_class", "equity") in maintained)
+        server.rebuild_exposure(batch_size=4)
+        rebuilt = self.exposures()
+        self.assertEquals(sorted(maintained), sorted(rebuilt))
+        for key, value in maintained.iteritems():
+            self.assertAlmostEqual(value, rebuilt[key], delta=1e-6, msg=key)
+
+class Scripts(unittest.TestCase):
+    """ Runs the error paths of the Lua scripts on a real Redis (see
+    real_redis_server), as FakeRedisServer only emulates them. Skipped if
+    Redis is not available.
+    """
+    def setUp(self):
+        global server
+        server = __import__("server", globals(), locals(), [''], -1)
+        server.SECURED = False
+        self.app = server.app.test_client()
+        server.redis_server = real_redis_server()
+        if server.redis_server is None:
+            del sys.modules[server.__name__]
+            self.skipTest("Redis is not available")
+        server.load_lua_scripts()
+        server.fill_database_assets()
+        self.app.post(url_version+"/portfolios", data='{"user":"john"}')
+        self.app.post(url_version+"/portfolios/john/assets", data='{"asset_id":2,"quantity":10}')
+
+    def tearDown(self):
+        server.redis_server.flushdb()
+        del sys.modules[server.__name__]
+
+    def state(self):
+        redis = server.redis_server
+        return (redis.hget("asset_id_2", "price"), redis.hget("user_john", "nav"),
+                redis.hgetall("exposure_class_john"), redis.hgetall("book_exposure_asset"))
+
+    def dump(self):
+        redis = server.redis_server
+        read = {"hash" : redis.hgetall, "set" : redis.smembers, "string" : redis.get, "zset" : lambda key: redis.zrange(key, 0, -1)}
+        return dict((key, read[redis.type(key)](key)) for key in redis.keys())
+
+    def trade(self, name, user, asset_id, quantity="0.0"):
+        keys = ["user_"+user, "holdings_"+user, "asset_id_"+str(asset_id), "holders_"+str(asset_id)]
+        return server.run_lua_script(name, keys, [asset_id, quantity, user])
+
+    def test_trade_scripts_errors(self):
+        server.redis_server.hmset("user_bob", {"name" : "bob", "data" : "626f62;323a35"})
+        server.redis_server.hset("user_alice", "name", "alice")
+        before = self.dump()
+        for name, user, asset_id, quantity, code in [
+                ("buy_sell", "jane", 2, "1.0", server.TRADE_USER_NOT_FOUND),
+                ("buy_sell", "bob", 2, "1.0", server.TRADE_LEGACY_DATA),
+                ("buy_sell", "alice", 2, "1.0", server.TRADE_NO_DATA),
+                ("buy_sell", "john", 3, "1.0", server.TRADE_ASSET_NOT_FOUND),
+                ("buy_sell", "john", 2, "-11.0", server.TRADE_NEGATIVE),
+                ("buy_sell", "john", 2, "nan", server.TRADE_INVALID_QUANTITY),
+                ("buy_sell", "john", 2, "1e308", server.TRADE_INVALID_QUANTITY),
+                ("create_holding", "john", 9, "1.0", server.TRADE_ASSET_NOT_FOUND),
+                ("create_holding", "jane", 3, "1.0", server.TRADE_USER_NOT_FOUND),
+                ("create_holding", "bob", 3, "1.0", server.TRADE_LEGACY_DATA),
+                ("create_holding", "john", 2, "1.0", server.TRADE_ALREADY_EXISTS),
+                ("create_holding", "john", 3, "inf", server.TRADE_INVALID_QUANTITY),
+                ("create_holding", "alice", 1, "1e305", server.TRADE_INVALID_QUANTITY),
+                ("remove_holding", "jane", 2, "0.0", server.TRADE_USER_NOT_FOUND),
+                ("remove_holding", "bob", 2, "0.0", server.TRADE_LEGACY_DATA)]:
+            self.assertEquals(self.trade(name, user, asset_id, quantity), code, name+" "+user)
+        self.assertEquals(self.dump(), before)
+        self.assertEquals(self.trade("buy_sell", "john", 2, "0.0"), server.TRADE_OK)
+        self.assertEquals(self.trade("remove_holding", "john", 3), server.TRADE_OK)
+        self.assertEquals(self.dump(), before)
+
+    def test_apply_trades_errors(self):
+        server.redis_server.hmset("user_bob", {"name" : "bob", "data" : "626f62;323a35"})
+        before = self.dump()
+        held = server.redis_server.hget("holdings_john", 2)
+        for user, legs, code in [
+                ("jane", [3, "", "1.0"], server.TRADE_USER_NOT_FOUND),
+                ("bob", [3, "", "1.0"], server.TRADE_LEGACY_DATA),
+                ("john", [3, "", "1.0", 2, "9.0", "5.0"], server.TRADE_CONFLICT),
+                ("john", [2, held, "5.0", 3, "1.0", ""], server.TRADE_CONFLICT),
+                ("john", [2, held, "5.0", 3, "", "nan"], server.TRADE_INVALID_QUANTITY),
+                ("john", [3, "", "1.0", 1, "", "1e305"], server.TRADE_INVALID_QUANTITY)]:
+            self.assertEquals(server.run_lua_script("apply_trades", ["user_"+user, "holdings_"+user], [user] + legs), code, str(legs))
+        self.assertEquals(self.dump(), before)
+
+    def test_user_scripts_errors(self):
+        redis = server.redis_server
+        redis.hmset("user_bob", {"name" : "bob", "data" : "626f62;323a35"})
+        redis.sadd("holders_2", "bob", "gone")
+        before = self.dump()
+        self.assertEquals(server.run_lua_script("refresh_nav", ["user_jane", "holdings_jane"], ["jane"]), None)
+        self.assertEquals(server.run_lua_script("delete_user", ["user_bob", "holdings_bob", "list_users"], ["bob"]), server.TRADE_LEGACY_DATA)
+        self.assertEquals(server.run_lua_script("migrate_holdings", ["user_bob", "holdings_bob"], ["626f62;", 2, "5.0"]), 0)
+        self.assertEquals(server.run_lua_script("replace_data", ["user_bob"], ["626f62;", "626f62;"]), 0)
+        self.assertEquals(server.run_lua_script("create_user", ["user_bob", "list_users"], ["bob"]), 0)
+        self.assertEquals(self.dump(), before)
+        self.assertEquals(sorted(redis.hgetall("user_john")), ["name", "nav", "version"])
+        self.assertEquals(server.run_lua_script("prune_holders", ["holders_2"], [2, "john", "bob", "gone"]), 1)
+        self.assertEquals(redis.smembers("holders_2"), set(["john", "bob"]))
+
+    def test_set_price_not_finite(self):
+        before = self.state()
+        self.assertEquals(float(before[1]), 514.5)
+        for price in ["inf", "nan", "1e308"]:
+            self.assertEquals(server.run_lua_script("set_price", ["asset_id_2", "holders_2"], [2, price]), server.TRADE_INVALID_QUANTITY)
+        for price in ["Infinity", "1e308"]:
+            response = self.app.put(url_version+"/assets/prices", data='{"prices":[{"asset_id":2,"price":'+price+'}]}')
+            self.assertEquals(response.status_code, HTTP_400_BAD_REQUEST)
+        self.assertEquals(self.state(), before)
+        response = self.app.put(url_version+"/assets/prices", data='{"prices":[{"asset_id":2,"price":5}]}')
+        self.assertEquals(response.status_code, HTTP_200_OK)
+        self.assertEquals(float(server.redis_server.hget("user_john", "nav")), 50)
+        self.assertEquals(server.exposure_values(server.redis_server.hgetall("exposure_class_john")), {"commodity" : 50})
+
+    def test_upsert_assets_not_finite(self):
+        before = self.state()
+        self.assertEquals(server.run_lua_script("upsert_assets", ["asset_id_2", "holders_2", "asset_id_7", "holders_7"],
+                                                [2, "brent crude oil", "commodity", "1e308", 7, "silver", "metal", "17.0"]),
+                          [server.TRADE_INVALID_QUANTITY, 1])
+        self.assertEquals(server.run_lua_script("upsert_assets", ["asset_id_2", "holders_2"], [2, "brent", "energy", "inf"]), [server.TRADE_INVALID_QUANTITY])
+        self.assertEquals(self.state(), before)
+        self.assertEquals(server.redis_server.hget("asset_id_2", "name"), "brent crude oil")
+        report = server.import_assets([{"id": 2, "name": "brent crude oil", "class": "commodity", "price": 1e308},
+                                       {"id": 8, "name": "copper", "class": "metal", "price": 6}])
+        self.assertEquals((report["created"], report["updated"], report["invalid"]), (1, 0, 1))
+        self.assertEquals(self.state(), before)
+        self.assertEquals(server.redis_server.hget("asset_id_8", "price"), "6.0")
+
+class AssetCatalog(unittest.TestCase):
+    def setUp(self):
+        server = __import__("server", globals(), locals(), [''], -1)
+        server.SECURED = False
+        self.app = server.app.test_client()
+
+    def tearDown(self):
+        del sys.modules[server.__name__]
+
+    def test_load(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":1286.59,"class":"commodity"}
+        database["asset_id_1"] = {"id": 1,"name":"NYC real estate index","price":16255.18,"class":"real-estate"}
+        database["user_john"] = {"name":"john", "data":""}
+        database["asset_catalog_version"] = 3
+        server.redis_server = FakeRedisServer(database)
+        catalog = server.AssetCatalog()
+        catalog.load()
+        self.assertEquals(sorted(catalog.assets), [0, 1])
+        self.assertEquals(catalog.assets[1], {"id": 1,"name":"NYC real estate index","price":16255.18,"class":"real-estate"})
+        self.assertEquals(catalog.version, 3)
+
+    def test_get_from_memory(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":1286.59,"class":"commodity"}
+        server.redis_server = FakeRedisServer(database)
+        catalog = server.AssetCatalog()
+        catalog.load()
+        del database["asset_id_0"]
+        self.assertEquals(catalog.get(0)["name"], "gold")
+        self.assertEquals(catalog.hits, 1)
+        self.assertEquals(catalog.misses, 0)
+
+    def test_get_new_asset(self):
+        database = dict()
+        server.redis_server = FakeRedisServer(database)
+        catalog = server.AssetCatalog()
+        catalog.load()
+        database["asset_id_2"] = {"id": 2,"name":"brent crude oil","price":51.45,"class":"commodity"}
+        self.assertEquals(catalog.get(2)["price"], 51.45)
+        self.assertEquals(catalog.misses, 1)
+        self.assertEquals(catalog.get(2)["price"], 51.45)
+        self.assertEquals(catalog.hits, 1)
+
+    def test_get_not_found(self):
+        server.redis_server = FakeRedisServer(dict())
+        catalog = server.AssetCatalog()
+        self.assertEquals(catalog.get(7), None)
+
+    def test_get_invalidated_while_fetched(self):
+        database = dict()
+        database["asset_id_2"] = {"id": 2,"name":"brent crude oil","price":51.45,"class":"commodity"}
+        server.redis_server = FakeRedisServer(database)
+        catalog = server.AssetCatalog()
+        catalog.load()
+        database["asset_id_3"] = {"id": 3,"name":"silver","price":17.1,"class":"commodity"}
+        hgetall = server.redis_server.hgetall
+        def hgetall_then_invalidate(key):
+            asset_hash = hgetall(key)
+            catalog.on_message({"type":"message", "data":"3"}) # price changed meanwhile
+            return asset_hash
+        server.redis_server.hgetall = hgetall_then_invalidate
+        self.assertEquals(catalog.get(3)["price"], 17.1)
+        self.assertFalse(3 in catalog.assets)
+        del server.redis_server.hgetall
+        self.assertEquals(catalog.get(3)["price"], 17.1)
+        self.assertTrue(3 in catalog.assets)
+
+    def test_prefetch_invalidated_while_fetched(self):
+        database = dict()
+        server.redis_server = FakeRedisServer(database)
+        catalog = server.AssetCatalog()
+        catalog.load()
+        database["asset_id_3"] = {"id": 3,"name":"silver","price":17.1,"class":"commodity"}
+        pipeline = server.redis_server.pipeline
+        def pipeline_then_invalidate(transaction=True):
+            pipe = pipeline(transaction)
+            execute = pipe.execute
+            def execute_then_invalidate():
+                results = execute()
+                catalog.on_message({"type":"message", "data":"3"})
+                return results
+            pipe.execute = execute_then_invalidate
+            return pipe
+        server.redis_server.pipeline = pipeline_then_invalidate
+        catalog.prefetch([3])
+        self.assertEquals(catalog.assets, {})
+        self.assertEquals(catalog.invalidations, 2)
+
+    def test_version_changed(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":1286.59,"class":"commodity"}
+        server.redis_server = FakeRedisServer(database)
+        catalog = server.AssetCatalog(refresh_interval=0)
+        catalog.load()
+        database["asset_id_0"]["price"] = 1300.0
+        self.assertEquals(catalog.get(0)["price"], 1286.59)
+        database["asset_catalog_version"] = 1
+        self.assertEquals(catalog.get(0)["price"], 1300.0)
+        self.assertEquals(catalog.reloads, 2)
+
+    def test_on_message(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":1286.59,"class":"commodity"}
+        database["asset_id_1"] = {"id": 1,"name":"NYC real estate index","price":16255.18,"class":"real-estate"}
+        server.redis_server = FakeRedisServer(database)
+        catalog = server.AssetCatalog()
+        catalog.load()
+        catalog.on_message({"type":"message", "data":"1"})
+        self.assertEquals(sorted(catalog.assets), [0])
+        catalog.on_message({"type":"message", "data":"*"})
+        self.assertFalse(catalog.loaded)
+
+    def test_unsubscribe(self):
+        class FakeListener(object):
+            stopped = joined = False
+            def stop(self):
+                self.stopped = True
+            def join(self):
+                self.joined = True
+        catalog = server.AssetCatalog()
+        catalog.unsubscribe()
+        listener = catalog.listener = FakeListener()
+        catalog.unsubscribe()
+        self.assertTrue(listener.stopped and listener.joined)
+        self.assertEquals(catalog.listener, None)
+
+    def test_notify_asset_change(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":1286.59,"class":"commodity"}
+        server.redis_server = FakeRedisServer(database)
+        server.asset_catalog.load()
+        database["asset_id_0"]["price"] = 1300.0
+        server.notify_asset_change([0])
+        self.assertEquals(database["asset_catalog_version"], 1)
+        self.assertEquals(server.asset_catalog.get(0)["price"], 1300.0)
+
+    def test_prefetch(self):
+        database = dict()
+        server.redis_server = FakeRedisServer(database)
+        catalog = server.AssetCatalog()
+        catalog.load()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":1286.59,"class":"commodity"}
+        database["asset_id_2"] = {"id": 2,"name":"brent crude oil","price":51.45,"class":"commodity"}
+        catalog.prefetch([0, 2, 5])
+        self.assertEquals(sorted(catalog.assets), [0, 2])
+        self.assertEquals(catalog.misses, 3)
+        del database["asset_id_0"]
+        self.assertEquals(catalog.get(0)["name"], "gold")
+
+    def test_deserialize_portfolio_prefetches(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":10,"class":"commodity"}
+        database["asset_id_1"] = {"id": 1,"name":"NYC real estate index","price":20,"class":"real-estate"}
+        server.redis_server = FakeRedisServer(database)
+        server.asset_catalog.load()
+        server.asset_catalog.assets.clear()
+        portfolio = server.Portfolio.deserialize("6a6f686e;33303b3335326533302333313b333632653330")
+        self.assertEquals(server.asset_catalog.misses, 2)
+        self.assertEquals(server.asset_catalog.hits, 2)
+        self.assertEquals(portfolio.assets[0], server.Asset(0, 5.0))
+        self.assertEquals(portfolio.assets[1], server.Asset(1, 6.0))
+        self.assertEquals(portfolio.nav, 10 * 5.0 + 20 * 6.0)
+
+    def test_asset_not_found(self):
+        server.redis_server = FakeRedisServer(dict())
+        with self.assertRaises(server.AssetNotFoundException):
+            server.Asset(5, 1)
+
+    def test_deserialize_portfolio_from_memory(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":1286.59,"class":"commodity"}
+        server.redis_server = FakeRedisServer(database)
+        server.asset_catalog.load()
+        server.redis_server = FakeRedisServer(dict())
+        portfolio = server.Portfolio.deserialize("6a6f686e;33303b3335")
+        self.assertEquals(portfolio.nav, 5 * 1286.59)
+
 class Credentials(unittest.TestCase):
     def setUp(self):
         server = __import__("server", globals(), locals(), [''], -1)
@@ -902,6 +3001,171 @@ class Other(unittest.TestCase):
         creds = server.determine_credentials()
         self.assertEquals(creds, creds_expected)
         
+    def test_migrate_portfolios_encoding(self):
+        database = dict()
+        database["user_john"] = {"name":"john", "data":"6a6f686e;33303b3335"}
+        database["user_jeremy"] = {"name":"jeremy", "data":""}
+        database["user_alice"] = {"name":"alice", "data":server.Portfolio.encode("alice", [(1, 2.0)])}
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":1286.59,"class":"commodity"}
+        server.redis_server = FakeRedisServer(database)
+        report = server.migrate_portfolios_encoding(batch_size=2)
+        self.assertEquals(report["scanned"], 3)
+        self.assertEquals(report["migrated"], 1)
+        self.assertEquals(report["skipped"], 0)
+        self.assertTrue("usedMemoryBefore" in report and "usedMemoryAfter" in report)
+        self.assertEquals(database["user_john"]["data"], server.Portfolio.encode("john", [(0, 5.0)]))
+        self.assertEquals(database["user_jeremy"]["data"], "")
+
+    def test_migrate_holdings(self):
+        database = dict()
+        database["user_john"] = {"name":"john", "data":"6a6f686e;33303b3335"}
+        database["user_jeremy"] = {"name":"jeremy", "data":""}
+        database["user_alice"] = {"name":"alice", "data":server.Portfolio.encode("alice", [(1, 2.0), (3, 0.5)])}
+        server.redis_server = FakeRedisServer(database)
+        report = server.migrate_holdings(batch_size=2)
+        self.assertEquals(report, {"scanned":3, "migrated":2, "skipped":0})
+        self.assertEquals(database["user_john"], {"name":"john", "nav":"0.0"})
+        self.assertEquals(database["holdings_john"], {"0":"5.0"})
+        self.assertEquals(database["holdings_alice"], {"1":"2.0", "3":"0.5"})
+        self.assertFalse("holdings_jeremy" in database)
+
+    def test_migrate_user_holdings_concurrent_update(self):
+        database = dict()
+        database["user_john"] = {"name":"john", "data":server.Portfolio.encode("john", [(0, 7.0)])}
+        server.redis_server = FakeRedisServer(database)
+        holdings = server.migrate_user_holdings("john", "6a6f686e;33303b3335")
+        self.assertEquals(holdings, [(0, 7.0)])
+        self.assertEquals(database["holdings_john"], {"0":"7.0"})
+
+    def test_set_asset_prices(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":"10.0","class":"commodity"}
+        database["user_john"] = {"name":"john", "nav":"50.0"}
+        database["holdings_john"] = {"0":"5.0"}
+        database["holders_0"] = set(["john"])
+        database["user_jeremy"] = {"name":"jeremy", "nav":"20.0"}
+        database["holdings_jeremy"] = {"1":"1.0"}
+        database["holders_1"] = set(["jeremy"])
+        server.redis_server = FakeRedisServer(database)
+        self.assertEquals(server.set_asset_prices({0: 12}), (1, []))
+        self.assertEquals(float(database["asset_id_0"]["price"]), 12)
+        self.assertEquals(float(database["user_john"]["nav"]), 60)
+        self.assertEquals(float(database["user_jeremy"]["nav"]), 20)
+
+    def test_holders_maintained(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":"10.0","class":"commodity"}
+        database["user_john"] = {"name":"john"}
+        server.redis_server = FakeRedisServer(database)
+        server.run_trade_script("create_holding", "john", 0, 2)
+        self.assertEquals(database["holders_0"], set(["john"]))
+        server.run_trade_script("buy_sell", "john", 0, -2)
+        self.assertFalse("holders_0" in database)
+        server.run_trade_script("create_holding", "john", 0, 2)
+        server.run_trade_script("remove_holding", "john", 0)
+        self.assertFalse("holders_0" in database)
+
+    def test_exposure_maintained(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":"10.0","class":"commodity"}
+        database["asset_id_1"] = {"id": 1,"name":"bond","price":"100.0","class":"fixed income"}
+        database["user_john"] = {"name":"john"}
+        database["user_jeremy"] = {"name":"jeremy"}
+        database["list_users"] = set(["john", "jeremy"])
+        server.redis_server = FakeRedisServer(database)
+        server.run_trade_script("create_holding", "john", 0, 2)
+        server.run_trade_script("create_holding", "jeremy", 0, 1)
+        server.trade_portfolio("john", [(1, 3)])
+        server.run_trade_script("buy_sell", "john", 0, 1)
+        server.set_asset_prices({0: 20})
+        book = server.exposure_values(database["book_exposure_class"])
+        self.assertEquals(server.exposure_values(database["exposure_class_john"]), {"commodity" : 60, "fixed income" : 300})
+        self.assertEquals(server.exposure_values(database["exposure_asset_john"]), {"0" : 60, "1" : 300})
+        self.assertEquals(book, {"commodity" : 80, "fixed income" : 300})
+        self.assertEquals(server.exposure_values(database["book_exposure_asset"]), {"0" : 80, "1" : 300})
+        server.run_trade_script("remove_holding", "john", 1)
+        self.assertEquals(server.exposure_values(database["exposure_asset_john"]), {"0" : 60})
+        self.assertEquals(server.exposure_values(database["book_exposure_class"]), {"commodity" : 80})
+        server.run_lua_script("delete_user", ["user_john", "holdings_john", "list_users"], ["john"])
+        self.assertFalse("exposure_class_john" in database)
+        self.assertEquals(server.exposure_values(database["book_exposure_class"]), {"commodity" : 20})
+        server.run_trade_script("buy_sell", "jeremy", 0, -1)
+        self.assertFalse("exposure_class_jeremy" in database)
+        self.assertEquals(server.exposure_values(database["book_exposure_asset"]), {})
+
+    def test_rebuild_exposure(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":"10.0","class":"commodity"}
+        database["user_john"] = {"name":"john", "nav":"50.0"}
+        database["holdings_john"] = {"0":"5.0"}
+        database["exposure_class_john"] = {"commodity":"40.0"}
+        database["book_exposure_class"] = {"commodity":"40.0"}
+        database["user_jeremy"] = {"name":"jeremy", "nav":"10.0"}
+        database["holdings_jeremy"] = {"0":"1.0"}
+        server.redis_server = FakeRedisServer(database)
+        self.assertEquals(server.rebuild_exposure(batch_size=1), {"refreshed" : 2})
+        self.assertEquals(server.exposure_values(database["exposure_class_john"]), {"commodity" : 50})
+        self.assertEquals(server.exposure_values(database["book_exposure_class"]), {"commodity" : 60})
+        self.assertEquals(server.exposure_values(database["book_exposure_asset"]), {"0" : 60})
+
+    def test_rebuild_asset_index(self):
+        database = dict()
+        database["asset_id_0"] = {"id": "0","name":"gold","price":"10.0","class":"commodity"}
+        database["asset_id_1"] = {"id": "1","name":"Brent  Crude","price":"5.0","class":"commodity"}
+        server.redis_server = FakeRedisServer(database)
+        self.assertEquals(server.rebuild_asset_index(batch_size=1), {"indexed" : 2})
+        self.assertEquals(database["assets_names"], set(["gold\x000", "brent crude\x001"]))
+        self.assertEquals(database["assets_class_commodity"], set(["0", "1"]))
+
+    def test_rebuild_holders(self):
+        database = dict()
+        database["user_john"] = {"name":"john"}
+        database["holdings_john"] = {"0":"5.0", "1":"1.0"}
+        database["user_bob"] = {"name":"bob", "data":"626f62;33303b3335"}
+        database["holders_0"] = set(["john", "gone"])
+        database["holders_3"] = set(["john"])
+        server.redis_server = FakeRedisServer(database)
+        report = server.rebuild_holders(batch_size=1)
+        self.assertEquals(report, {"scanned":2, "added":2, "removed":2})
+        self.assertEquals(database["holders_0"], set(["john", "bob"]))
+        self.assertEquals(database["holders_1"], set(["john"]))
+        self.assertFalse("holders_3" in database)
+
+    def test_verify_navs(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":"10.0","class":"commodity"}
+        database["user_john"] = {"name":"john", "nav":"49.0"}
+        database["holdings_john"] = {"0":"5.0"}
+        database["user_jeremy"] = {"name":"jeremy", "nav":"10.0"}
+        database["holdings_jeremy"] = {"0":"1.0"}
+        database["user_alice"] = {"name":"alice"}
+        database["holdings_alice"] = {"0":"2.0"}
+        database["user_bob"] = {"name":"bob", "data":"626f62;"}
+        server.redis_server = FakeRedisServer(database)
+        report = server.verify_navs(batch_size=2)
+        self.assertEquals((report["scanned"], report["legacy"], report["missing"], report["drifted"]), (4, 1, 1, 1))
+        self.assertEquals(report["users"], ["john"])
+        self.assertEquals(report["maxDrift"], 1.0)
+        report = server.verify_navs(repair=True)
+        self.assertEquals(report["repaired"], 2)
+        self.assertEquals(float(database["user_john"]["nav"]), 50)
+        self.assertEquals(float(database["user_alice"]["nav"]), 20)
+        self.assertEquals(server.verify_navs()["drifted"], 0)
+
+    def test_verify_navs_prices(self):
+        database = dict()
+        database["asset_id_0"] = {"id": 0,"name":"gold","price":"10.0","class":"commodity"}
+        database["user_john"] = {"name":"john", "nav":"50.0"}
+        database["holdings_john"] = {"0":"5.0", "7":"1.0"}
+        server.redis_server = FakeRedisServer(database)
+        server.asset_catalog.load()
+        database["asset_id_0"]["price"] = "12.0" # repriced by another process
+        database["user_john"]["nav"] = "60.0"
+        report = server.verify_navs()
+        self.assertEquals((report["scanned"], report["drifted"]), (1, 0))
+        database["user_john"]["nav"] = "50.0"
+        self.assertEquals(server.verify_navs()["users"], ["john"])
+
     def test_fill_database_assets(self):
         temp = server.redis_server
         server.redis_server = FakeRedisServer(dict())
@@ -912,6 +3176,39 @@ class Other(unittest.TestCase):
             exception_raised = True
         server.redis_server = temp
         self.assertFalse(exception_raised)
+
+    def test_fill_database_assets_once(self):
+        database = dict()
+        server.redis_server = FakeRedisServer(database)
+        server.fill_database_assets()
+        self.assertEquals(database["seed_version"], str(server.SEED_VERSION))
+        self.assertEquals(database["asset_id_0"]["price"], "1286.59")
+        database["asset_id_0"]["price"] = "1300.0"
+        database["asset_id_1"]["name"] = "renamed"
+        server.fill_database_assets()
+        self.assertEquals(database["asset_id_1"]["name"], "renamed")
+        del database["seed_version"]
+        server.fill_database_assets()
+        self.assertEquals(database["asset_id_1"]["name"], "NYC real estate index")
+        self.assertEquals(database["asset_id_0"]["price"], "1300.0")
+
+    def test_fill_database_admin(self):
+        database = dict()
+        server.redis_server = FakeRedisServer(database)
+        server.fill_database_admin()
+        hash_password = database["admin_password_admin"]["hash_password"]
+        self.assertTrue(check_password_hash(hash_password, "admin_password"))
+        server.fill_database_admin()
+        self.assertEquals(database["admin_password_admin"]["hash_password"], hash_password)
+
+    def test_render_swagger_specification(self):
+        specification = server.render_swagger_specification("example.com:8080")
+        self.assertTrue(specification.startswith("var spec = "))
+        self.assertEquals(json.loads(specification[len("var spec = "):-1])["host"], "example.com:8080")
+        server.swagger_specification = specification
+        resp = server.app.test_client().get("/specification/portfolioMgmt.js")
+        self.assertEquals(resp.status_code, HTTP_200_OK)
+        self.assertEquals(resp.data, specification)
         
         
 